@@ -7,6 +7,8 @@ from langchain.llms import CTransformers
 import chainlit as cl
 from langchain_community.chat_models import ChatOpenAI
 from langchain_community.embeddings import OpenAIEmbeddings
+import asyncio
+import time
 import yaml
 import logging
 from dotenv import load_dotenv
@@ -14,6 +16,12 @@ from dotenv import load_dotenv
 from modules.llm_tutor import LLMTutor
 from modules.constants import *
 from modules.helpers import get_sources
+from modules.model_registry import model_registry
+from modules.lexical_index import retrieval_stats
+from modules.generation_control import generation_stats
+from modules.condensation import condense_stats
+from modules.streaming import AnswerStreamHandler
+from modules.local_inference import InferenceUnavailable, LocalLLM
 
 
 logger = logging.getLogger(__name__)
@@ -75,6 +83,8 @@ async def start():
 
     chat_profile = cl.user_session.get("chat_profile")
     if chat_profile is not None:
+        # Selects the generation options of the profile (see generation_control.py)
+        config["llm_params"]["chat_profile"] = chat_profile.lower()
         if chat_profile.lower() in ["gpt-3.5-turbo-1106", "gpt-4"]:
             config["llm_params"]["llm_loader"] = "openai"
             config["llm_params"]["openai_params"]["model"] = chat_profile.lower()
@@ -93,6 +103,7 @@ async def start():
     llm_tutor = LLMTutor(config, logger=logger)
 
     chain = llm_tutor.qa_bot()
+    logger.info(f"Model registry: {model_registry.stats()}")
     model = config["llm_params"]["local_llm_params"]["model"]
     msg = cl.Message(content=f"Starting the bot {model}...")
     await msg.send()
@@ -100,18 +111,58 @@ async def start():
     await msg.update()
 
     cl.user_session.set("chain", chain)
+    cl.user_session.set("llm", llm_tutor.llm)
+    cl.user_session.set("llm_tutor", llm_tutor)
 
 
 @cl.on_message
 async def main(message):
     user = cl.user_session.get("user")
     chain = cl.user_session.get("chain")
-    # cb = cl.AsyncLangchainCallbackHandler(
-    #     stream_final_answer=True, answer_prefix_tokens=["FINAL", "ANSWER"]
-    # )
-    # cb.answer_reached = True
-    # res=await chain.acall(message, callbacks=[cb])
-    res = await chain.acall(message.content)
+    llm_tutor = cl.user_session.get("llm_tutor")
+    start_time = time.perf_counter()
+    trace = {}
+    msg = cl.Message(content="")
+
+    # Only the first question of a conversation is answered from the cache,
+    # follow-up questions depend on the chat history
+    answer_cache = llm_tutor.answer_cache
+    memory = getattr(chain, "memory", None)
+    use_cache = answer_cache is not None and (
+        memory is None or not memory.chat_memory.messages
+    )
+    cached = None
+    if use_cache:
+        cached = await asyncio.to_thread(
+            answer_cache.lookup,
+            message.content,
+            llm_tutor.get_llm_name(),
+            llm_tutor.index_version,
+        )
+        trace["answer_cache"] = "hit" if cached is not None else "miss"
+
+    if cached is not None:
+        answer, source_documents = cached
+        res = {"answer": answer, "source_documents": source_documents}
+        if memory is not None:
+            memory.save_context({"question": message.content}, {"answer": answer})
+        stream_handler = None
+    else:
+        # The answer is streamed into the message as it is generated, the sources
+        # are added once the chain is done
+        stream_handler = AnswerStreamHandler(asyncio.get_running_loop())
+        chain_task = asyncio.create_task(
+            chain.acall(message.content, callbacks=[stream_handler])
+        )
+        async for token in stream_handler.stream(chain_task):
+            await msg.stream_token(token)
+        try:
+            res = await chain_task
+        except InferenceUnavailable as e:
+            logger.warning(f"Local model unavailable: {e}")
+            msg.content = "The tutor is busy right now, please try again in a moment."
+            await msg.send()
+            return
     print(f"response: {res}")
     try:
         answer = res["answer"]
@@ -121,4 +172,50 @@ async def main(message):
 
     answer_with_sources, source_elements = get_sources(res, answer)
 
-    await cl.Message(content=answer_with_sources, elements=source_elements).send()
+    msg.content = answer_with_sources
+    msg.elements = source_elements
+    await msg.send()
+
+    if use_cache and cached is None and res["source_documents"]:
+        await asyncio.to_thread(
+            answer_cache.store,
+            message.content,
+            answer,
+            res["source_documents"],
+            llm_tutor.get_llm_name(),
+            llm_tutor.index_version,
+        )
+
+    if cached is None:
+        # Condensation timings of the conversational chain
+        trace.update(res.get("trace", {}))
+    if cached is None and res.get("source_documents"):
+        trace["retrieval_path"] = res["source_documents"][0].metadata.get(
+            "retrieval_path"
+        )
+    trace["total_time"] = time.perf_counter() - start_time
+    if stream_handler is not None:
+        trace.update(stream_handler.metrics())
+    llm = cl.user_session.get("llm")
+    if isinstance(llm, LocalLLM):
+        trace["inference_service"] = llm.service.stats()
+    if answer_cache is not None:
+        trace["answer_cache_stats"] = answer_cache.stats()
+    trace["retrieval_stats"] = retrieval_stats.stats()
+    trace["generation_stats"] = generation_stats.stats()
+    trace["condensation"] = condense_stats.stats()
+    if cached is None and llm_tutor.context_packer is not None:
+        packing = dict(llm_tutor.context_packer.last_stats)
+        # The unpacked prompt is not run: its prefill time is extrapolated from
+        # the measured time to first token, linearly in the prompt tokens
+        if "llm_time_to_first_token" in trace and packing.get("prompt_tokens_after"):
+            packing["measured_time_to_first_token"] = trace["llm_time_to_first_token"]
+            packing["estimated_unpacked_prefill_time"] = (
+                trace["llm_time_to_first_token"]
+                * packing["prompt_tokens_before"]
+                / packing["prompt_tokens_after"]
+            )
+        trace["context_packing"] = packing
+    if llm_tutor.reranker is not None:
+        trace["reranker"] = llm_tutor.reranker.stats()
+    logger.info(f"Message trace: {trace}")
@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from langchain.schema.document import Document
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticAnswerCache:
+    """
+    Caches answers to questions, keyed by the question's embedding. A new
+    question gets the cached answer (and sources) of the most similar cached
+    question when the cosine similarity passes similarity_threshold, and the
+    answer was generated by the same LLM from the same version of the index.
+
+    Entries expire after ttl seconds, the least recently used ones are evicted
+    beyond max_entries. The cache is persisted to cache_path after every change.
+    """
+
+    def __init__(
+        self,
+        cache_path: str,
+        embedding_model,
+        similarity_threshold: float = 0.95,
+        ttl: int = 86400,
+        max_entries: int = 1000,
+    ):
+        self.cache_path = cache_path
+        self.embedding_model = embedding_model
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = []
+        self.vectors = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        entries_path = os.path.join(self.cache_path, "entries.json")
+        vectors_path = os.path.join(self.cache_path, "vectors.npy")
+        if os.path.exists(entries_path) and os.path.exists(vectors_path):
+            with open(entries_path, "r") as f:
+                self.entries = json.load(f)
+            self.vectors = np.load(vectors_path)
+            if len(self.entries) != len(self.vectors):
+                logger.warning("Answer cache is inconsistent, starting empty")
+                self.entries, self.vectors = [], None
+
+    def save(self):
+        os.makedirs(self.cache_path, exist_ok=True)
+        entries_path = os.path.join(self.cache_path, "entries.json")
+        vectors_path = os.path.join(self.cache_path, "vectors.npy")
+        with open(entries_path + ".tmp", "w") as f:
+            # metadata may hold numpy scalars (e.g. the retrieval scores)
+            json.dump(
+                self.entries,
+                f,
+                default=lambda o: o.item() if hasattr(o, "item") else str(o),
+            )
+        with open(vectors_path + ".tmp", "wb") as f:
+            np.save(f, self.vectors if self.vectors is not None else np.zeros((0, 0)))
+        os.replace(entries_path + ".tmp", entries_path)
+        os.replace(vectors_path + ".tmp", vectors_path)
+
+    def embed(self, question: str):
+        vector = np.asarray(
+            self.embedding_model.embed_query(question), dtype=np.float32
+        )
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def remove(self, keep):
+        self.entries = [entry for entry, k in zip(self.entries, keep) if k]
+        self.vectors = self.vectors[np.asarray(keep, dtype=bool)]
+
+    def lookup(self, question: str, llm_name: str, index_version: str):
+        """
+        Returns (answer, source documents), or None on a miss
+        """
+        vector = self.embed(question)
+        with self._lock:
+            now = time.time()
+            if self.entries:
+                expired = [
+                    now - entry["created_at"] > self.ttl for entry in self.entries
+                ]
+                if any(expired):
+                    self.remove([not e for e in expired])
+            if not self.entries:
+                self.misses += 1
+                return None
+            similarities = self.vectors @ vector
+            valid = np.array(
+                [
+                    entry["llm"] == llm_name and entry["index_version"] == index_version
+                    for entry in self.entries
+                ]
+            )
+            similarities[~valid] = -1.0
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry = self.entries[best]
+            entry["last_used"] = now
+            sources = [
+                Document(
+                    page_content=source["page_content"], metadata=source["metadata"]
+                )
+                for source in entry["sources"]
+            ]
+            logger.info(
+                f"Answer cache hit ({similarities[best]:.3f}): "
+                f"'{question}' ~ '{entry['question']}'"
+            )
+            return entry["answer"], sources
+
+    def store(self, question, answer, source_documents, llm_name, index_version):
+        vector = self.embed(question)
+        entry = {
+            "question": question,
+            "answer": answer,
+            "sources": [
+                {"page_content": doc.page_content, "metadata": doc.metadata}
+                for doc in source_documents
+            ],
+            "llm": llm_name,
+            "index_version": index_version,
+            "created_at": time.time(),
+            "last_used": time.time(),
+        }
+        with self._lock:
+            if len(self.entries) >= self.max_entries:
+                lru = min(
+                    range(len(self.entries)), key=lambda i: self.entries[i]["last_used"]
+                )
+                self.remove([i != lru for i in range(len(self.entries))])
+            self.entries.append(entry)
+            if self.vectors is None or len(self.vectors) == 0:
+                self.vectors = vector[None, :]
+            else:
+                self.vectors = np.vstack([self.vectors, vector[None, :]])
+            self.save()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
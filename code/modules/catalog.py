@@ -0,0 +1,223 @@
+import bisect
+import json
+import logging
+import re
+from typing import List
+
+from langchain.schema.document import Document
+
+logger = logging.getLogger(__name__)
+
+# Strings are matched first, so that the repairs never apply inside them
+JSON_REPAIR_PATTERN = re.compile(r'"(?:\\.|[^"\\])*"|:\s*(?=[,}\]])|,\s*(?=[}\]])')
+COURSE_CODE_PATTERN = re.compile(r"\b([A-Za-z]{2,4})[\s\-]?(\d{3})\b")
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+NAME_STOPWORDS = {"a", "an", "and", "for", "in", "of", "on", "the", "to", "with"}
+MIN_PREFIX_LENGTH = 4
+
+
+def repair_json(text: str) -> str:
+    """
+    Fixes the errors of hand-written json: missing values ("credits": ,)
+    become null, and trailing commas are dropped
+    """
+
+    def repair(match):
+        token = match.group(0)
+        if token.startswith('"'):
+            return token
+        if token.startswith(":"):
+            return ": null"
+        return ""
+
+    return JSON_REPAIR_PATTERN.sub(repair, text)
+
+
+def parse_catalog(text: str) -> List[dict]:
+    """
+    The course records of a catalog. If the file is still not valid json after
+    the repairs, the records that are are kept, and the others are skipped
+    with a warning.
+    """
+    text = repair_json(text)
+    try:
+        return json.loads(text)["courses"]
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        logger.warning(f"Parsing the catalog record by record: {e}")
+    decoder = json.JSONDecoder()
+    courses = []
+    for match in re.finditer(r'\{\s*"course_id"', text):
+        try:
+            course, _ = decoder.raw_decode(text, match.start())
+            courses.append(course)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Skipping a catalog record: {e}")
+    return courses
+
+
+def name_tokens(name: str) -> List[str]:
+    return [
+        token
+        for token in WORD_PATTERN.findall(name.lower())
+        if token not in NAME_STOPWORDS
+    ]
+
+
+class CourseCatalog:
+    """
+    In-memory index of the course catalog: courses by department and number
+    ("DS 542"), by normalized name, and by the tokens of their names, with
+    prefix lookups over the name tokens.
+    """
+
+    def __init__(self, courses: List[dict], source: str = "catalog.json"):
+        self.source = source
+        self.courses = []
+        self.by_code = {}
+        self.by_name = {}
+        self.by_token = {}
+        for course in courses:
+            if not course.get("department") or course.get("course_number") is None:
+                continue
+            index = len(self.courses)
+            self.courses.append(course)
+            code = self.normalize_code(course["department"], course["course_number"])
+            self.by_code[code] = index
+            name = " ".join(name_tokens(course.get("course_name") or ""))
+            if name:
+                self.by_name.setdefault(name, []).append(index)
+            for token in set(name.split()):
+                self.by_token.setdefault(token, set()).add(index)
+        self.tokens = sorted(self.by_token)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            courses = parse_catalog(f.read())
+        catalog = cls(courses, source=path)
+        logger.info(f"Loaded {len(catalog.courses)} courses from {path}")
+        return catalog
+
+    @staticmethod
+    def normalize_code(department, number) -> str:
+        return f"{str(department).upper()}{int(number)}"
+
+    def get(self, department: str, number) -> dict:
+        index = self.by_code.get(self.normalize_code(department, number))
+        return None if index is None else self.courses[index]
+
+    def get_by_name(self, name: str) -> List[dict]:
+        indices = self.by_name.get(" ".join(name_tokens(name)), [])
+        return [self.courses[index] for index in indices]
+
+    def prefix_tokens(self, prefix: str) -> List[str]:
+        """
+        Name tokens that start with prefix
+        """
+        start = bisect.bisect_left(self.tokens, prefix)
+        end = bisect.bisect_left(self.tokens, prefix + "\uffff")
+        return self.tokens[start:end]
+
+    def search_tokens(self, tokens: List[str], prefix: bool = True) -> List[dict]:
+        """
+        Courses whose name has all the tokens, or with prefix, tokens that start
+        with them
+        """
+        result = None
+        for token in tokens:
+            if prefix and len(token) >= MIN_PREFIX_LENGTH:
+                matches = set().union(
+                    *(self.by_token[match] for match in self.prefix_tokens(token))
+                )
+            else:
+                matches = self.by_token.get(token, set())
+            result = matches if result is None else result & matches
+            if not result:
+                return []
+        return [self.courses[index] for index in sorted(result or [])]
+
+    def lookup(self, query: str, max_matches: int = 3) -> List[dict]:
+        """
+        The courses a question names, by code ("DS 542") or by full name
+        ("Foundations of Data Science", abbreviations of its words allowed, as
+        a phrase). Empty if it names none, or more than max_matches.
+        """
+        matches = []
+        for department, number in COURSE_CODE_PATTERN.findall(query):
+            course = self.get(department, number)
+            if course is not None and course not in matches:
+                matches.append(course)
+        if not matches:
+            query_tokens = name_tokens(query)
+            candidates = set()
+            for token in set(query_tokens):
+                candidates |= self.by_token.get(token, set())
+                if len(token) >= MIN_PREFIX_LENGTH:
+                    for match in self.prefix_tokens(token):
+                        candidates |= self.by_token[match]
+            for index in sorted(candidates):
+                course = self.courses[index]
+                if self.contains_name(
+                    query_tokens, name_tokens(course.get("course_name") or "")
+                ):
+                    matches.append(course)
+        return matches if len(matches) <= max_matches else []
+
+    def contains_name(self, query_tokens: List[str], name: List[str]) -> bool:
+        """
+        Whether the tokens of the name appear in the query as a phrase, in
+        order and next to each other (stopwords aside)
+        """
+        return any(
+            all(
+                self.matches_token(name_token, query_token)
+                for name_token, query_token in zip(name, query_tokens[start:])
+            )
+            for start in range(len(query_tokens) - len(name) + 1)
+        )
+
+    def matches_token(self, name_token: str, query_token: str) -> bool:
+        return name_token == query_token or (
+            len(query_token) >= MIN_PREFIX_LENGTH and name_token.startswith(query_token)
+        )
+
+    def to_document(self, course: dict) -> Document:
+        code = " ".join(
+            str(part)
+            for part in [
+                course.get("college"),
+                course["department"],
+                course["course_number"],
+            ]
+            if part
+        )
+        lines = [f"{code}: {(course.get('course_name') or '').strip()}"]
+        if course.get("course_abstract"):
+            lines.append(" ".join(course["course_abstract"].split()))
+        for field, label in [
+            ("prereqs", "Prerequisites"),
+            ("coreqs", "Corequisites"),
+            ("credits", "Credits"),
+            ("semesters", "Semesters"),
+        ]:
+            value = course.get(field)
+            if value in (None, [], ""):
+                continue
+            if isinstance(value, list):
+                value = ", ".join(str(item) for item in value)
+            lines.append(f"{label}: {value}")
+        return Document(
+            page_content="\n".join(lines),
+            metadata={
+                "source": self.source,
+                "page": 0,
+                "course_id": course.get("course_id"),
+            },
+        )
+
+
+def get_catalog_path(config):
+    options = config["embedding_options"].get("catalog", {})
+    if not options.get("enabled", False):
+        return None
+    return options["path"]
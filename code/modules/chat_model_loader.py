@@ -9,30 +9,55 @@ import os
 from langchain.callbacks.manager import CallbackManager
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 
+try:
+    from modules.constants import tinyllama_prompt_prefix
+    from modules.generation_control import get_generation_options
+    from modules.local_inference import LocalInferenceService, LocalLLM
+except:
+    from constants import tinyllama_prompt_prefix
+    from generation_control import get_generation_options
+    from local_inference import LocalInferenceService, LocalLLM
+
 
 class ChatModelLoader:
     def __init__(self, config):
         self.config = config
         self.huggingface_token = os.getenv("HUGGINGFACEHUB_API_TOKEN")
 
-    def load_chat_model(self):
+    def load_local_service(self):
+        # The service owns the llama.cpp instances and queues the requests of
+        # all the sessions sharing this model (see model_registry.py)
+        # Both local prompt templates start with tinyllama_prompt_prefix
+        return LocalInferenceService(
+            self.config["llm_params"]["local_llm_params"],
+            prompt_prefix=tinyllama_prompt_prefix,
+        )
+
+    def load_chat_model(self, service=None):
+        # Output cap and stop sequences of the chat profile
+        generation = get_generation_options(self.config)
         if self.config["llm_params"]["llm_loader"] == "openai":
             llm = ChatOpenAI(
-                model_name=self.config["llm_params"]["openai_params"]["model"]
+                model_name=self.config["llm_params"]["openai_params"]["model"],
+                streaming=True,
+                max_tokens=generation["max_tokens"],
+                model_kwargs=(
+                    {"stop": generation["stop"]} if generation["stop"] else {}
+                ),
             )
         elif self.config["llm_params"]["llm_loader"] == "local_llm":
-            n_batch = 512  # Should be between 1 and n_ctx, consider the amount of VRAM in your GPU.
-            model_path = self.config["llm_params"]["local_llm_params"]["model"]
-            llm = LlamaCpp(
-                model_path=model_path,
-                n_batch=n_batch,
-                n_ctx=2048,
-                f16_kv=True,
-                verbose=True,
-                n_threads=2,
+            # A lightweight wrapper with the generation options of the profile,
+            # around the (shared) service
+            llm = LocalLLM(
+                service=service or self.load_local_service(),
                 temperature=self.config["llm_params"]["local_llm_params"][
                     "temperature"
                 ],
+                max_tokens=generation["max_tokens"],
+                stop=generation["stop"],
+                profile=generation["profile"],
+                repetition_ngram_size=generation["repetition_ngram_size"],
+                max_repeats=generation["max_repeats"],
             )
         else:
             raise ValueError("Invalid LLM Loader")
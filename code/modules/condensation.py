@@ -0,0 +1,467 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
+from langchain.schema.document import Document
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForChainRun,
+    CallbackManagerForChainRun,
+)
+from langchain_core.runnables.config import run_in_executor
+
+try:
+    from modules.lexical_index import reciprocal_rank_fusion, tokenize
+except:
+    from lexical_index import reciprocal_rank_fusion, tokenize
+
+CONDENSE_MODES = ["none", "embedding", "llm"]
+
+# Early retrievals of the synchronous chains
+_retrieval_executor = ThreadPoolExecutor(max_workers=4)
+
+
+class CondenseCache:
+    """
+    LRU cache of the standalone questions written by the LLM, keyed by the chat
+    history and the follow-up question
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, chat_history: str, question: str) -> str:
+        return hashlib.sha1(f"{chat_history}\x00{question}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            question = self.entries.get(key)
+            if question is not None:
+                self.entries.move_to_end(key)
+            return question
+
+    def put(self, key: str, question: str):
+        with self._lock:
+            self.entries[key] = question
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class CondenseStats:
+    """
+    Process-wide per-turn counters of each condensation mode, to compare their
+    latency and LLM calls
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.modes = {}
+
+    def record(self, mode: str, condense_time: float, turn_time: float, trace: dict):
+        with self._lock:
+            stats = self.modes.setdefault(
+                mode,
+                {
+                    "turns": 0,
+                    "llm_calls": 0,
+                    "cache_hits": 0,
+                    "condense_time": 0.0,
+                    "turn_time": 0.0,
+                    "parallel_reused": 0,
+                    "parallel_merged": 0,
+                    "retrieval_time_saved": 0.0,
+                },
+            )
+            stats["turns"] += 1
+            # The answer, and the rewrite when the LLM wrote it
+            stats["llm_calls"] += 1 + trace.get("condense_llm_calls", 0)
+            stats["cache_hits"] += int(trace.get("condense_cache") == "hit")
+            stats["condense_time"] += condense_time
+            stats["turn_time"] += turn_time
+            if "parallel_retrieval" in trace:
+                stats[f"parallel_{trace['parallel_retrieval']}"] += 1
+                stats["retrieval_time_saved"] += trace["retrieval_time_saved"]
+
+    def stats(self):
+        with self._lock:
+            return {
+                mode: {
+                    "turns": stats["turns"],
+                    "llm_calls_per_turn": round(stats["llm_calls"] / stats["turns"], 2),
+                    "cache_hits": stats["cache_hits"],
+                    "avg_condense_time": stats["condense_time"] / stats["turns"],
+                    "avg_turn_time": stats["turn_time"] / stats["turns"],
+                    "parallel_reused": stats["parallel_reused"],
+                    "parallel_merged": stats["parallel_merged"],
+                    "avg_retrieval_time_saved": stats["retrieval_time_saved"]
+                    / stats["turns"],
+                }
+                for mode, stats in self.modes.items()
+            }
+
+
+condense_stats = CondenseStats()
+
+
+def get_history_questions(chat_history, num_turns: int) -> List[str]:
+    """
+    The user messages of the last num_turns turns of the chat history (messages
+    or (human, ai) tuples)
+    """
+    questions = []
+    for turn in chat_history:
+        if isinstance(turn, tuple):
+            questions.append(turn[0])
+        elif getattr(turn, "type", None) == "human":
+            questions.append(turn.content)
+    return questions[-num_turns:] if num_turns > 0 else []
+
+
+class CondensingConversationalRetrievalChain(ConversationalRetrievalChain):
+    """
+    ConversationalRetrievalChain whose follow-up questions are condensed with
+    condense_mode:
+    - "none": the question is retrieved as it is
+    - "embedding": the question is retrieved with its embedding blended with
+      the embeddings of the user messages of the last history_turns turns
+      (history_weight of the blend), no LLM call
+    - "llm": the LLM rewrites the question into a standalone one (the default
+      of ConversationalRetrievalChain), the rewrites are cached
+    The answer is generated from the question and the chat history in all the
+    modes. The timings of the turn are returned under "trace".
+
+    With parallel_retrieval, the "llm" mode retrieves the question as asked
+    while the LLM rewrites it. If the rewrite barely changed it (reuse_similarity
+    of their terms), those results are used, otherwise the rewrite is retrieved
+    too and both results are fused.
+    """
+
+    condense_mode: str = "llm"
+    history_turns: int = 2
+    history_weight: float = 0.3
+    embedding_model: Any = None
+    condense_cache: Optional[CondenseCache] = None
+    turn_vectors: dict = {}  # question -> embedding, of the last turns
+    parallel_retrieval: bool = False
+    reuse_similarity: float = 0.8
+
+    @property
+    def output_keys(self) -> List[str]:
+        return super().output_keys + ["trace"]
+
+    def blend(self, question: str, history_questions: List[str]) -> List[float]:
+        vectors = {
+            text: self.turn_vectors.get(text) or self.embedding_model.embed_query(text)
+            for text in [question] + history_questions
+        }
+        self.turn_vectors = vectors
+        query = np.asarray(vectors[question], dtype=np.float32)
+        history = np.asarray([vectors[text] for text in history_questions], np.float32)
+        norm = max(float(np.linalg.norm(query)), 1e-12)
+        history = history / np.maximum(
+            np.linalg.norm(history, axis=1, keepdims=True), 1e-12
+        )
+        blended = (1 - self.history_weight) * query / norm + (
+            self.history_weight * history.mean(axis=0)
+        )
+        # Same norm as the query, for the stores that compare L2 distances
+        blended *= norm / max(float(np.linalg.norm(blended)), 1e-12)
+        return blended.tolist()
+
+    def get_cached_rewrite(self, chat_history_str, question, trace):
+        if self.condense_cache is None:
+            return None
+        new_question = self.condense_cache.get(
+            self.condense_cache.key(chat_history_str, question)
+        )
+        trace["condense_cache"] = "miss" if new_question is None else "hit"
+        return new_question
+
+    def put_rewrite(self, chat_history_str, question, new_question, trace):
+        trace["condense_llm_calls"] = 1
+        if self.condense_cache is not None:
+            self.condense_cache.put(
+                self.condense_cache.key(chat_history_str, question), new_question
+            )
+
+    def condense(self, inputs, chat_history_str, callbacks):
+        """
+        The question to retrieve and answer, the keyword arguments of the
+        retriever, and the trace of the condensation
+        """
+        question = inputs["question"]
+        trace = {"condense_mode": self.condense_mode}
+        if not chat_history_str or self.condense_mode == "none":
+            return question, {}, trace
+        if self.condense_mode == "embedding":
+            history_questions = get_history_questions(
+                inputs["chat_history"], self.history_turns
+            )
+            if not history_questions:
+                return question, {}, trace
+            return (
+                question,
+                {"query_vector": self.blend(question, history_questions)},
+                trace,
+            )
+        new_question = self.get_cached_rewrite(chat_history_str, question, trace)
+        if new_question is None:
+            new_question = self.question_generator.run(
+                question=question, chat_history=chat_history_str, callbacks=callbacks
+            )
+            self.put_rewrite(chat_history_str, question, new_question, trace)
+        return new_question, {}, trace
+
+    async def acondense(self, inputs, chat_history_str, callbacks):
+        question = inputs["question"]
+        if self.condense_mode != "llm" or not chat_history_str:
+            # No LLM call, the embeddings are computed off the event loop
+            return await run_in_executor(
+                None, self.condense, inputs, chat_history_str, callbacks
+            )
+        trace = {"condense_mode": self.condense_mode}
+        new_question = self.get_cached_rewrite(chat_history_str, question, trace)
+        if new_question is None:
+            new_question = await self.question_generator.arun(
+                question=question, chat_history=chat_history_str, callbacks=callbacks
+            )
+            self.put_rewrite(chat_history_str, question, new_question, trace)
+        return new_question, {}, trace
+
+    def use_parallel_retrieval(self, inputs, chat_history_str) -> bool:
+        if not self.parallel_retrieval or self.condense_mode != "llm":
+            return False
+        if not chat_history_str:
+            return False
+        # A cached rewrite is instant, there is nothing to overlap
+        return self.condense_cache is None or (
+            self.condense_cache.get(
+                self.condense_cache.key(chat_history_str, inputs["question"])
+            )
+            is None
+        )
+
+    def is_same_question(self, question: str, new_question: str) -> bool:
+        terms, new_terms = set(tokenize(question)), set(tokenize(new_question))
+        if not terms | new_terms:
+            return True
+        return len(terms & new_terms) / len(terms | new_terms) >= self.reuse_similarity
+
+    def merge_docs(self, docs, early_docs) -> List[Document]:
+        """
+        The results of the rewrite fused with the early results of the question,
+        deduplicated, the rewrite winning ties
+        """
+        k = max(len(docs), len(early_docs))
+        return [doc for doc, _ in reciprocal_rank_fusion([docs, early_docs], k)]
+
+    def timed_get_docs(self, question, inputs, run_manager, **retriever_kwargs):
+        start = time.perf_counter()
+        docs = self._get_docs(
+            question, inputs, run_manager=run_manager, **retriever_kwargs
+        )
+        return docs, time.perf_counter() - start
+
+    async def atimed_get_docs(self, question, inputs, run_manager, **retriever_kwargs):
+        start = time.perf_counter()
+        docs = await self._aget_docs(
+            question, inputs, run_manager=run_manager, **retriever_kwargs
+        )
+        return docs, time.perf_counter() - start
+
+    def trace_parallel(self, trace, reused, early_time, retrieval_time, elapsed):
+        """
+        Time saved over condensing then retrieving: the condensation and the
+        retrieval whose results are used, in sequence, against the time taken
+        """
+        trace["parallel_retrieval"] = "reused" if reused else "merged"
+        trace["early_retrieval_time"] = early_time
+        trace["retrieval_time_saved"] = (
+            trace["condense_time"] + retrieval_time - elapsed
+        )
+
+    def retrieve(self, inputs, chat_history_str, run_manager):
+        """
+        The condensed question, its documents, and the trace
+        """
+        start = time.perf_counter()
+        if not self.use_parallel_retrieval(inputs, chat_history_str):
+            new_question, retriever_kwargs, trace = self.condense(
+                inputs, chat_history_str, run_manager.get_child()
+            )
+            trace["condense_time"] = time.perf_counter() - start
+            docs = self._get_docs(
+                new_question, inputs, run_manager=run_manager, **retriever_kwargs
+            )
+            return new_question, docs, trace
+
+        early = _retrieval_executor.submit(
+            self.timed_get_docs, inputs["question"], inputs, run_manager
+        )
+        new_question, _, trace = self.condense(
+            inputs, chat_history_str, run_manager.get_child()
+        )
+        trace["condense_time"] = time.perf_counter() - start
+        early_docs, early_time = early.result()
+        if self.is_same_question(inputs["question"], new_question):
+            docs, retrieval_time = early_docs, early_time
+        else:
+            docs, retrieval_time = self.timed_get_docs(
+                new_question, inputs, run_manager
+            )
+            docs = self.merge_docs(docs, early_docs)
+        self.trace_parallel(
+            trace,
+            docs is early_docs,
+            early_time,
+            retrieval_time,
+            time.perf_counter() - start,
+        )
+        return new_question, docs, trace
+
+    async def aretrieve(self, inputs, chat_history_str, run_manager):
+        start = time.perf_counter()
+        if not self.use_parallel_retrieval(inputs, chat_history_str):
+            new_question, retriever_kwargs, trace = await self.acondense(
+                inputs, chat_history_str, run_manager.get_child()
+            )
+            trace["condense_time"] = time.perf_counter() - start
+            docs = await self._aget_docs(
+                new_question, inputs, run_manager=run_manager, **retriever_kwargs
+            )
+            return new_question, docs, trace
+
+        early = asyncio.ensure_future(
+            self.atimed_get_docs(inputs["question"], inputs, run_manager)
+        )
+        try:
+            new_question, _, trace = await self.acondense(
+                inputs, chat_history_str, run_manager.get_child()
+            )
+        except BaseException:
+            early.cancel()
+            raise
+        trace["condense_time"] = time.perf_counter() - start
+        if self.is_same_question(inputs["question"], new_question):
+            docs, retrieval_time = await early
+            early_docs, early_time = docs, retrieval_time
+        else:
+            # The early retrieval may still be running, wait for both
+            (early_docs, early_time), (docs, retrieval_time) = await asyncio.gather(
+                early, self.atimed_get_docs(new_question, inputs, run_manager)
+            )
+            docs = self.merge_docs(docs, early_docs)
+        self.trace_parallel(
+            trace,
+            docs is early_docs,
+            early_time,
+            retrieval_time,
+            time.perf_counter() - start,
+        )
+        return new_question, docs, trace
+
+    def _get_docs(
+        self,
+        question: str,
+        inputs: Dict[str, Any],
+        *,
+        run_manager: CallbackManagerForChainRun,
+        **retriever_kwargs: Any,
+    ) -> List[Document]:
+        docs = self.retriever.invoke(
+            question, config={"callbacks": run_manager.get_child()}, **retriever_kwargs
+        )
+        return self._reduce_tokens_below_limit(docs)
+
+    async def _aget_docs(
+        self,
+        question: str,
+        inputs: Dict[str, Any],
+        *,
+        run_manager: AsyncCallbackManagerForChainRun,
+        **retriever_kwargs: Any,
+    ) -> List[Document]:
+        docs = await self.retriever.ainvoke(
+            question, config={"callbacks": run_manager.get_child()}, **retriever_kwargs
+        )
+        return self._reduce_tokens_below_limit(docs)
+
+    def get_answer_inputs(self, inputs, new_question, chat_history_str) -> dict:
+        new_inputs = inputs.copy()
+        if self.rephrase_question:
+            new_inputs["question"] = new_question
+        new_inputs["chat_history"] = chat_history_str
+        return new_inputs
+
+    def get_output(self, docs, answer, new_question, trace) -> dict:
+        output = {self.output_key: answer, "trace": trace}
+        if self.return_source_documents:
+            output["source_documents"] = docs
+        if self.return_generated_question:
+            output["generated_question"] = new_question
+        return output
+
+    def _call(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        start = time.perf_counter()
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs["chat_history"])
+        new_question, docs, trace = self.retrieve(
+            inputs, chat_history_str, _run_manager
+        )
+        if self.response_if_no_docs_found is not None and len(docs) == 0:
+            answer = self.response_if_no_docs_found
+        else:
+            answer = self.combine_docs_chain.run(
+                input_documents=docs,
+                callbacks=_run_manager.get_child(),
+                **self.get_answer_inputs(inputs, new_question, chat_history_str),
+            )
+        condense_stats.record(
+            self.condense_mode,
+            trace["condense_time"],
+            time.perf_counter() - start,
+            trace,
+        )
+        return self.get_output(docs, answer, new_question, trace)
+
+    async def _acall(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
+        start = time.perf_counter()
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs["chat_history"])
+        new_question, docs, trace = await self.aretrieve(
+            inputs, chat_history_str, _run_manager
+        )
+        if self.response_if_no_docs_found is not None and len(docs) == 0:
+            answer = self.response_if_no_docs_found
+        else:
+            answer = await self.combine_docs_chain.arun(
+                input_documents=docs,
+                callbacks=_run_manager.get_child(),
+                **self.get_answer_inputs(inputs, new_question, chat_history_str),
+            )
+        condense_stats.record(
+            self.condense_mode,
+            trace["condense_time"],
+            time.perf_counter() - start,
+            trace,
+        )
+        return self.get_output(docs, answer, new_question, trace)
@@ -34,12 +34,12 @@ Only return the helpful answer below and nothing else.
 Helpful answer:
 """
 
-tinyllama_prompt_template = """
+# The system block and the example exchange are the same for every request, the
+# local model evaluates them once and restores them (see local_inference.py).
+# Only the context, history and question that follow are evaluated per request.
+tinyllama_prompt_prefix = """
 <|im_start|>system
-Assistant is an intelligent chatbot designed to help students with questions regarding the course. Only answer questions using the context below and if you're not sure of an answer, you can say "I don't know". Always give a breif and concise answer to the question. Use the history to answer the question if you can.
-
-Context:
-{context}
+Assistant is an intelligent chatbot designed to help students with questions regarding the course. Only answer questions using the context given with the question and if you're not sure of an answer, you can say "I don't know". Always give a breif and concise answer to the question. Use the history to answer the question if you can.
 <|im_end|>
 <|im_start|>user
 Question: Who is the instructor for this course?
@@ -48,27 +48,21 @@ Question: Who is the instructor for this course?
 The instructor for this course is Prof. Thomas Gardos.
 <|im_end|>
 <|im_start|>user
+"""
+
+tinyllama_prompt_template = tinyllama_prompt_prefix + """Context:
+{context}
+
 Question: {question}
 <|im_end|>
 <|im_start|>assistant
 """
 
-tinyllama_prompt_template_with_history = """
-<|im_start|>system
-Assistant is an intelligent chatbot designed to help students with questions regarding the course. Only answer questions using the context below and if you're not sure of an answer, you can say "I don't know". Always give a breif and concise answer to the question.
-
-Chat History:
+tinyllama_prompt_template_with_history = tinyllama_prompt_prefix + """Chat History:
 {chat_history}
 Context:
 {context}
-<|im_end|>
-<|im_start|>user
-Question: Who is the instructor for this course?
-<|im_end|>
-<|im_start|>assistant
-The instructor for this course is Prof. Thomas Gardos.
-<|im_end|>
-<|im_start|>user
+
 Question: {question}
 <|im_end|>
 <|im_start|>assistant
@@ -0,0 +1,216 @@
+import logging
+import re
+import time
+from typing import Any, Callable, List
+
+from langchain.chains.combine_documents.stuff import StuffDocumentsChain
+from langchain.schema.document import Document
+
+try:
+    from modules.lexical_index import tokenize
+except:
+    from lexical_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+class ContextPacker:
+    """
+    Fits the prompt of the "stuff" chain in the context window of the model,
+    counting tokens with the model's own tokenizer. The window, less the answer
+    (max_answer_tokens) and the template, is shared between the question, the
+    chat history (its most recent lines, up to max_history_tokens) and the
+    retrieved chunks. Chunks longer than max_chunk_tokens are cut to the
+    sentences around the one that best matches the question, and if they still
+    do not fit, the lowest scored chunks are dropped first.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        context_window: int = 2048,
+        max_answer_tokens: int = 256,
+        max_history_tokens: int = 256,
+        max_chunk_tokens: int = 200,
+        min_chunk_tokens: int = 32,
+    ):
+        self.count_tokens = count_tokens
+        self.context_window = context_window
+        self.max_answer_tokens = max_answer_tokens
+        self.max_history_tokens = max_history_tokens
+        self.max_chunk_tokens = max_chunk_tokens
+        self.min_chunk_tokens = min_chunk_tokens
+        self.template_tokens = {}  # template -> tokens of its static text
+        self.last_stats = {}
+
+    def get_template_tokens(self, prompt) -> int:
+        if prompt.template not in self.template_tokens:
+            self.template_tokens[prompt.template] = self.count_tokens(
+                prompt.format(**{name: "" for name in prompt.input_variables})
+            )
+        return self.template_tokens[prompt.template]
+
+    def truncate(self, text: str, max_tokens: int, num_tokens: int = None) -> str:
+        num_tokens = num_tokens or self.count_tokens(text)
+        while num_tokens > max_tokens and text:
+            text = text[: int(len(text) * max_tokens / num_tokens * 0.95)]
+            num_tokens = self.count_tokens(text)
+        return text
+
+    def window(self, text: str, query_terms: set, max_tokens: int) -> str:
+        """
+        The sentences of text around the one with the most query terms, as many
+        as fit in max_tokens
+        """
+        sentences = [s for s in SENTENCE_PATTERN.split(text) if s.strip()]
+        if not sentences:
+            return text
+        overlaps = [len(query_terms & set(tokenize(s))) for s in sentences]
+        best = overlaps.index(max(overlaps))
+        lengths = [self.count_tokens(s) for s in sentences]
+        if lengths[best] >= max_tokens:
+            return self.truncate(sentences[best], max_tokens, lengths[best])
+        start, end, total = best, best + 1, lengths[best]
+        while True:
+            grown = False
+            if end < len(sentences) and total + lengths[end] <= max_tokens:
+                total += lengths[end]
+                end += 1
+                grown = True
+            if start > 0 and total + lengths[start - 1] <= max_tokens:
+                start -= 1
+                total += lengths[start]
+                grown = True
+            if not grown:
+                return " ".join(sentences[start:end])
+
+    def pack_history(self, chat_history: str, max_tokens: int) -> str:
+        """
+        The most recent lines of the chat history that fit in max_tokens
+        """
+        lines, total = [], 0
+        for line in reversed(chat_history.split("\n")):
+            num_tokens = self.count_tokens(line) + 1
+            if total + num_tokens > max_tokens:
+                break
+            lines.append(line)
+            total += num_tokens
+        return "\n".join(reversed(lines))
+
+    def pack(self, docs: List[Document], inputs: dict, prompt):
+        """
+        The documents and the prompt inputs (question and chat history) that fit
+        in the context window
+        """
+        start = time.perf_counter()
+        question = inputs.get("question", "")
+        chat_history = inputs.get("chat_history")
+        template_tokens = self.get_template_tokens(prompt)
+        question_tokens = self.count_tokens(question)
+        available = (
+            self.context_window
+            - self.max_answer_tokens
+            - template_tokens
+            - question_tokens
+        )
+
+        history_tokens_before = history_tokens = 0
+        if isinstance(chat_history, str) and chat_history:
+            history_tokens_before = self.count_tokens(chat_history)
+            if history_tokens_before > min(self.max_history_tokens, available):
+                chat_history = self.pack_history(
+                    chat_history, min(self.max_history_tokens, available)
+                )
+                inputs = {**inputs, "chat_history": chat_history}
+            history_tokens = self.count_tokens(chat_history) if chat_history else 0
+        budget = available - history_tokens
+
+        query_terms = set(tokenize(question))
+        doc_tokens_before = [self.count_tokens(doc.page_content) for doc in docs]
+        packed, num_windowed = [], 0
+        for doc, num_tokens in zip(docs, doc_tokens_before):
+            content = doc.page_content
+            if num_tokens > self.max_chunk_tokens:
+                content = self.window(content, query_terms, self.max_chunk_tokens)
+                num_tokens = self.count_tokens(content)
+                num_windowed += 1
+            packed.append(
+                [
+                    doc.metadata.get("score"),
+                    Document(page_content=content, metadata=doc.metadata),
+                    num_tokens + 2,  # and the separator
+                ]
+            )
+
+        # Drop the lowest scored chunks (the last retrieved among equal scores)
+        # until the rest fit. Without a score for every chunk (hybrid retrieval
+        # found some of them only lexically), the last retrieved are dropped.
+        if any(item[0] is None for item in packed):
+            by_score = list(reversed(range(len(packed))))
+        else:
+            by_score = sorted(range(len(packed)), key=lambda i: (packed[i][0], -i))
+        kept = set(range(len(packed)))
+        total = sum(item[2] for item in packed)
+        for i in by_score:
+            if total <= budget or len(kept) == 1:
+                break
+            kept.discard(i)
+            total -= packed[i][2]
+        if len(kept) == 1 and total > budget:
+            # The best chunk alone is too long, keep the part that fits
+            (i,) = kept
+            if budget >= self.min_chunk_tokens:
+                content = self.window(
+                    packed[i][1].page_content, query_terms, budget - 2
+                )
+                packed[i][1] = Document(page_content=content, metadata=docs[i].metadata)
+                packed[i][2] = self.count_tokens(content) + 2
+                total = packed[i][2]
+            else:
+                kept, total = set(), 0
+        packed_docs = [packed[i][1] for i in sorted(kept)]
+
+        fixed_tokens = template_tokens + question_tokens
+        self.last_stats = {
+            "prompt_tokens_before": fixed_tokens
+            + history_tokens_before
+            + sum(num_tokens + 2 for num_tokens in doc_tokens_before),
+            "prompt_tokens_after": fixed_tokens + history_tokens + total,
+            "chunks_before": len(docs),
+            "chunks_after": len(packed_docs),
+            "chunks_windowed": num_windowed,
+            "history_tokens_before": history_tokens_before,
+            "history_tokens_after": history_tokens,
+            "packing_time": time.perf_counter() - start,
+        }
+        logger.info(
+            f"Context packing: {self.last_stats['prompt_tokens_before']} -> "
+            f"{self.last_stats['prompt_tokens_after']} prompt tokens, "
+            f"{len(docs)} -> {len(packed_docs)} chunks ({num_windowed} windowed)"
+        )
+        return packed_docs, inputs
+
+
+class PackedStuffDocumentsChain(StuffDocumentsChain):
+    """
+    StuffDocumentsChain whose documents and chat history are packed in the
+    context window of the model before they are stuffed in the prompt
+    """
+
+    packer: Any
+
+    def _get_inputs(self, docs: List[Document], **kwargs: Any) -> dict:
+        docs, kwargs = self.packer.pack(docs, kwargs, self.llm_chain.prompt)
+        return super()._get_inputs(docs, **kwargs)
+
+
+def pack_chain(chain: StuffDocumentsChain, packer: ContextPacker):
+    return PackedStuffDocumentsChain(
+        llm_chain=chain.llm_chain,
+        document_prompt=chain.document_prompt,
+        document_variable_name=chain.document_variable_name,
+        document_separator=chain.document_separator,
+        packer=packer,
+    )
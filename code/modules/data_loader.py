@@ -1,28 +1,41 @@
+import json
+import multiprocessing
 import os
 import re
+import tempfile
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import requests
 import pysrt
 from langchain_community.document_loaders import (
     PyMuPDFLoader,
     Docx2txtLoader,
     YoutubeLoader,
-    WebBaseLoader,
     TextLoader,
 )
 from langchain_community.document_loaders import UnstructuredMarkdownLoader
 from llama_parse import LlamaParse
 from langchain.schema import Document
 import logging
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from ragatouille import RAGPretrainedModel
 from langchain.chains import LLMChain
 from langchain.llms import OpenAI
 from langchain import PromptTemplate
+from bs4 import BeautifulSoup
 
 try:
     from modules.helpers import get_metadata
+    from modules.http_cache import HTTPCache, get_http_cache
+    from modules.ingestion_manifest import hash_config, hash_file, hash_text
+    from modules.ingestion_store import get_ingestion_store
+    from modules.text_splitter import DelimiterRemover, TokenOffsetSplitter
 except:
     from helpers import get_metadata
+    from http_cache import HTTPCache, get_http_cache
+    from ingestion_manifest import hash_config, hash_file, hash_text
+    from ingestion_store import get_ingestion_store
+    from text_splitter import DelimiterRemover, TokenOffsetSplitter
 
 logger = logging.getLogger(__name__)
 
@@ -40,8 +53,9 @@ class PDFReader:
 
 
 class FileReader:
-    def __init__(self):
+    def __init__(self, http_cache: HTTPCache = None):
         self.pdf_reader = PDFReader()
+        self.http_cache = http_cache if http_cache is not None else HTTPCache()
 
     def extract_text_from_pdf(self, pdf_path):
         text = ""
@@ -54,8 +68,8 @@ class FileReader:
         return text
 
     def download_pdf_from_url(self, pdf_url):
-        response = requests.get(pdf_url)
-        if response.status_code == 200:
+        response = self.http_cache.fetch(pdf_url)
+        if response.ok:
             with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
                 temp_file.write(response.content)
                 temp_file_path = temp_file.name
@@ -65,6 +79,18 @@ class FileReader:
             return None
 
     def read_pdf(self, temp_file_path: str):
+        if temp_file_path.startswith(("http://", "https://")):
+            pdf_url = temp_file_path
+            temp_file_path = self.download_pdf_from_url(pdf_url)
+            if temp_file_path is None:
+                return []
+            try:
+                documents = self.read_pdf(temp_file_path)
+            finally:
+                os.remove(temp_file_path)
+            for doc in documents:
+                doc.metadata["source"] = pdf_url
+            return documents
         loader = self.pdf_reader.get_loader(temp_file_path)
         documents = self.pdf_reader.get_documents(loader)
         return documents
@@ -91,12 +117,33 @@ class FileReader:
         return loader.load()
 
     def read_html(self, url: str):
-        loader = WebBaseLoader(url)
-        return loader.load()
+        # Same content and metadata as WebBaseLoader, through the http cache
+        response = self.http_cache.fetch(url)
+        soup = BeautifulSoup(response.content, "html.parser")
+        metadata = {"source": url}
+        if title := soup.find("title"):
+            metadata["title"] = title.get_text()
+        if description := soup.find("meta", attrs={"name": "description"}):
+            metadata["description"] = description.get(
+                "content", "No description found."
+            )
+        if html := soup.find("html"):
+            metadata["language"] = html.get("lang", "No language found.")
+        return [Document(page_content=soup.get_text(), metadata=metadata)]
+
+    def get_source_hash(self, source: str):
+        """
+        Content hash of a local file or a remote resource, None if unknown
+        """
+        if source.startswith(("http://", "https://")):
+            if "youtube" in source:
+                return None
+            return self.http_cache.content_hash(source)
+        return hash_file(source)
 
     def read_tex_from_url(self, tex_url):
-        response = requests.get(tex_url)
-        if response.status_code == 200:
+        response = self.http_cache.fetch(tex_url)
+        if response.ok:
             return [Document(page_content=response.text)]
         else:
             print("Failed to fetch .tex file from URL:", tex_url)
@@ -108,127 +155,305 @@ class ChunkProcessor:
         self.config = config
 
         if config["splitter_options"]["use_splitter"]:
-            if config["splitter_options"]["split_by_token"]:
-                self.splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-                    chunk_size=config["splitter_options"]["chunk_size"],
-                    chunk_overlap=config["splitter_options"]["chunk_overlap"],
-                    separators=config["splitter_options"]["chunk_separators"],
-                    disallowed_special=(),
-                )
-            else:
-                self.splitter = RecursiveCharacterTextSplitter(
-                    chunk_size=config["splitter_options"]["chunk_size"],
-                    chunk_overlap=config["splitter_options"]["chunk_overlap"],
-                    separators=config["splitter_options"]["chunk_separators"],
-                    disallowed_special=(),
-                )
+            self.splitter = TokenOffsetSplitter(
+                chunk_size=config["splitter_options"]["chunk_size"],
+                chunk_overlap=config["splitter_options"]["chunk_overlap"],
+                separators=config["splitter_options"]["chunk_separators"],
+                encoding_name=(
+                    "gpt2" if config["splitter_options"]["split_by_token"] else None
+                ),
+            )
         else:
             self.splitter = None
+        self.delimiter_remover = DelimiterRemover(
+            config["splitter_options"]["delimiters_to_remove"] or []
+        )
+        self.num_workers = (
+            config["embedding_options"].get("parsing", {}).get("num_workers", 1)
+        )
+        self.store = get_ingestion_store(config)
+        self.splitter_hash = hash_config(config["splitter_options"])
+        self.stage_stats = Counter()
         logger.info("ChunkProcessor instance created")
 
     def remove_delimiters(self, document_chunks: list):
         for chunk in document_chunks:
-            for delimiter in self.config["splitter_options"]["delimiters_to_remove"]:
-                chunk.page_content = re.sub(delimiter, " ", chunk.page_content)
+            chunk.page_content = self.delimiter_remover(chunk.page_content)
         return document_chunks
 
     def remove_chunks(self, document_chunks: list):
-        front = self.config["splitter_options"]["front_chunk_to_remove"]
-        end = self.config["splitter_options"]["last_chunks_to_remove"]
-        for _ in range(front):
-            del document_chunks[0]
-        for _ in range(end):
-            document_chunks.pop()
+        front = self.config["splitter_options"]["front_chunks_to_remove"] or 0
+        end = self.config["splitter_options"]["last_chunks_to_remove"] or 0
+        document_chunks = document_chunks[front : len(document_chunks) - end]
         logger.info(f"\tNumber of pages after skipping: {len(document_chunks)}")
         return document_chunks
 
     def process_chunks(
         self, documents, file_type="txt", source="", page=0, metadata={}
     ):
-        documents = [Document(page_content=documents, source=source, page=page)]
-        if (
-            file_type == "txt"
-            or file_type == "docx"
-            or file_type == "srt"
-            or file_type == "tex"
-        ):
-            document_chunks = self.splitter.split_documents(documents)
-        elif file_type == "pdf":
-            document_chunks = documents  # Full page for now
-
-        # add the source and page number back to the metadata
-        for chunk in document_chunks:
-            chunk.metadata["source"] = source
-            chunk.metadata["page"] = page
-
-            # add the metadata extracted from the document
-            for key, value in metadata.items():
-                chunk.metadata[key] = value
+        return self.process_pages([(documents, file_type, source, page, metadata)])[0]
+
+    def process_pages(self, pages: list):
+        """
+        Splits a batch of pages, given as (text, file_type, source, page, metadata).
+        The pages are tokenized together, PDF pages are split like any other text.
+        """
+        texts = [text for text, _, _, _, _ in pages]
+        if self.splitter is not None:
+            split_texts = self.splitter.split_texts(texts)
+        else:
+            split_texts = [[text] for text in texts]
+
+        results = []
+        for (_, _, source, page, metadata), chunk_texts in zip(pages, split_texts):
+            # add the source and page number, and the metadata extracted from
+            # the document
+            document_chunks = [
+                Document(
+                    page_content=chunk_text,
+                    metadata={"source": source, "page": page, **metadata},
+                )
+                for chunk_text in chunk_texts
+            ]
+            if self.config["splitter_options"]["remove_leftover_delimiters"]:
+                document_chunks = self.remove_delimiters(document_chunks)
+            if self.config["splitter_options"]["remove_chunks"]:
+                document_chunks = self.remove_chunks(document_chunks)
+            results.append(document_chunks)
+        return results
+
+    def load_pages(self, source: str, source_hash, read_pages):
+        """
+        Pages of a source, from the ingestion store if this version of the source
+        was parsed before, otherwise from read_pages()
+        """
+        if self.store is not None and source_hash is not None:
+            pages = self.store.get_pages(source, source_hash)
+            if pages is not None:
+                self.stage_stats["pages_cached"] += 1
+                return pages
+        pages = read_pages()
+        self.stage_stats["pages_parsed"] += 1
+        if self.store is not None and source_hash is not None:
+            self.store.put_pages(source, source_hash, pages)
+        return pages
+
+    def split_pages(self, pages: list):
+        """
+        Chunks of a batch of pages (see process_pages), from the ingestion store
+        for the pages that were split with the same splitter options before
+        """
+        if self.store is None:
+            return [chunk for chunks in self.process_pages(pages) for chunk in chunks]
+        page_hashes = [
+            hash_text(
+                json.dumps([file_type, source, page, metadata, text], sort_keys=True)
+            )
+            for text, file_type, source, page, metadata in pages
+        ]
+        results = [
+            self.store.get_chunks(page_hash, self.splitter_hash)
+            for page_hash in page_hashes
+        ]
+        missing = [i for i, chunks in enumerate(results) if chunks is None]
+        self.stage_stats["chunks_cached"] += len(pages) - len(missing)
+        self.stage_stats["chunks_split"] += len(missing)
+        if missing:
+            split_pages = self.process_pages([pages[i] for i in missing])
+            for i, chunks in zip(missing, split_pages):
+                self.store.put_chunks(page_hashes[i], self.splitter_hash, chunks)
+                results[i] = chunks
+        return [chunk for chunks in results for chunk in chunks]
+
+    def read_file(self, file_reader, file_path: str, metadata: dict):
+        file_name = os.path.basename(file_path)
+        file_type = file_name.split(".")[-1].lower()
+
+        if file_type == "pdf":
+            documents = file_reader.read_pdf(file_path)
+        elif file_type == "txt":
+            documents = file_reader.read_txt(file_path)
+        elif file_type == "docx":
+            documents = file_reader.read_docx(file_path)
+        elif file_type == "srt":
+            documents = file_reader.read_srt(file_path)
+        elif file_type == "tex":
+            documents = file_reader.read_tex_from_url(file_path)
+
+        pages = []
+        for doc in documents:
+            page_num = doc.metadata.get("page", 0)
+            page_metadata = {"source": file_path, "page": page_num}
+            page_metadata.update(metadata)
+            pages.append((doc.page_content, page_metadata, f"{file_name}_{page_num}"))
+        return pages
+
+    def parse_file(self, file_reader, file_path: str, metadata: dict):
+        """
+        Reads a file, returns its pages as (text, metadata, name) and its chunks
+        """
+        file_type = os.path.basename(file_path).split(".")[-1].lower()
+        if file_type not in ["pdf", "txt", "docx", "srt", "tex"]:
+            logger.warning(f"Unsupported file type: {file_type}")
+            return [], []
+
+        # The additional metadata is stored in the pages, so it is part of the
+        # key of the cached pages
+        source_hash = file_reader.get_source_hash(file_path)
+        if source_hash is not None:
+            source_hash = hash_config({"source": source_hash, "metadata": metadata})
+        pages = self.load_pages(
+            file_path,
+            source_hash,
+            lambda: self.read_file(file_reader, file_path, metadata),
+        )
+        chunks = []
+        if self.config["embedding_options"]["db_option"] not in ["RAGatouille"]:
+            chunks = self.split_pages(
+                [
+                    (text, file_type, file_path, page_metadata["page"], metadata)
+                    for text, page_metadata, _ in pages
+                ]
+            )
+        return pages, chunks
+
+    def read_weblink(self, file_reader, link: str):
+        if "youtube" in link:
+            documents = file_reader.read_youtube_transcript(link)
+        else:
+            documents = file_reader.read_html(link)
+        return [
+            (
+                doc.page_content,
+                {"source": link, "page": doc.metadata.get("page", 0)},
+                link,
+            )
+            for doc in documents
+        ]
+
+    def parse_weblink(self, file_reader, link: str, link_index: int):
+        try:
+            logger.info(f"\tSplitting link {link_index+1} : {link}")
+            pages = self.load_pages(
+                link,
+                file_reader.get_source_hash(link),
+                lambda: self.read_weblink(file_reader, link),
+            )
+            chunks = []
+            if self.config["embedding_options"]["db_option"] not in ["RAGatouille"]:
+                chunks = self.split_pages(
+                    [
+                        (text, "txt", link, 0, {"source_type": "webpage"})
+                        for text, _, _ in pages
+                    ]
+                )
+            return pages, chunks
+        except Exception as e:
+            logger.error(f"Error splitting link {link_index+1} : {link}: {str(e)}")
+            return None
 
-        if self.config["splitter_options"]["remove_leftover_delimiters"]:
-            document_chunks = self.remove_delimiters(document_chunks)
-        if self.config["splitter_options"]["remove_chunks"]:
-            document_chunks = self.remove_chunks(document_chunks)
+    def iter_sources(self, file_reader, uploaded_files, weblinks):
+        """
+        Yields (source, pages, chunks) for every file and weblink, in order.
+        With num_workers > 1, files are parsed in a pool of worker processes and
+        weblinks in as many threads. Only a few sources are in flight at a time,
+        so memory doesn't grow with the size of the corpus.
+        """
+        addl_metadata = get_metadata(uploaded_files)  # For any additional metadata
 
-        return document_chunks
+        seen_sources = set()
+        tasks = []
+        for file_path in uploaded_files:
+            file_name = os.path.basename(file_path)
+            if file_name not in seen_sources:
+                seen_sources.add(file_name)
+                tasks.append((file_path, False))
+        if weblinks and weblinks[0] != "":
+            logger.info(f"Splitting weblinks: total of {len(weblinks)}")
+            for link in weblinks:
+                if link not in seen_sources:
+                    seen_sources.add(link)
+                    tasks.append((link, True))
+
+        pools = {}
+
+        def submit(source, is_weblink, index):
+            if self.num_workers <= 1:
+                if is_weblink:
+                    return self.parse_weblink(file_reader, source, index)
+                return self.parse_file(
+                    file_reader, source, addl_metadata.get(source, {})
+                )
+            if is_weblink:
+                if "threads" not in pools:
+                    pools["threads"] = ThreadPoolExecutor(max_workers=self.num_workers)
+                return pools["threads"].submit(
+                    self.parse_weblink, file_reader, source, index
+                )
+            if "processes" not in pools:
+                pools["processes"] = ProcessPoolExecutor(
+                    max_workers=self.num_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_parser_worker,
+                    initargs=(self.config,),
+                )
+            return pools["processes"].submit(
+                _parse_file, source, addl_metadata.get(source, {})
+            )
+
+        max_pending = 2 * self.num_workers if self.num_workers > 1 else 1
+        pending = deque()
+        counts = {"sources": 0, "chunks": 0}
+        start = time.perf_counter()
+
+        def collect():
+            source, result = pending.popleft()
+            if isinstance(result, Future):
+                result = result.result()
+            if result is None:  # a weblink that couldn't be read
+                return
+            if len(result) == 3:  # parsed in a worker process
+                result, stage_stats = result[:2], result[2]
+                self.stage_stats.update(stage_stats)
+            counts["sources"] += 1
+            counts["chunks"] += len(result[1])
+            yield (source, *result)
+
+        link_index = 0
+        try:
+            for source, is_weblink in tasks:
+                pending.append((source, submit(source, is_weblink, link_index)))
+                link_index += is_weblink
+                while len(pending) >= max_pending:
+                    yield from collect()
+            while pending:
+                yield from collect()
+        finally:
+            for pool in pools.values():
+                pool.shutdown(cancel_futures=True)
+
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Parsed {counts['sources']} sources into {counts['chunks']} chunks "
+            f"in {elapsed:.1f}s ({counts['sources'] / max(elapsed, 1e-9):.1f} sources/sec)"
+        )
+        if self.store is not None:
+            logger.info(f"Ingestion store: {dict(self.stage_stats)}")
 
     def get_chunks(self, file_reader, uploaded_files, weblinks):
         self.document_chunks_full = []
-        self.parent_document_names = []
         self.child_document_names = []
         self.documents = []
         self.document_metadata = []
 
-        addl_metadata = get_metadata(uploaded_files)  # For any additional metadata
-
-        for file_index, file_path in enumerate(uploaded_files):
-            file_name = os.path.basename(file_path)
-            if file_name not in self.parent_document_names:
-                file_type = file_name.split(".")[-1].lower()
-
-                # try:
-                if file_type == "pdf":
-                    documents = file_reader.read_pdf(file_path)
-                elif file_type == "txt":
-                    documents = file_reader.read_txt(file_path)
-                elif file_type == "docx":
-                    documents = file_reader.read_docx(file_path)
-                elif file_type == "srt":
-                    documents = file_reader.read_srt(file_path)
-                elif file_type == "tex":
-                    documents = file_reader.read_tex_from_url(file_path)
-                else:
-                    logger.warning(f"Unsupported file type: {file_type}")
-                    continue
-
-                for doc in documents:
-                    page_num = doc.metadata.get("page", 0)
-                    self.documents.append(doc.page_content)
-                    self.document_metadata.append(
-                        {"source": file_path, "page": page_num}
-                    )
-                    metadata = addl_metadata.get(file_path, {})
-                    self.document_metadata[-1].update(metadata)
-
-                    self.child_document_names.append(f"{file_name}_{page_num}")
-
-                    self.parent_document_names.append(file_name)
-                    if self.config["embedding_options"]["db_option"] not in [
-                        "RAGatouille"
-                    ]:
-                        document_chunks = self.process_chunks(
-                            self.documents[-1],
-                            file_type,
-                            source=file_path,
-                            page=page_num,
-                            metadata=metadata,
-                        )
-                        self.document_chunks_full.extend(document_chunks)
-
-            # except Exception as e:
-            #     logger.error(f"Error processing file {file_name}: {str(e)}")
-
-        self.process_weblinks(file_reader, weblinks)
+        for _, pages, chunks in self.iter_sources(
+            file_reader, uploaded_files, weblinks
+        ):
+            for text, metadata, name in pages:
+                self.documents.append(text)
+                self.document_metadata.append(metadata)
+                self.child_document_names.append(name)
+            self.document_chunks_full.extend(chunks)
 
         logger.info(
             f"Total document chunks extracted: {len(self.document_chunks_full)}"
@@ -240,51 +465,37 @@ class ChunkProcessor:
             self.document_metadata,
         )
 
-    def process_weblinks(self, file_reader, weblinks):
-        if weblinks[0] != "":
-            logger.info(f"Splitting weblinks: total of {len(weblinks)}")
 
-            for link_index, link in enumerate(weblinks):
-                if link not in self.parent_document_names:
-                    try:
-                        logger.info(f"\tSplitting link {link_index+1} : {link}")
-                        if "youtube" in link:
-                            documents = file_reader.read_youtube_transcript(link)
-                        else:
-                            documents = file_reader.read_html(link)
-
-                        for doc in documents:
-                            page_num = doc.metadata.get("page", 0)
-                            self.documents.append(doc.page_content)
-                            self.document_metadata.append(
-                                {"source": link, "page": page_num}
-                            )
-                            self.child_document_names.append(f"{link}")
-
-                        self.parent_document_names.append(link)
-                        if self.config["embedding_options"]["db_option"] not in [
-                            "RAGatouille"
-                        ]:
-                            document_chunks = self.process_chunks(
-                                self.documents[-1],
-                                "txt",
-                                source=link,
-                                page=0,
-                                metadata={"source_type": "webpage"},
-                            )
-                            self.document_chunks_full.extend(document_chunks)
-                    except Exception as e:
-                        logger.error(
-                            f"Error splitting link {link_index+1} : {link}: {str(e)}"
-                        )
+# File reader and chunk processor of a parser worker process
+_worker_file_reader = None
+_worker_chunk_processor = None
+
+
+def _init_parser_worker(config):
+    global _worker_file_reader, _worker_chunk_processor
+    _worker_file_reader = FileReader(get_http_cache(config))
+    _worker_chunk_processor = ChunkProcessor(config)
+
+
+def _parse_file(file_path, metadata):
+    _worker_chunk_processor.stage_stats.clear()
+    pages, chunks = _worker_chunk_processor.parse_file(
+        _worker_file_reader, file_path, metadata
+    )
+    return pages, chunks, _worker_chunk_processor.stage_stats
 
 
 class DataLoader:
-    def __init__(self, config):
-        self.file_reader = FileReader()
+    def __init__(self, config, http_cache: HTTPCache = None):
+        self.file_reader = FileReader(http_cache)
         self.chunk_processor = ChunkProcessor(config)
 
     def get_chunks(self, uploaded_files, weblinks):
         return self.chunk_processor.get_chunks(
             self.file_reader, uploaded_files, weblinks
         )
+
+    def iter_sources(self, uploaded_files, weblinks):
+        return self.chunk_processor.iter_sources(
+            self.file_reader, uploaded_files, weblinks
+        )
@@ -0,0 +1,255 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embedding vectors, keyed by model name and the hash of
+    the normalized chunk text.
+
+    Vectors are stored in a memory-mapped float32 file with a fixed number of
+    slots; the key -> slot mapping and the last use of each slot live in a small
+    sqlite db next to it, with the dimension and the number of slots of the
+    file. When all slots are used, the least recently used vectors are evicted.
+    If max_entries changes, the file is resized (the least recently used
+    vectors are evicted if it shrinks).
+    """
+
+    def __init__(self, cache_path: str, model_name: str, max_entries: int = 100000):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.cache_dir = os.path.join(cache_path, model_name.replace("/", "_"))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.vectors_path = os.path.join(self.cache_dir, "vectors.f32")
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.db = sqlite3.connect(
+            os.path.join(self.cache_dir, "index.sqlite"), check_same_thread=False
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, slot INTEGER UNIQUE, last_used REAL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)"
+        )
+        self.db.commit()
+        self.dim = self.get_meta("dim")
+        self.vectors = None
+        self.free_slots = []
+        if self.dim is not None:
+            self._open_vectors()
+
+    def get_meta(self, name: str):
+        row = self.db.execute("SELECT value FROM meta WHERE name = ?", (name,))
+        row = row.fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, name: str, value: int):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+
+    def _map_vectors(self, capacity: int):
+        row_size = self.dim * np.dtype(np.float32).itemsize
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(capacity * row_size)
+        self.vectors = np.memmap(
+            self.vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim)
+        )
+
+    def _open_vectors(self):
+        """
+        Maps the vectors file, resized to max_entries slots
+        """
+        capacity = self.get_meta("capacity")
+        if not os.path.exists(self.vectors_path):
+            capacity = self.max_entries
+        elif capacity is None:
+            # Written before the capacity was recorded
+            row_size = self.dim * np.dtype(np.float32).itemsize
+            capacity = os.path.getsize(self.vectors_path) // row_size
+        # Mapped with the size the entries were written with
+        self._map_vectors(capacity)
+        if capacity > self.max_entries:
+            self._shrink(capacity)
+        self._map_vectors(self.max_entries)
+        self.set_meta("capacity", self.max_entries)
+        self.db.commit()
+        used = {slot for (slot,) in self.db.execute("SELECT slot FROM entries")}
+        self.free_slots = [
+            slot for slot in range(self.max_entries - 1, -1, -1) if slot not in used
+        ]
+
+    def _shrink(self, capacity: int):
+        """
+        Moves the vectors of the most recently used entries into the first
+        max_entries slots, the others are evicted
+        """
+        used = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if used > self.max_entries:
+            self.db.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries "
+                "ORDER BY last_used LIMIT ?)",
+                (used - self.max_entries,),
+            )
+            self.db.commit()
+        slots = {slot for (slot,) in self.db.execute("SELECT slot FROM entries")}
+        free = [slot for slot in range(self.max_entries) if slot not in slots]
+        moved = self.db.execute(
+            "SELECT key, slot FROM entries WHERE slot >= ?", (self.max_entries,)
+        ).fetchall()
+        for (key, slot), new_slot in zip(moved, free):
+            self.vectors[new_slot] = self.vectors[slot]
+        # the vectors must be on disk before the index points to them
+        self.vectors.flush()
+        self.db.executemany(
+            "UPDATE entries SET slot = ? WHERE key = ?",
+            [(new_slot, key) for (key, _), new_slot in zip(moved, free)],
+        )
+        self.set_meta("capacity", self.max_entries)
+        self.db.commit()
+        del self.vectors
+
+    def get_key(self, text: str) -> str:
+        text_hash = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+        return f"{self.model_name}:{text_hash}"
+
+    def get(self, texts: List[str]) -> list:
+        """
+        Returns the cached vector for each text, None where it is not cached
+        """
+        keys = [self.get_key(text) for text in texts]
+        results = [None] * len(texts)
+        with self._lock:
+            if self.vectors is None:
+                self.misses += len(texts)
+                return results
+            slots = {}
+            for start in range(0, len(keys), 500):
+                batch = keys[start : start + 500]
+                rows = self.db.execute(
+                    "SELECT key, slot FROM entries WHERE key IN "
+                    f"({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                slots.update(rows)
+            for i, key in enumerate(keys):
+                if key in slots:
+                    results[i] = np.array(self.vectors[slots[key]])
+            now = time.time()
+            self.db.executemany(
+                "UPDATE entries SET last_used = ? WHERE key = ?",
+                [(now, key) for key in slots],
+            )
+            self.db.commit()
+            self.hits += len([r for r in results if r is not None])
+            self.misses += len([r for r in results if r is None])
+        return results
+
+    def put(self, texts: List[str], vectors: List[List[float]]):
+        with self._lock:
+            if self.vectors is None:
+                self.dim = len(vectors[0])
+                self.set_meta("dim", self.dim)
+                self._open_vectors()
+
+            entries = {}
+            for text, vector in zip(texts, vectors):
+                entries[self.get_key(text)] = vector
+            existing = set()
+            for start in range(0, len(entries), 500):
+                batch = list(entries)[start : start + 500]
+                existing.update(
+                    key
+                    for (key,) in self.db.execute(
+                        "SELECT key FROM entries WHERE key IN "
+                        f"({','.join('?' * len(batch))})",
+                        batch,
+                    )
+                )
+            entries = {k: v for k, v in entries.items() if k not in existing}
+            if not entries:
+                return
+
+            slots = self._allocate_slots(len(entries))
+            for slot, vector in zip(slots, entries.values()):
+                self.vectors[slot] = np.asarray(vector, dtype=np.float32)
+            # the vectors must be on disk before the index points to them
+            self.vectors.flush()
+            now = time.time()
+            self.db.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?)",
+                [(key, slot, now) for key, slot in zip(entries, slots)],
+            )
+            self.db.commit()
+
+    def _allocate_slots(self, n: int) -> list:
+        n = min(n, self.max_entries)
+        if len(self.free_slots) < n:
+            # Evict the least recently used entries. The eviction is committed
+            # before their slots are overwritten, so that after a crash no key
+            # points to the vector of another text
+            evicted = self.db.execute(
+                "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?",
+                (n - len(self.free_slots),),
+            ).fetchall()
+            self.db.executemany(
+                "DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted]
+            )
+            self.db.commit()
+            self.free_slots += [slot for _, slot in evicted]
+        slots = self.free_slots[-n:]
+        del self.free_slots[-n:]
+        return slots
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "entries": self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0],
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model so that document embeddings are read from and
+    written to an EmbeddingCache. Queries are passed through uncached.
+    """
+
+    def __init__(self, embedding_model: Embeddings, cache: EmbeddingCache):
+        self.embedding_model = embedding_model
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.cache.get(texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            new_vectors = self.embedding_model.embed_documents(
+                [texts[i] for i in missing]
+            )
+            self.cache.put([texts[i] for i in missing], new_vectors)
+            for i, vector in zip(missing, new_vectors):
+                vectors[i] = vector
+        return [list(map(float, vector)) for vector in vectors]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embedding_model.embed_query(text)
@@ -4,8 +4,10 @@ from langchain_community.embeddings import LlamaCppEmbeddings
 
 try:
     from modules.constants import *
+    from modules.embedding_cache import CachedEmbeddings, EmbeddingCache
 except:
     from constants import *
+    from embedding_cache import CachedEmbeddings, EmbeddingCache
 import os
 
 
@@ -13,8 +15,11 @@ class EmbeddingModelLoader:
     def __init__(self, config):
         self.config = config
 
-    def load_embedding_model(self):
-        if self.config["embedding_options"]["model"] in ["text-embedding-ada-002"]:
+    def is_openai_model(self):
+        return self.config["embedding_options"]["model"] in ["text-embedding-ada-002"]
+
+    def load_embedding_model(self, use_cache=True):
+        if self.is_openai_model():
             embedding_model = OpenAIEmbeddings(
                 deployment="SL-document_embedder",
                 model=self.config["embedding_options"]["model"],
@@ -35,4 +40,13 @@ class EmbeddingModelLoader:
             #     model_path=os.path.abspath("storage/llama-7b.ggmlv3.q4_0.bin")
             # )
 
+        cache_options = self.config["embedding_options"].get("embedding_cache", {})
+        if use_cache and cache_options.get("enabled", False):
+            cache = EmbeddingCache(
+                cache_options["cache_path"],
+                self.config["embedding_options"]["model"],
+                max_entries=cache_options["max_entries"],
+            )
+            embedding_model = CachedEmbeddings(embedding_model, cache)
+
         return embedding_model
@@ -0,0 +1,192 @@
+import json
+import os
+import time
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ["Flat", "HNSW", "IVF", "IVFPQ"]
+# Options that change the content of the index; the others only affect search
+BUILD_OPTIONS = ["type", "hnsw_m", "ef_construction", "nlist", "pq_m", "pq_nbits"]
+
+
+def get_index_options(config) -> dict:
+    options = {
+        "type": "Flat",
+        "hnsw_m": 32,
+        "ef_construction": 40,
+        "ef_search": 64,
+        "nlist": 100,
+        "nprobe": 8,
+        "pq_m": 16,
+        "pq_nbits": 8,
+        "train_size": 10000,
+        "evaluate": True,
+        "recall_k": 4,
+        "num_eval_queries": 100,
+    }
+    options.update(config["embedding_options"].get("faiss_index", {}))
+    if options["type"] not in INDEX_TYPES:
+        raise ValueError(
+            f"Unknown FAISS index type {options['type']}, expected one of {INDEX_TYPES}"
+        )
+    return options
+
+
+def get_train_size(options: dict) -> int:
+    """
+    Vectors to buffer before the index can be created
+    """
+    if options["type"] in ["IVF", "IVFPQ"]:
+        return options["train_size"]
+    return 0
+
+
+def create_index(options: dict, train_vectors: np.ndarray, logger):
+    """
+    Creates (and trains, if needed) an empty index of the configured type.
+    With too few training vectors, the number of IVF lists is reduced, and PQ
+    falls back to IVF.
+    """
+    dim = train_vectors.shape[1]
+    index_type = options["type"]
+    if index_type == "Flat":
+        return faiss.IndexFlatL2(dim)
+    if index_type == "HNSW":
+        index = faiss.IndexHNSWFlat(dim, options["hnsw_m"])
+        index.hnsw.efConstruction = options["ef_construction"]
+        return index
+
+    num_train = len(train_vectors)
+    # faiss wants at least 39 training points per list
+    nlist = max(1, min(options["nlist"], num_train // 39))
+    if nlist < options["nlist"]:
+        logger.warning(
+            f"\tOnly {num_train} training vectors, using nlist={nlist} "
+            f"instead of {options['nlist']}"
+        )
+    quantizer = faiss.IndexFlatL2(dim)
+    if (
+        index_type == "IVFPQ"
+        and dim % options["pq_m"] == 0
+        and num_train >= 2 ** options["pq_nbits"]
+    ):
+        index = faiss.IndexIVFPQ(
+            quantizer, dim, nlist, options["pq_m"], options["pq_nbits"]
+        )
+    else:
+        if index_type == "IVFPQ":
+            logger.warning(
+                f"\tCan't train PQ with m={options['pq_m']}, nbits={options['pq_nbits']} "
+                f"on {num_train} vectors of dimension {dim}, using IVF"
+            )
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+    index.train(train_vectors)
+    return index
+
+
+def set_search_params(index, options: dict):
+    """
+    Search-time parameters, which can change without rebuilding the index
+    """
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = options["ef_search"]
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = options["nprobe"]
+
+
+def delete_vectors(vector_db, ids: list):
+    """
+    FAISS.delete, which renumbers the positions of the remaining vectors.
+    IVF indexes keep the labels of the remaining vectors when some are
+    removed, so they are renumbered to match.
+    """
+    id_set = set(ids)
+    removed = np.array(
+        sorted(i for i, _id in vector_db.index_to_docstore_id.items() if _id in id_set),
+        dtype=np.int64,
+    )
+    vector_db.delete(ids)
+    index = vector_db.index
+    if not isinstance(index, faiss.IndexIVF) or len(removed) == 0:
+        return
+    invlists = index.invlists
+    for list_no in range(index.nlist):
+        size = invlists.list_size(list_no)
+        if size == 0:
+            continue
+        labels = faiss.rev_swig_ptr(invlists.get_ids(list_no), size).copy()
+        codes = faiss.rev_swig_ptr(
+            invlists.get_codes(list_no), size * invlists.code_size
+        ).copy()
+        labels -= np.searchsorted(removed, labels)
+        invlists.update_entries(
+            list_no, 0, size, faiss.swig_ptr(labels), faiss.swig_ptr(codes)
+        )
+
+
+def read_index(path: str, index_type: str = "Flat", mmap: bool = False):
+    """
+    Reads an index, with mmap memory-mapped and read-only. faiss maps the
+    inverted lists of IVF indexes (IO_FLAG_MMAP) and the vectors of the
+    others (IO_FLAG_MMAP_IFC), and doesn't accept both flags for IVF.
+    """
+    if not mmap:
+        return faiss.read_index(path)
+    if index_type in ["IVF", "IVFPQ"]:
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    else:
+        flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+    return faiss.read_index(path, flags)
+
+
+def get_index_memory(index) -> int:
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def evaluate_index(index, flat_index, options: dict) -> dict:
+    """
+    recall@k and search latency of the index against exact search over the
+    same vectors. Queries are stored vectors, their own match is left out.
+    """
+    k = options["recall_k"]
+    num_queries = min(options["num_eval_queries"], flat_index.ntotal)
+    if num_queries == 0:
+        return {}
+    rng = np.random.default_rng(0)
+    query_ids = rng.choice(flat_index.ntotal, size=num_queries, replace=False)
+    queries = flat_index.reconstruct_batch(query_ids)
+
+    start = time.perf_counter()
+    _, exact = flat_index.search(queries, k + 1)
+    flat_time = time.perf_counter() - start
+    start = time.perf_counter()
+    _, approx = index.search(queries, k + 1)
+    index_time = time.perf_counter() - start
+
+    recalls = []
+    for query_id, exact_ids, approx_ids in zip(query_ids, exact, approx):
+        exact_ids = [i for i in exact_ids if i != query_id and i != -1][:k]
+        approx_ids = [i for i in approx_ids if i != query_id and i != -1][:k]
+        if exact_ids:
+            recalls.append(len(set(exact_ids) & set(approx_ids)) / len(exact_ids))
+    return {
+        f"recall@{k}": round(float(np.mean(recalls)), 4) if recalls else None,
+        "search_ms": round(1000 * index_time / num_queries, 4),
+        "flat_search_ms": round(1000 * flat_time / num_queries, 4),
+        "memory_bytes": get_index_memory(index),
+        "flat_memory_bytes": get_index_memory(flat_index),
+    }
+
+
+def save_index_config(db_path: str, index_config: dict):
+    with open(os.path.join(db_path, "index_config.json"), "w") as f:
+        json.dump(index_config, f, indent=2)
+
+
+def load_index_config(db_path: str):
+    path = os.path.join(db_path, "index_config.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
@@ -0,0 +1,108 @@
+import threading
+from collections import deque
+
+FINISH_REASONS = ["stop", "length", "repetition"]
+
+
+def get_generation_options(config) -> dict:
+    """
+    Generation options of the chat profile (recorded in the config by main.py):
+    the defaults, overridden by the options of the profile. Without a profile,
+    the OpenAI model name or the local model type is used.
+    """
+    llm_params = config["llm_params"]
+    profile = llm_params.get("chat_profile")
+    if profile is None:
+        if llm_params["llm_loader"] == "openai":
+            profile = llm_params["openai_params"]["model"]
+        else:
+            profile = llm_params["local_llm_params"].get("model_type", "llama")
+    generation = llm_params.get("generation", {})
+    options = {
+        "max_tokens": 256,
+        "stop": [],
+        "repetition_ngram_size": 0,
+        "max_repeats": 3,
+        **generation.get("default", {}),
+        **generation.get("profiles", {}).get(profile, {}),
+    }
+    options["profile"] = profile
+    options["stop"] = list(options["stop"] or [])
+    return options
+
+
+class RepetitionDetector:
+    """
+    Detects a generation stuck in a loop: the last ngram_size tokens were
+    already generated max_repeats - 1 times. The tokens generated since the
+    first occurrence of the repeated n-gram are counted as wasted.
+    """
+
+    def __init__(self, ngram_size: int = 8, max_repeats: int = 3):
+        self.ngram_size = ngram_size
+        self.max_repeats = max_repeats
+        self.window = deque(maxlen=ngram_size)
+        self.first_end = {}  # n-gram -> number of tokens when it first ended
+        self.counts = {}
+        self.num_tokens = 0
+        self.wasted_tokens = 0
+
+    def add(self, token: str) -> bool:
+        """
+        Adds a generated token, True when the generation should stop
+        """
+        self.num_tokens += 1
+        self.window.append(token)
+        if len(self.window) < self.ngram_size:
+            return False
+        ngram = tuple(self.window)
+        self.first_end.setdefault(ngram, self.num_tokens)
+        self.counts[ngram] = self.counts.get(ngram, 0) + 1
+        if self.counts[ngram] < self.max_repeats:
+            return False
+        self.wasted_tokens = self.num_tokens - self.first_end[ngram]
+        return True
+
+
+class GenerationStats:
+    """
+    Process-wide counters of the generated tokens per chat profile: generated,
+    wasted (spent repeating text before the generation was stopped), and why
+    the generations finished
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profiles = {}
+
+    def record(self, profile: str, generated: int, wasted: int, finish_reason: str):
+        with self._lock:
+            stats = self.profiles.setdefault(
+                profile,
+                {
+                    "generations": 0,
+                    "generated_tokens": 0,
+                    "wasted_tokens": 0,
+                    **{reason: 0 for reason in FINISH_REASONS},
+                },
+            )
+            stats["generations"] += 1
+            stats["generated_tokens"] += generated
+            stats["wasted_tokens"] += wasted
+            if finish_reason in FINISH_REASONS:
+                stats[finish_reason] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                profile: {
+                    **stats,
+                    "avg_tokens": round(
+                        stats["generated_tokens"] / max(stats["generations"], 1), 1
+                    ),
+                }
+                for profile, stats in self.profiles.items()
+            }
+
+
+generation_stats = GenerationStats()
@@ -7,13 +7,16 @@ import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse, urljoin, urldefrag
 import asyncio
+import time
 import aiohttp
 from aiohttp import ClientSession
 
 try:
     from modules.constants import *
+    from modules.http_cache import HTTPCache
 except:
     from constants import *
+    from http_cache import HTTPCache
 
 """
 Ref: https://python.plainenglish.io/scraping-the-subpages-on-a-website-ea2d4e3db113
@@ -21,40 +24,124 @@ Ref: https://python.plainenglish.io/scraping-the-subpages-on-a-website-ea2d4e3db
 
 
 class WebpageCrawler:
-    def __init__(self):
+    """
+    Crawls the child pages of a url with a bounded pool of concurrent requests,
+    at most requests_per_second requests per host, up to max_depth links away
+    from the start page and max_pages pages in total (None for no limit).
+    The status and content type of every url are recorded once, so that
+    clean_url_list doesn't have to request them again. Pages are downloaded
+    through http_cache, so unchanged pages cost a conditional request.
+    """
+
+    def __init__(
+        self,
+        max_depth: int = None,
+        max_pages: int = None,
+        concurrency: int = 8,
+        requests_per_second: float = 5,
+        http_cache: HTTPCache = None,
+    ):
+        self.http_cache = http_cache if http_cache is not None else HTTPCache()
         self.dict_href_links = {}
+        self.url_info = {}  # url -> {"status": int, "content_type": str}
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+        self.min_interval = 1 / requests_per_second if requests_per_second else 0
+        self.host_next_request = {}
+        self.semaphore = None
+        self.stats = {"pages": 0, "head_requests": 0, "get_requests": 0, "errors": 0}
+        self.crawl_time = 0.0
+
+    async def throttle(self, url: str):
+        # Reserve the next free slot for this host, then wait for it
+        host = urlparse(url).netloc
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self.host_next_request.get(host, now))
+        self.host_next_request[host] = slot + self.min_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def get_semaphore(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.semaphore
 
     async def fetch(self, session: ClientSession, url: str) -> str:
-        async with session.get(url) as response:
+        cached = self.http_cache.get_fresh(url)
+        if cached is not None:
+            return cached.text
+        # Wait for the host's slot before taking a connection, so that a
+        # throttled host does not hold up the requests to the others
+        await self.throttle(url)
+        async with self.get_semaphore():
+            self.stats["get_requests"] += 1
+            response = await self.http_cache.afetch(session, url)
+            self.url_info[url] = {
+                "status": response.status,
+                "content_type": response.content_type,
+            }
+            return response.text
+
+    async def check_url(self, session: ClientSession, url: str) -> dict:
+        """
+        Status and content type of a url, requested at most once per url
+        """
+        if url in self.url_info:
+            return self.url_info[url]
+        cached = self.http_cache.get_fresh(url)
+        if cached is not None:
+            self.url_info[url] = {
+                "status": cached.status,
+                "content_type": cached.content_type,
+            }
+            return self.url_info[url]
+        await self.throttle(url)
+        async with self.get_semaphore():
+            self.stats["head_requests"] += 1
             try:
-                return await response.text()
-            except UnicodeDecodeError:
-                return await response.text(encoding="latin1")
+                async with session.head(url, allow_redirects=True) as response:
+                    info = {
+                        "status": response.status,
+                        "content_type": response.headers.get(
+                            "Content-Type", ""
+                        ).lower(),
+                    }
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self.stats["errors"] += 1
+                info = {"status": None, "content_type": ""}
+        self.url_info[url] = info
+        return info
 
-    def url_exists(self, url: str) -> bool:
-        try:
-            response = requests.head(url)
-            return response.status_code == 200
-        except requests.ConnectionError:
-            return False
+    async def url_exists(self, session: ClientSession, url: str) -> bool:
+        return (await self.check_url(session, url))["status"] == 200
 
     async def get_links(self, session: ClientSession, website_link: str, base_url: str):
-        html_data = await self.fetch(session, website_link)
+        info = await self.check_url(session, website_link)
+        if "text/html" not in info["content_type"]:
+            return []  # files don't have links to follow
+        try:
+            html_data = await self.fetch(session, website_link)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.stats["errors"] += 1
+            return []
         soup = BeautifulSoup(html_data, "html.parser")
-        list_links = []
+        candidates = []
         for link in soup.find_all("a", href=True):
             href = link["href"].strip()
-            full_url = urljoin(base_url, href)
+            full_url = urljoin(website_link, href)
             normalized_url = self.normalize_url(full_url)  # sections removed
-            if (
-                normalized_url not in self.dict_href_links
-                and self.is_child_url(normalized_url, base_url)
-                and self.url_exists(normalized_url)
+            if normalized_url not in self.dict_href_links and self.is_child_url(
+                normalized_url, base_url
             ):
+                # Claimed before the HEAD request, so no other page checks it again
                 self.dict_href_links[normalized_url] = None
-                list_links.append(normalized_url)
-
-        return list_links
+                candidates.append(normalized_url)
+        exists = await asyncio.gather(
+            *[self.url_exists(session, url) for url in candidates]
+        )
+        return [url for url, ok in zip(candidates, exists) if ok]
 
     async def get_subpage_links(
         self, session: ClientSession, urls: list, base_url: str
@@ -65,54 +152,57 @@ class WebpageCrawler:
         return all_links
 
     async def get_all_pages(self, url: str, base_url: str):
+        start = time.perf_counter()
+        self.semaphore = None  # bound to the running event loop
         async with aiohttp.ClientSession() as session:
-            dict_links = {url: "Not-checked"}
-            counter = None
-            while counter != 0:
-                unchecked_links = [
-                    link
-                    for link, status in dict_links.items()
-                    if status == "Not-checked"
-                ]
-                if not unchecked_links:
-                    break
-                new_links = await self.get_subpage_links(
-                    session, unchecked_links, base_url
-                )
-                for link in unchecked_links:
-                    dict_links[link] = "Checked"
+            url = self.normalize_url(url)
+            self.dict_href_links[url] = None
+            checked_urls = []
+            frontier, depth = [url], 0
+            while frontier:
+                if self.max_pages is not None:
+                    frontier = frontier[: self.max_pages - len(checked_urls)]
+                checked_urls.extend(frontier)
+                for link in frontier:
                     print(f"Checked: {link}")
-                dict_links.update(
-                    {
-                        link: "Not-checked"
-                        for link in new_links
-                        if link not in dict_links
-                    }
-                )
-                counter = len(
-                    [
-                        status
-                        for status in dict_links.values()
-                        if status == "Not-checked"
-                    ]
-                )
-
-            checked_urls = [
-                url for url, status in dict_links.items() if status == "Checked"
-            ]
-            return checked_urls
+                if (
+                    self.max_pages is not None and len(checked_urls) >= self.max_pages
+                ) or (self.max_depth is not None and depth >= self.max_depth):
+                    break
+                frontier = await self.get_subpage_links(session, frontier, base_url)
+                depth += 1
+
+        self.stats["pages"] += len(checked_urls)
+        self.crawl_time += time.perf_counter() - start
+        return checked_urls
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "crawl_time": round(self.crawl_time, 2),
+            "pages_per_sec": round(self.stats["pages"] / max(self.crawl_time, 1e-9), 2),
+            "http_cache": self.http_cache.stats(),
+        }
+
+    async def check_urls(self, urls):
+        self.semaphore = None
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*[self.check_url(session, url) for url in urls])
 
     def is_webpage(self, url: str) -> bool:
-        try:
-            response = requests.head(url, allow_redirects=True)
-            content_type = response.headers.get("Content-Type", "").lower()
-            return "text/html" in content_type
-        except requests.RequestException:
-            return False
+        if url not in self.url_info:
+            asyncio.get_event_loop().run_until_complete(self.check_urls([url]))
+        return "text/html" in self.url_info[url]["content_type"]
 
     def clean_url_list(self, urls):
         files, webpages = [], []
 
+        # urls found while crawling are already known, the others are checked
+        # concurrently
+        unknown_urls = [url for url in urls if url and url not in self.url_info]
+        if unknown_urls:
+            asyncio.get_event_loop().run_until_complete(self.check_urls(unknown_urls))
+
         for url in urls:
             if self.is_webpage(url):
                 webpages.append(url)
@@ -179,7 +269,10 @@ def get_sources(res, answer):
     for idx, source in enumerate(res["source_documents"]):
         source_metadata = source.metadata
         url = source_metadata["source"]
-        score = source_metadata.get("score", "N/A")
+        score = source_metadata.get("score")
+        if score is None:
+            # Found by the lexical search only, no similarity
+            score = "N/A"
         page = source_metadata.get("page", 1)
         date = source_metadata.get("date", "N/A")
 
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+
+class CachedResponse:
+    """
+    Body and headers of a fetched url. not_modified is True when the server
+    answered 304 and the body was served from the cache.
+    """
+
+    def __init__(self, url, status, body: bytes, content_type="", not_modified=False):
+        self.url = url
+        self.status = status
+        self.content = body
+        self.content_type = content_type
+        self.not_modified = not_modified
+
+    @property
+    def ok(self):
+        return self.status == 200
+
+    @property
+    def text(self):
+        charset = "utf-8"
+        for param in self.content_type.split(";")[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "charset" and value:
+                charset = value.strip('"')
+        try:
+            return self.content.decode(charset)
+        except (LookupError, UnicodeDecodeError):
+            return self.content.decode("latin1")
+
+    @property
+    def content_hash(self):
+        return hashlib.sha256(self.content).hexdigest()
+
+
+class HTTPCache:
+    """
+    On-disk cache of HTTP responses. Bodies are stored with their ETag and
+    Last-Modified headers, and a url that is in the cache is fetched again
+    with a conditional request: a 304 answer means the cached body is still
+    current. A url is requested at most once per run, later fetches are served
+    from the cache. With cache_path None, responses are only kept in memory.
+    """
+
+    def __init__(self, cache_path: str = None, timeout: float = 30):
+        self.cache_path = cache_path
+        self.timeout = timeout
+        if cache_path is not None:
+            os.makedirs(cache_path, exist_ok=True)
+        self.entries = {}
+        self.bodies = {}
+        self.fresh = set()  # urls validated during this run
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_not_modified = 0
+        self.num_downloaded = 0
+        self.num_fresh_hits = 0
+
+    def get_paths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return (
+            os.path.join(self.cache_path, key + ".json"),
+            os.path.join(self.cache_path, key + ".body"),
+        )
+
+    def get_entry(self, url):
+        if url in self.entries or self.cache_path is None:
+            return self.entries.get(url)
+        entry_path, body_path = self.get_paths(url)
+        if not (os.path.exists(entry_path) and os.path.exists(body_path)):
+            return None
+        with open(entry_path, "r") as f:
+            entry = json.load(f)
+        self.entries[url] = entry
+        return entry
+
+    def get_body(self, url):
+        if self.cache_path is None:
+            return self.bodies[url]
+        with open(self.get_paths(url)[1], "rb") as f:
+            return f.read()
+
+    def cached_response(self, url, not_modified=False):
+        entry = self.get_entry(url)
+        return CachedResponse(
+            url,
+            entry["status"],
+            self.get_body(url),
+            entry["content_type"],
+            not_modified=not_modified,
+        )
+
+    def get_fresh(self, url):
+        """
+        The cached response of a url that was already fetched during this run
+        """
+        with self._lock:
+            if url not in self.fresh:
+                return None
+            self.num_fresh_hits += 1
+        return self.cached_response(url, not_modified=True)
+
+    def is_fresh(self, url):
+        return url in self.fresh
+
+    def conditional_headers(self, url):
+        entry = self.get_entry(url)
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, url, headers, body: bytes):
+        entry = {
+            "url": url,
+            "status": 200,
+            "content_type": headers.get("Content-Type", "").lower(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }
+        if self.cache_path is None:
+            self.bodies[url] = body
+        else:
+            entry_path, body_path = self.get_paths(url)
+            with open(body_path + ".tmp", "wb") as f:
+                f.write(body)
+            with open(entry_path + ".tmp", "w") as f:
+                json.dump(entry, f)
+            os.replace(body_path + ".tmp", body_path)
+            os.replace(entry_path + ".tmp", entry_path)
+        self.entries[url] = entry
+
+    def handle_response(self, url, status, headers, body):
+        with self._lock:
+            self.num_requests += 1
+            if status == 304 and self.get_entry(url) is not None:
+                self.num_not_modified += 1
+                self.fresh.add(url)
+                not_modified = True
+            elif status == 200:
+                self.num_downloaded += 1
+                self.store(url, headers, body)
+                self.fresh.add(url)
+                not_modified = False
+            else:
+                # Errors are not cached
+                return CachedResponse(
+                    url, status, body, headers.get("Content-Type", "").lower()
+                )
+        return self.cached_response(url, not_modified=not_modified)
+
+    def fetch(self, url: str) -> CachedResponse:
+        cached = self.get_fresh(url)
+        if cached is not None:
+            return cached
+        response = requests.get(
+            url, headers=self.conditional_headers(url), timeout=self.timeout
+        )
+        return self.handle_response(
+            url, response.status_code, response.headers, response.content
+        )
+
+    async def afetch(self, session, url: str) -> CachedResponse:
+        """
+        Same as fetch, with an aiohttp session
+        """
+        cached = self.get_fresh(url)
+        if cached is not None:
+            return cached
+        async with session.get(url, headers=self.conditional_headers(url)) as response:
+            body = await response.read()
+            return self.handle_response(url, response.status, response.headers, body)
+
+    def content_hash(self, url: str):
+        """
+        Hash of the current content of a url, None if it can't be fetched
+        """
+        try:
+            response = self.fetch(url)
+        except requests.RequestException:
+            return None
+        return response.content_hash if response.ok else None
+
+    def stats(self):
+        return {
+            "requests": self.num_requests,
+            "not_modified": self.num_not_modified,
+            "downloaded": self.num_downloaded,
+            "fresh_hits": self.num_fresh_hits,
+        }
+
+
+def get_http_cache(config):
+    options = config["embedding_options"].get("http_cache", {})
+    if options.get("enabled", False):
+        return HTTPCache(options.get("cache_path"))
+    return HTTPCache()
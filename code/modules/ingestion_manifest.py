@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8", errors="ignore")).hexdigest()
+
+
+def hash_file(file_path: str):
+    """
+    Content hash of a local file, None for remote files (urls)
+    """
+    if not os.path.isfile(file_path):
+        return None
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def hash_config(options: dict) -> str:
+    return hash_text(json.dumps(options, sort_keys=True, default=str))
+
+
+def get_chunk_id(chunk) -> str:
+    """
+    Deterministic id of a chunk, used as its id in the vector database
+    """
+    return hash_text(
+        f"{chunk.metadata.get('source', '')}\x00"
+        f"{chunk.metadata.get('page', 0)}\x00"
+        f"{chunk.page_content}"
+    )
+
+
+class IngestionManifest:
+    """
+    Records what the vector database was built from: a content hash for every
+    source (file or webpage) and each of its pages, and the ids of its chunks.
+    Stored as json next to the vector database.
+    """
+
+    def __init__(self, path: str, config_hash: str):
+        self.path = path
+        self.config_hash = config_hash
+        self.sources = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                manifest = json.load(f)
+            # chunks built with different splitter options can't be reused
+            if manifest.get("config_hash") == config_hash:
+                self.sources = manifest.get("sources", {})
+
+    def exists(self):
+        return len(self.sources) > 0
+
+    def is_unchanged(self, source: str, source_hash) -> bool:
+        entry = self.sources.get(source)
+        return (
+            source_hash is not None
+            and entry is not None
+            and entry["hash"] == source_hash
+        )
+
+    def chunk_ids(self, source: str = None) -> set:
+        if source is not None:
+            return set(self.sources.get(source, {}).get("chunks", []))
+        return {
+            chunk_id for entry in self.sources.values() for chunk_id in entry["chunks"]
+        }
+
+    def update_source(self, source: str, source_hash, page_hashes: dict, chunk_ids):
+        self.sources[source] = {
+            "hash": source_hash,
+            "pages": page_hashes,
+            "chunks": list(chunk_ids),
+        }
+
+    def remove_source(self, source: str):
+        return set(self.sources.pop(source, {}).get("chunks", []))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({"config_hash": self.config_hash, "sources": self.sources}, f)
@@ -0,0 +1,118 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from langchain.schema import Document
+
+
+class IngestionStore:
+    """
+    Persists the intermediate results of ingestion in a sqlite db, so that a
+    rebuild only re-runs the stages whose inputs changed:
+
+    - pages: the parsed pages of a source, keyed by the source and its content
+      hash. Changing the splitter options doesn't read the sources again.
+    - chunks: the chunks of a page, keyed by the hash of the page and of the
+      splitter options.
+
+    The third stage, the embeddings of the chunks, is the EmbeddingCache.
+    Payloads are stored as zlib-compressed json. Entries that were not used
+    for max_age days are deleted when the store is opened.
+    """
+
+    def __init__(self, db_path: str, max_age: float = 30):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        # Parser worker processes open the same db, WAL lets them write concurrently
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pages (source TEXT, source_hash TEXT, "
+            "data BLOB, last_used REAL, PRIMARY KEY (source, source_hash))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (page_hash TEXT, splitter_hash TEXT, "
+            "data BLOB, last_used REAL, PRIMARY KEY (page_hash, splitter_hash))"
+        )
+        cutoff = time.time() - max_age * 86400
+        self.db.execute("DELETE FROM pages WHERE last_used < ?", (cutoff,))
+        self.db.execute("DELETE FROM chunks WHERE last_used < ?", (cutoff,))
+        self.db.commit()
+
+    def encode(self, value) -> bytes:
+        return zlib.compress(json.dumps(value, default=str).encode("utf-8"))
+
+    def decode(self, data: bytes):
+        return json.loads(zlib.decompress(data).decode("utf-8"))
+
+    def get_pages(self, source: str, source_hash: str):
+        """
+        The cached pages of a source as a list of (text, metadata, name), or None
+        """
+        with self._lock:
+            row = self.db.execute(
+                "SELECT data FROM pages WHERE source = ? AND source_hash = ?",
+                (source, source_hash),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE pages SET last_used = ? WHERE source = ? AND source_hash = ?",
+                (time.time(), source, source_hash),
+            )
+            self.db.commit()
+        return [tuple(page) for page in self.decode(row[0])]
+
+    def put_pages(self, source: str, source_hash: str, pages: list):
+        with self._lock:
+            # Older versions of the source are of no use anymore
+            self.db.execute("DELETE FROM pages WHERE source = ?", (source,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                (source, source_hash, self.encode(pages), time.time()),
+            )
+            self.db.commit()
+
+    def get_chunks(self, page_hash: str, splitter_hash: str):
+        """
+        The cached chunks of a page as Documents, or None
+        """
+        with self._lock:
+            row = self.db.execute(
+                "SELECT data FROM chunks WHERE page_hash = ? AND splitter_hash = ?",
+                (page_hash, splitter_hash),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE chunks SET last_used = ? "
+                "WHERE page_hash = ? AND splitter_hash = ?",
+                (time.time(), page_hash, splitter_hash),
+            )
+            self.db.commit()
+        return [
+            Document(page_content=chunk["page_content"], metadata=chunk["metadata"])
+            for chunk in self.decode(row[0])
+        ]
+
+    def put_chunks(self, page_hash: str, splitter_hash: str, chunks: list):
+        data = [
+            {"page_content": chunk.page_content, "metadata": chunk.metadata}
+            for chunk in chunks
+        ]
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)",
+                (page_hash, splitter_hash, self.encode(data), time.time()),
+            )
+            self.db.commit()
+
+
+def get_ingestion_store(config):
+    options = config["embedding_options"].get("ingestion_store", {})
+    if not options.get("enabled", False):
+        return None
+    return IngestionStore(options["db_path"], max_age=options.get("max_age", 30))
@@ -0,0 +1,265 @@
+import json
+import os
+import re
+import threading
+from typing import List, Tuple
+
+import numpy as np
+from langchain_community.vectorstores import FAISS, Chroma
+from langchain.schema.document import Document
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# Course numbers like "DS 542", "DS-542" and "DS542" are indexed as one term.
+# They are written in capitals in the documents, in any case in the queries
+COURSE_PATTERN = re.compile(r"\b([A-Z]{2,4})[\s\-]?(\d{3})\b")
+QUERY_COURSE_PATTERN = re.compile(r"\b([A-Za-z]{2,4})[\s\-]?(\d{3})\b")
+STOPWORDS = set(
+    "a an and are as at be by can do does for from has have how i in is it its "
+    "of on or that the this to was what when where which who why will with you "
+    "your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS
+    ]
+
+
+def analyze_document(text: str) -> List[str]:
+    return tokenize(COURSE_PATTERN.sub(r"\1\2", text))
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over the chunks of a vector database, keyed by the same
+    chunk ids. The postings (chunk positions and precomputed BM25 term weights)
+    are stored as numpy arrays, the vocabulary as json.
+    """
+
+    def __init__(self, ids, vocabulary, offsets, postings, weights):
+        self.ids = ids
+        self.vocabulary = vocabulary  # term -> index of its postings
+        self.offsets = offsets
+        self.postings = postings
+        self.weights = weights
+        num_docs = max(len(ids), 1)
+        doc_freqs = np.diff(offsets)
+        self.idf = np.log(1 + (num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+
+    @classmethod
+    def build(cls, ids: List[str], texts: List[str], k1: float = 1.5, b: float = 0.75):
+        term_freqs = {}
+        doc_lengths = np.zeros(len(texts), dtype=np.float32)
+        for position, text in enumerate(texts):
+            tokens = analyze_document(text)
+            doc_lengths[position] = len(tokens)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                term_freqs.setdefault(token, []).append((position, count))
+        avg_length = float(doc_lengths.mean()) if len(texts) else 1.0
+
+        vocabulary, offsets, postings, weights = {}, [0], [], []
+        for term, entries in term_freqs.items():
+            vocabulary[term] = len(vocabulary)
+            positions = np.array([position for position, _ in entries], np.int32)
+            tf = np.array([count for _, count in entries], np.float32)
+            norm = k1 * (1 - b + b * doc_lengths[positions] / max(avg_length, 1e-9))
+            postings.append(positions)
+            weights.append(tf * (k1 + 1) / (tf + norm))
+            offsets.append(offsets[-1] + len(entries))
+        return cls(
+            list(ids),
+            vocabulary,
+            np.array(offsets, np.int64),
+            np.concatenate(postings) if postings else np.zeros(0, np.int32),
+            np.concatenate(weights) if weights else np.zeros(0, np.float32),
+        )
+
+    def save(self, path: str):
+        """
+        Writes every file next to the previous one and swaps them in with
+        os.replace, the vocabulary last, so processes that memory-mapped the
+        previous arrays keep reading them
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = {
+            "offsets.npy": self.offsets,
+            "postings.npy": self.postings,
+            "weights.npy": self.weights,
+        }
+        for name, array in arrays.items():
+            with open(os.path.join(path, name + ".tmp"), "wb") as f:
+                np.save(f, array)
+        with open(os.path.join(path, "vocabulary.json.tmp"), "w") as f:
+            json.dump({"ids": self.ids, "vocabulary": self.vocabulary}, f)
+        for name in [*arrays, "vocabulary.json"]:
+            os.replace(os.path.join(path, name + ".tmp"), os.path.join(path, name))
+
+    @classmethod
+    def load(cls, path: str):
+        with open(os.path.join(path, "vocabulary.json"), "r") as f:
+            data = json.load(f)
+        return cls(
+            data["ids"],
+            data["vocabulary"],
+            np.load(os.path.join(path, "offsets.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "postings.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "weights.npy"), mmap_mode="r"),
+        )
+
+    def analyze_query(self, query: str) -> List[str]:
+        # Only join a course number into one term when the database has it,
+        # "page 123" stays two terms
+        def join(match):
+            term = (match.group(1) + match.group(2)).lower()
+            return term if term in self.vocabulary else match.group(0)
+
+        return list(dict.fromkeys(tokenize(QUERY_COURSE_PATTERN.sub(join, query))))
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float, bool]]:
+        """
+        The k best chunks for the query as (chunk id, BM25 score, whether the
+        chunk has every term of the query)
+        """
+        terms = self.analyze_query(query)
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        matches = np.zeros(len(self.ids), dtype=np.int32)
+        for term in terms:
+            term_index = self.vocabulary.get(term)
+            if term_index is None:
+                continue
+            start, end = self.offsets[term_index], self.offsets[term_index + 1]
+            positions = self.postings[start:end]
+            scores[positions] += self.idf[term_index] * self.weights[start:end]
+            matches[positions] += 1
+        candidates = np.flatnonzero(matches)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [
+            (self.ids[i], float(scores[i]), bool(matches[i] == len(terms)))
+            for i in candidates
+        ]
+
+    def is_decisive(
+        self, query: str, hits: list, k: int, max_terms: int = 4, min_idf: float = 3.0
+    ) -> bool:
+        """
+        Whether the lexical hits can answer the query without dense retrieval:
+        a short keyword query (e.g. a course number or a name) with a selective
+        term, whose k best chunks all contain every term of the query
+        """
+        terms = self.analyze_query(query)
+        if not terms or len(terms) > max_terms or len(hits) < k:
+            return False
+        idfs = [
+            self.idf[self.vocabulary[term]] for term in terms if term in self.vocabulary
+        ]
+        if len(idfs) < len(terms) or max(idfs) < min_idf:
+            return False
+        return all(full_match for _, _, full_match in hits[:k])
+
+
+def get_documents(vectorstore, ids: List[str]) -> dict:
+    """
+    The documents of a FAISS or Chroma store with the given chunk ids, by id
+    """
+    if isinstance(vectorstore, FAISS):
+        docs = {_id: vectorstore.docstore.search(_id) for _id in ids}
+        return {_id: doc for _id, doc in docs.items() if isinstance(doc, Document)}
+    if isinstance(vectorstore, Chroma):
+        response = vectorstore._collection.get(
+            ids=list(ids), include=["documents", "metadatas"]
+        )
+        return {
+            _id: Document(page_content=text, metadata=metadata or {})
+            for _id, text, metadata in zip(
+                response["ids"], response["documents"], response["metadatas"]
+            )
+        }
+    return {}
+
+
+def get_store_texts(vectorstore):
+    """
+    Chunk ids and texts of a FAISS or Chroma store
+    """
+    if isinstance(vectorstore, FAISS):
+        ids = [_id for _, _id in sorted(vectorstore.index_to_docstore_id.items())]
+        return ids, [vectorstore.docstore.search(_id).page_content for _id in ids]
+    response = vectorstore._collection.get(include=["documents"])
+    return response["ids"], response["documents"]
+
+
+def document_key(doc: Document):
+    return (doc.page_content, doc.metadata.get("source"), doc.metadata.get("page"))
+
+
+def reciprocal_rank_fusion(rankings: List[list], k: int, rrf_k: int = 60) -> list:
+    """
+    Fuses rankings of documents into the k best (document, fused score)
+    """
+    scores, docs = {}, {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = document_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+            docs.setdefault(key, doc)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [(docs[key], scores[key]) for key in best]
+
+
+class RetrievalStats:
+    """
+    Process-wide counters of the retrieval paths: dense only, hybrid (lexical
+    and dense, fused), lexical only (the fast path), and catalog lookups that
+    found a course (its record is added to the results of the other paths)
+    """
+
+    PATHS = ["dense", "hybrid", "lexical", "catalog"]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = {path: 0 for path in self.PATHS}
+        self.total_time = {path: 0.0 for path in self.PATHS}
+        self.lexical_queries = 0
+        self.lexical_hits = 0
+
+    def record(self, path: str, elapsed: float, lexical_hit: bool = None):
+        with self._lock:
+            self.queries[path] += 1
+            self.total_time[path] += elapsed
+            if lexical_hit is not None:
+                self.lexical_queries += 1
+                self.lexical_hits += int(lexical_hit)
+
+    def stats(self):
+        with self._lock:
+            total = sum(self.queries[path] for path in self.PATHS if path != "catalog")
+            return {
+                **{
+                    path: {
+                        "queries": self.queries[path],
+                        "avg_ms": (
+                            round(1000 * self.total_time[path] / self.queries[path], 2)
+                            if self.queries[path]
+                            else None
+                        ),
+                    }
+                    for path in self.PATHS
+                },
+                "lexical_hit_rate": (
+                    round(self.lexical_hits / self.lexical_queries, 3)
+                    if self.lexical_queries
+                    else 0.0
+                ),
+                "fast_path_rate": (
+                    round(self.queries["lexical"] / total, 3) if total else 0.0
+                ),
+            }
+
+
+retrieval_stats = RetrievalStats()
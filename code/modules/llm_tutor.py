@@ -7,12 +7,26 @@ from langchain.chains import RetrievalQA, ConversationalRetrievalChain
 from langchain.llms import CTransformers
 from langchain.memory import ConversationBufferWindowMemory
 from langchain.chains.conversational_retrieval.prompts import QA_PROMPT
+import copy
+import logging
 import os
 from modules.constants import *
 from modules.helpers import get_prompt
-from modules.chat_model_loader import ChatModelLoader
+from modules.model_registry import model_registry
+from modules.streaming import ANSWER_TAG
+from modules.answer_cache import SemanticAnswerCache
+from modules.catalog import CourseCatalog, get_catalog_path
+from modules.condensation import (
+    CondenseCache,
+    CondensingConversationalRetrievalChain,
+)
+from modules.context_packing import ContextPacker, pack_chain
+from modules.generation_control import get_generation_options
+from modules.reranker import load_reranker
 from modules.vector_db import VectorDB, VectorDBScore
 
+logger = logging.getLogger(__name__)
+
 
 class LLMTutor:
     def __init__(self, config, logger=None):
@@ -21,6 +35,16 @@ class LLMTutor:
         if self.config["embedding_options"]["embedd_files"]:
             self.vector_db.create_database()
             self.vector_db.save_database()
+            # sessions started after a rebuild must not get the stale shared index
+            model_registry.invalidate("vector_db", self.db_key())
+            model_registry.invalidate("lexical_index", self.db_key())
+
+    def db_key(self):
+        return (
+            self.config["embedding_options"]["db_option"],
+            self.config["embedding_options"]["db_path"],
+            self.config["embedding_options"]["model"],
+        )
 
     def set_custom_prompt(self):
         """
@@ -36,9 +60,15 @@ class LLMTutor:
         if self.config["embedding_options"]["db_option"] in ["FAISS", "Chroma"]:
             retriever = VectorDBScore(
                 vectorstore=db,
+                retrieval_options={
+                    "lambda_mult": self.config["embedding_options"]["lambda_mult"],
+                    **self.config["embedding_options"].get("retrieval", {}),
+                },
+                lexical_index=self.load_lexical_index(),
+                catalog=self.load_catalog(),
+                reranker=self.reranker,
                 # search_kwargs={
                 #     "k": self.config["embedding_options"]["search_top_k"],
-                #     "lambda_mult": self.config["embedding_options"]["lambda_mult"],
                 # },
             )
         elif self.config["embedding_options"]["db_option"] == "RAGatouille":
@@ -52,13 +82,31 @@ class LLMTutor:
                 return_messages=True,
                 output_key="answer",
             )
-            qa_chain = ConversationalRetrievalChain.from_llm(
+            condense_options = self.config["llm_params"].get("condense", {})
+            condense_mode = condense_options.get("mode", "llm")
+            if condense_mode == "embedding" and not isinstance(
+                retriever, VectorDBScore
+            ):
+                logger.warning(
+                    "Embedding condensation needs a FAISS or Chroma database, "
+                    "follow-up questions are not condensed"
+                )
+                condense_mode = "none"
+            qa_chain = CondensingConversationalRetrievalChain.from_llm(
                 llm=llm,
                 chain_type="stuff",
                 retriever=retriever,
                 return_source_documents=True,
                 memory=memory,
                 combine_docs_chain_kwargs={"prompt": prompt},
+                condense_question_llm=self.load_condense_llm(),
+                condense_mode=condense_mode,
+                history_turns=condense_options.get("history_turns", 2),
+                history_weight=condense_options.get("history_weight", 0.3),
+                embedding_model=getattr(db, "embeddings", None),
+                condense_cache=self.load_condense_cache(),
+                parallel_retrieval=condense_options.get("parallel_retrieval", False),
+                reuse_similarity=condense_options.get("reuse_similarity", 0.8),
             )
         else:
             qa_chain = RetrievalQA.from_chain_type(
@@ -68,18 +116,141 @@ class LLMTutor:
                 return_source_documents=True,
                 chain_type_kwargs={"prompt": prompt},
             )
+        # Fit the stuffed documents and history in the context window
+        if self.context_packer is not None:
+            if self.config["llm_params"]["use_history"]:
+                qa_chain.combine_docs_chain = pack_chain(
+                    qa_chain.combine_docs_chain, self.context_packer
+                )
+            else:
+                qa_chain.combine_documents_chain = pack_chain(
+                    qa_chain.combine_documents_chain, self.context_packer
+                )
+        # Mark the answer generation, so only its tokens are streamed to the user
+        if self.config["llm_params"]["use_history"]:
+            qa_chain.combine_docs_chain.llm_chain.tags = [ANSWER_TAG]
+        else:
+            qa_chain.combine_documents_chain.llm_chain.tags = [ANSWER_TAG]
         return qa_chain
 
-    # Loading the model
+    # Loading the model (shared across sessions)
     def load_llm(self):
-        chat_model_loader = ChatModelLoader(self.config)
-        llm = chat_model_loader.load_chat_model()
+        llm = model_registry.get_llm(self.config)
         return llm
 
+    def get_llm_name(self):
+        if self.config["llm_params"]["llm_loader"] == "openai":
+            return self.config["llm_params"]["openai_params"]["model"]
+        return self.config["llm_params"]["local_llm_params"]["model"]
+
+    # BM25 index of the database for hybrid retrieval (shared across sessions)
+    def load_lexical_index(self):
+        retrieval_options = self.config["embedding_options"].get("retrieval", {})
+        if retrieval_options.get("mode", "dense") != "hybrid":
+            return None
+        return model_registry.get_or_load(
+            "lexical_index", self.db_key(), self.vector_db.load_lexical_index
+        )
+
+    # Course catalog for exact course lookups (shared across sessions)
+    def load_catalog(self):
+        catalog_path = get_catalog_path(self.config)
+        if catalog_path is None or not os.path.exists(catalog_path):
+            return None
+        return model_registry.get_or_load(
+            "catalog", (catalog_path,), lambda: CourseCatalog.load(catalog_path)
+        )
+
+    # Second-stage reranker of the retrieved chunks (shared across sessions)
+    def load_reranker(self):
+        rerank_options = self.config["embedding_options"].get("rerank", {})
+        if not rerank_options.get("enabled", False):
+            return None
+        return model_registry.get_or_load(
+            "reranker",
+            (rerank_options.get("type", "colbert"), rerank_options["model"]),
+            lambda: load_reranker(rerank_options),
+        )
+
+    # Smaller model for the question rewrite, None to use the chat model
+    def load_condense_llm(self):
+        model = self.config["llm_params"].get("condense", {}).get("llm")
+        if model is None:
+            return None
+        config = copy.deepcopy(self.config)
+        config["llm_params"].pop("chat_profile", None)
+        if model.endswith(".gguf"):
+            config["llm_params"]["llm_loader"] = "local_llm"
+            config["llm_params"]["local_llm_params"]["model"] = model
+        else:
+            config["llm_params"]["llm_loader"] = "openai"
+            config["llm_params"]["openai_params"]["model"] = model
+        return model_registry.get_llm(config)
+
+    # Cache of the question rewrites (shared across sessions)
+    def load_condense_cache(self):
+        condense_options = self.config["llm_params"].get("condense", {})
+        if condense_options.get("mode", "llm") != "llm":
+            return None
+        model = condense_options.get("llm") or self.get_llm_name()
+        return model_registry.get_or_load(
+            "condense_cache",
+            (model,),
+            lambda: CondenseCache(condense_options.get("cache_size", 1000)),
+        )
+
+    # Packs the prompt of each session's chain, tokens are counted with the
+    # tokenizer of the llm
+    def load_context_packer(self, llm):
+        packing_options = self.config["llm_params"].get("context_packing", {})
+        if not packing_options.get("enabled", False):
+            return None
+        context_window = packing_options.get("context_window")
+        if context_window is None:
+            if self.config["llm_params"]["llm_loader"] == "openai":
+                context_window = 8192
+            else:
+                context_window = self.config["llm_params"]["local_llm_params"].get(
+                    "n_ctx", 2048
+                )
+        return ContextPacker(
+            llm.get_num_tokens,
+            context_window=context_window,
+            max_answer_tokens=get_generation_options(self.config)["max_tokens"],
+            max_history_tokens=packing_options.get("max_history_tokens", 256),
+            max_chunk_tokens=packing_options.get("max_chunk_tokens", 200),
+            min_chunk_tokens=packing_options.get("min_chunk_tokens", 32),
+        )
+
+    # Cache of answers to repeated questions (shared across sessions)
+    def load_answer_cache(self):
+        cache_options = self.config["llm_params"].get("answer_cache", {})
+        if not cache_options.get("enabled", False):
+            return None
+        return model_registry.get_or_load(
+            "answer_cache",
+            (cache_options["cache_path"], self.config["embedding_options"]["model"]),
+            lambda: SemanticAnswerCache(
+                cache_options["cache_path"],
+                model_registry.get_embedding_model(self.config),
+                similarity_threshold=cache_options["similarity_threshold"],
+                ttl=cache_options["ttl"],
+                max_entries=cache_options["max_entries"],
+            ),
+        )
+
     # QA Model Function
+    # The vector db and llm are loaded once per process, only the chain and its
+    # memory are created per session
     def qa_bot(self):
-        db = self.vector_db.load_database()
+        db = model_registry.get_or_load(
+            "vector_db", self.db_key(), self.vector_db.load_database
+        )
         self.llm = self.load_llm()
+        self.answer_cache = self.load_answer_cache()
+        self.reranker = self.load_reranker()
+        self.context_packer = self.load_context_packer(self.llm)
+        self.index_version = self.vector_db.get_index_version()
         qa_prompt = self.set_custom_prompt()
         qa = self.retrieval_qa_chain(self.llm, qa_prompt, db)
 
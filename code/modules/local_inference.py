@@ -0,0 +1,381 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.llms import LLM
+from llama_cpp import Llama
+
+try:
+    from modules.generation_control import RepetitionDetector, generation_stats
+except:
+    from generation_control import RepetitionDetector, generation_stats
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceUnavailable(RuntimeError):
+    pass
+
+
+class InferenceQueueFull(InferenceUnavailable):
+    pass
+
+
+class InferenceTimeout(InferenceUnavailable):
+    pass
+
+
+class LocalInferenceService:
+    """
+    Serves a local gguf model with n_instances llama.cpp instances. Requests
+    wait (first come, first served) for a free instance; at most max_queue_depth
+    requests may wait, and for at most max_wait_time seconds, so that
+    concurrent users get a bounded latency or a clear error instead of a
+    frozen server.
+
+    When given the static prefix of the prompt template, the service evaluates
+    it once, saves the llama.cpp state after it and restores that state for the
+    requests whose prompt starts with it, so that only the rest of the prompt
+    (context, history and question) is evaluated per request.
+    """
+
+    def __init__(self, local_llm_params: dict, prompt_prefix: str = None):
+        self.model_path = local_llm_params["model"]
+        self.n_instances = local_llm_params.get("n_instances", 1)
+        self.n_threads = local_llm_params.get("n_threads") or max(
+            1, (os.cpu_count() or 1) // self.n_instances
+        )
+        self.n_ctx = local_llm_params.get("n_ctx", 2048)
+        self.n_batch = local_llm_params.get("n_batch", 512)
+        self.max_queue_depth = local_llm_params.get("max_queue_depth", 8)
+        self.max_wait_time = local_llm_params.get("max_wait_time", 60)
+
+        instances = [
+            Llama(
+                model_path=self.model_path,
+                n_ctx=self.n_ctx,
+                n_batch=self.n_batch,
+                n_threads=self.n_threads,
+                f16_kv=True,
+                verbose=True,
+            )
+            for _ in range(self.n_instances)
+        ]
+        self.prompt_prefix = None
+        self.prefix_tokens = []
+        self.prefix_state = None
+        self.prefix_eval_time = 0.0
+        if prompt_prefix and local_llm_params.get("prefix_cache", True):
+            self.cache_prefix(instances, prompt_prefix)
+        # Tokenizing only reads the vocabulary, any instance can count tokens
+        self.tokenizer = instances[0]
+        self.free_instances = queue.Queue()
+        for instance in instances:
+            self.free_instances.put(instance)
+        # One thread per admitted request, waiting happens on free_instances
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.n_instances + self.max_queue_depth
+        )
+
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_queue_depth = 0
+        self.num_requests = 0
+        self.num_rejected = 0
+        self.num_timed_out = 0
+        self.total_wait_time = 0.0
+        self.peak_wait_time = 0.0
+        self.num_prefix_hits = 0
+        self.num_prefix_restores = 0
+        self.total_restore_time = 0.0
+        self.total_prefill_time_saved = 0.0
+        logger.info(
+            f"Local inference service: {self.n_instances} x {self.model_path} "
+            f"({self.n_threads} threads, n_ctx={self.n_ctx})"
+        )
+
+    def cache_prefix(self, instances: list, prompt_prefix: str):
+        """
+        Evaluates the prompt prefix on the first instance and copies the state
+        (kv cache and tokens) to the others
+        """
+        self.prompt_prefix = prompt_prefix
+        # Tokenized the way create_completion tokenizes the prompts
+        self.prefix_tokens = instances[0].tokenize(
+            prompt_prefix.encode("utf-8"), special=True
+        )
+        start = time.perf_counter()
+        instances[0].reset()
+        instances[0].eval(self.prefix_tokens)
+        self.prefix_eval_time = time.perf_counter() - start
+        self.prefix_state = instances[0].save_state()
+        for instance in instances[1:]:
+            instance.load_state(self.prefix_state)
+        logger.info(
+            f"Cached the prompt prefix: {len(self.prefix_tokens)} tokens, "
+            f"evaluated in {self.prefix_eval_time:.2f}s"
+        )
+
+    def restore_prefix(self, instance, prompt: str):
+        """
+        Makes sure the instance starts from the prompt prefix and returns the
+        prefill time saved, None if the prompt does not start with the prefix.
+        llama.cpp already reuses the common prefix of consecutive prompts, the
+        state only needs restoring after another prompt (e.g. the one that
+        condenses the question) was evaluated on the instance.
+        """
+        if self.prefix_state is None or not prompt.startswith(self.prompt_prefix):
+            return None
+        num_tokens = len(self.prefix_tokens)
+        restore_time = 0.0
+        if (
+            instance.n_tokens < num_tokens
+            or instance.input_ids[:num_tokens].tolist() != self.prefix_tokens
+        ):
+            start = time.perf_counter()
+            instance.load_state(self.prefix_state)
+            restore_time = time.perf_counter() - start
+        saved = self.prefix_eval_time - restore_time
+        with self._lock:
+            if restore_time:
+                self.num_prefix_restores += 1
+                self.total_restore_time += restore_time
+            else:
+                self.num_prefix_hits += 1
+            self.total_prefill_time_saved += saved
+        logger.info(
+            f"Prompt prefix reused ({num_tokens} tokens, "
+            f"{'restored' if restore_time else 'in the kv cache'}), "
+            f"{1000 * saved:.0f} ms of prefill saved"
+        )
+        return saved
+
+    def count_tokens(self, text: str) -> int:
+        return len(
+            self.tokenizer.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+        )
+
+    def admit(self):
+        """
+        Admission control: a request is rejected right away when
+        max_queue_depth requests are already waiting for an instance
+        """
+        with self._lock:
+            if self.in_flight >= self.n_instances + self.max_queue_depth:
+                self.num_rejected += 1
+                raise InferenceQueueFull(
+                    f"{self.max_queue_depth} requests are already waiting for the model"
+                )
+            self.in_flight += 1
+            queue_depth = max(0, self.in_flight - self.n_instances)
+            self.peak_queue_depth = max(self.peak_queue_depth, queue_depth)
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def acquire_instance(self):
+        start = time.perf_counter()
+        try:
+            instance = self.free_instances.get(timeout=self.max_wait_time)
+        except queue.Empty:
+            with self._lock:
+                self.num_timed_out += 1
+            raise InferenceTimeout(
+                f"No model instance became free within {self.max_wait_time}s"
+            )
+        wait_time = time.perf_counter() - start
+        with self._lock:
+            self.num_requests += 1
+            self.total_wait_time += wait_time
+            self.peak_wait_time = max(self.peak_wait_time, wait_time)
+        return instance
+
+    def run_generation(
+        self,
+        prompt: str,
+        stop=None,
+        on_token=None,
+        repetition: RepetitionDetector = None,
+        profile: str = None,
+        **params,
+    ) -> str:
+        """
+        Streams the completion of the prompt, stopped early when repetition
+        detects a loop, and records the generated tokens for the profile
+        """
+        try:
+            instance = self.acquire_instance()
+            try:
+                self.restore_prefix(instance, prompt)
+                text = ""
+                num_tokens = 0
+                finish_reason = None
+                completion = instance.create_completion(
+                    prompt, stop=stop, stream=True, **params
+                )
+                for chunk in completion:
+                    token = chunk["choices"][0]["text"]
+                    finish_reason = chunk["choices"][0].get("finish_reason")
+                    if not token:
+                        continue
+                    num_tokens += 1
+                    text += token
+                    if on_token is not None:
+                        on_token(token)
+                    if repetition is not None and repetition.add(token):
+                        finish_reason = "repetition"
+                        completion.close()
+                        break
+                generation_stats.record(
+                    profile,
+                    num_tokens,
+                    repetition.wasted_tokens if repetition is not None else 0,
+                    finish_reason,
+                )
+                return text
+            finally:
+                self.free_instances.put(instance)
+        finally:
+            self.release()
+
+    def generate(self, prompt: str, stop=None, on_token=None, **params) -> str:
+        """
+        Blocking generation, on_token is called with every generated token
+        """
+        self.admit()
+        return self.run_generation(prompt, stop=stop, on_token=on_token, **params)
+
+    async def agenerate(self, prompt: str, stop=None, on_token=None, **params) -> str:
+        """
+        Runs the generation on the service's threads, on_token is awaited with
+        every generated token on the calling event loop
+        """
+        self.admit()
+        loop = asyncio.get_running_loop()
+        tokens = asyncio.Queue()
+        generation = loop.run_in_executor(
+            self.executor,
+            partial(
+                self.run_generation,
+                prompt,
+                stop=stop,
+                on_token=lambda token: loop.call_soon_threadsafe(
+                    tokens.put_nowait, token
+                ),
+                **params,
+            ),
+        )
+        while True:
+            next_token = asyncio.ensure_future(tokens.get())
+            done, _ = await asyncio.wait(
+                {next_token, generation}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if next_token in done:
+                if on_token is not None:
+                    await on_token(next_token.result())
+                continue
+            next_token.cancel()
+            await asyncio.sleep(0)
+            while not tokens.empty() and on_token is not None:
+                await on_token(tokens.get_nowait())
+            return await generation
+
+    def prefix_stats(self):
+        num_reused = self.num_prefix_hits + self.num_prefix_restores
+        return {
+            "prefix_tokens": len(self.prefix_tokens),
+            "prefix_eval_time": self.prefix_eval_time,
+            "hits": self.num_prefix_hits,
+            "restores": self.num_prefix_restores,
+            "avg_restore_time": self.total_restore_time
+            / max(self.num_prefix_restores, 1),
+            "prefill_time_saved": self.total_prefill_time_saved,
+            "avg_prefill_time_saved": self.total_prefill_time_saved
+            / max(num_reused, 1),
+        }
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "queue_depth": max(0, self.in_flight - self.n_instances),
+                "peak_queue_depth": self.peak_queue_depth,
+                "requests": self.num_requests,
+                "rejected": self.num_rejected,
+                "timed_out": self.num_timed_out,
+                "avg_wait_time": self.total_wait_time / max(self.num_requests, 1),
+                "peak_wait_time": self.peak_wait_time,
+            }
+            if self.prefix_state is not None:
+                stats["prefix_cache"] = self.prefix_stats()
+            return stats
+
+
+class LocalLLM(LLM):
+    """
+    LangChain LLM backed by a LocalInferenceService
+    """
+
+    service: Any
+    temperature: float = 0.8
+    max_tokens: int = 256
+    stop: List[str] = []
+    profile: Optional[str] = None
+    repetition_ngram_size: int = 0
+    max_repeats: int = 3
+
+    @property
+    def _llm_type(self) -> str:
+        return "local_inference_service"
+
+    def get_num_tokens(self, text: str) -> int:
+        return self.service.count_tokens(text)
+
+    def generation_params(self, stop: Optional[List[str]]) -> dict:
+        return dict(
+            stop=self.stop + [s for s in stop or [] if s not in self.stop],
+            repetition=(
+                RepetitionDetector(self.repetition_ngram_size, self.max_repeats)
+                if self.repetition_ngram_size
+                else None
+            ),
+            profile=self.profile,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+        )
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return self.service.generate(
+            prompt,
+            on_token=run_manager.on_llm_new_token if run_manager else None,
+            **self.generation_params(stop),
+        )
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return await self.service.agenerate(
+            prompt,
+            on_token=run_manager.on_llm_new_token if run_manager else None,
+            **self.generation_params(stop),
+        )
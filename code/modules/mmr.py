@@ -0,0 +1,124 @@
+import threading
+import time
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS, Chroma
+from langchain.schema.document import Document
+
+_direct_map_lock = threading.Lock()
+
+
+def mmr_select(query_vector, vectors, k: int, lambda_mult: float = 0.5) -> list:
+    """
+    Maximal marginal relevance: indices of k of the vectors, each picked for
+    its similarity to the query minus its similarity to the ones already picked.
+    All the cosine similarities are computed in one matrix product.
+    """
+    if len(vectors) == 0:
+        return []
+    vectors = vectors / np.maximum(
+        np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12
+    )
+    query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+    query_similarity = vectors @ query_vector
+    similarity = vectors @ vectors.T
+
+    selected = [int(np.argmax(query_similarity))]
+    max_similarity = similarity[selected[0]].copy()
+    for _ in range(1, min(k, len(vectors))):
+        scores = lambda_mult * query_similarity - (1 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return selected
+
+
+def reconstruct_vectors(index, positions) -> np.ndarray:
+    """
+    The stored vectors at the given positions of a FAISS index, in one call.
+    IVF indexes need a direct map (position -> inverted list) to reconstruct,
+    it is built the first time.
+    """
+    if isinstance(index, faiss.IndexIVF):
+        with _direct_map_lock:
+            if index.direct_map.type == faiss.DirectMap.NoMap:
+                index.make_direct_map()
+    return index.reconstruct_batch(np.asarray(positions, dtype=np.int64))
+
+
+def mmr_search_faiss(vectorstore: FAISS, query_vector, k, fetch_k, lambda_mult):
+    relevance_score_fn = vectorstore._select_relevance_score_fn()
+    query = np.array([query_vector], dtype=np.float32)
+    if vectorstore._normalize_L2:
+        faiss.normalize_L2(query)
+    scores, indices = vectorstore.index.search(query, fetch_k)
+    keep = indices[0] != -1
+    scores, indices = scores[0][keep], indices[0][keep]
+    start = time.perf_counter()
+    vectors = reconstruct_vectors(vectorstore.index, indices)
+    selected = mmr_select(query[0], vectors, k, lambda_mult)
+    mmr_time = time.perf_counter() - start
+    results = []
+    for i in selected:
+        doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[indices[i]])
+        results.append((doc, relevance_score_fn(float(scores[i]))))
+    return results, mmr_time
+
+
+def mmr_search_chroma(vectorstore: Chroma, query_vector, k, fetch_k, lambda_mult):
+    relevance_score_fn = vectorstore._select_relevance_score_fn()
+    response = vectorstore._collection.query(
+        query_embeddings=[list(query_vector)],
+        n_results=fetch_k,
+        include=["documents", "metadatas", "distances", "embeddings"],
+    )
+    start = time.perf_counter()
+    vectors = np.array(response["embeddings"][0], dtype=np.float32)
+    selected = mmr_select(
+        np.asarray(query_vector, dtype=np.float32), vectors, k, lambda_mult
+    )
+    mmr_time = time.perf_counter() - start
+    texts, metadatas = response["documents"][0], response["metadatas"][0]
+    distances = response["distances"][0]
+    return [
+        (
+            Document(page_content=texts[i], metadata=metadatas[i] or {}),
+            relevance_score_fn(distances[i]),
+        )
+        for i in selected
+    ], mmr_time
+
+
+def mmr_search(
+    vectorstore,
+    query: str,
+    k: int,
+    fetch_k: int,
+    lambda_mult: float,
+    query_vector=None,
+):
+    """
+    The k (document, relevance score) picked by MMR among the fetch_k nearest
+    chunks, from their stored vectors (the candidates are not embedded again),
+    and the timings. The query is embedded unless its vector is given.
+    """
+    start = time.perf_counter()
+    if query_vector is None:
+        query_vector = vectorstore.embeddings.embed_query(query)
+    embedded = time.perf_counter()
+    fetch_k = max(fetch_k, k)
+    if isinstance(vectorstore, FAISS):
+        results, mmr_time = mmr_search_faiss(
+            vectorstore, query_vector, k, fetch_k, lambda_mult
+        )
+    else:
+        results, mmr_time = mmr_search_chroma(
+            vectorstore, query_vector, k, fetch_k, lambda_mult
+        )
+    return results, {
+        "retrieval_embed_time": embedded - start,
+        "retrieval_search_time": time.perf_counter() - embedded - mmr_time,
+        "mmr_time": mmr_time,
+    }
@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+import time
+
+try:
+    from modules.embedding_model_loader import EmbeddingModelLoader
+    from modules.chat_model_loader import ChatModelLoader
+    from modules.generation_control import get_generation_options
+except:
+    from embedding_model_loader import EmbeddingModelLoader
+    from chat_model_loader import ChatModelLoader
+    from generation_control import get_generation_options
+
+logger = logging.getLogger(__name__)
+
+
+def get_rss_bytes():
+    """
+    Resident set size of the current process, in bytes
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        # ru_maxrss is the peak (not current) rss, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RegistryEntry:
+    def __init__(self, key, value, load_time, rss_delta):
+        self.key = key
+        self.value = value
+        self.load_time = load_time
+        self.rss_delta = rss_delta
+        self.hits = 0
+
+    def stats(self):
+        return {
+            "key": self.key,
+            "load_time_s": round(self.load_time, 3),
+            "rss_mb": round(self.rss_delta / (1024 * 1024), 1),
+            "hits": self.hits,
+        }
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of the heavy objects (embedding models, vector stores, LLMs).
+    Each entry is loaded once and then shared by every chat session; sessions only
+    keep their own lightweight state (memory, chain).
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def get_or_load(self, kind, key, loader):
+        full_key = (kind,) + tuple(key)
+        with self._lock:
+            entry = self._entries.get(full_key)
+            if entry is not None:
+                entry.hits += 1
+                return entry.value
+            key_lock = self._key_locks.setdefault(full_key, threading.Lock())
+
+        # Loading happens outside the registry lock, so that different entries can
+        # load in parallel while concurrent requests for the same entry wait here
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(full_key)
+            if entry is None:
+                rss_before = get_rss_bytes()
+                start = time.perf_counter()
+                value = loader()
+                entry = RegistryEntry(
+                    full_key,
+                    value,
+                    time.perf_counter() - start,
+                    get_rss_bytes() - rss_before,
+                )
+                with self._lock:
+                    self._entries[full_key] = entry
+                logger.info(f"Loaded {full_key}: {entry.stats()}")
+            else:
+                entry.hits += 1
+        return entry.value
+
+    def get_embedding_model(self, config):
+        key = (config["embedding_options"]["model"],)
+        return self.get_or_load(
+            "embedding_model",
+            key,
+            lambda: EmbeddingModelLoader(config).load_embedding_model(),
+        )
+
+    def get_local_service(self, config):
+        # Only what the llama.cpp instances are loaded with, every profile and
+        # temperature shares the weights
+        local_llm_params = config["llm_params"]["local_llm_params"]
+        key = (
+            local_llm_params["model"],
+            local_llm_params.get("n_ctx", 2048),
+            local_llm_params.get("n_threads"),
+        )
+        return self.get_or_load(
+            "local_inference",
+            key,
+            lambda: ChatModelLoader(config).load_local_service(),
+        )
+
+    def get_llm(self, config):
+        llm_params = config["llm_params"]
+        if llm_params["llm_loader"] == "openai":
+            profile = get_generation_options(config)["profile"]
+            key = ("openai", llm_params["openai_params"]["model"], profile)
+            return self.get_or_load(
+                "llm", key, lambda: ChatModelLoader(config).load_chat_model()
+            )
+        if llm_params["llm_loader"] == "local_llm":
+            # The per-profile generation options live on a wrapper of the service
+            return ChatModelLoader(config).load_chat_model(
+                self.get_local_service(config)
+            )
+        return ChatModelLoader(config).load_chat_model()
+
+    def invalidate(self, kind, key=None):
+        with self._lock:
+            for full_key in list(self._entries):
+                if full_key[0] == kind and (key is None or full_key[1:] == tuple(key)):
+                    del self._entries[full_key]
+
+    def stats(self):
+        with self._lock:
+            return [entry.stats() for entry in self._entries.values()]
+
+
+model_registry = ModelRegistry()
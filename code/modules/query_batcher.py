@@ -0,0 +1,178 @@
+import asyncio
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain_community.embeddings import HuggingFaceEmbeddings, OpenAIEmbeddings
+from langchain_community.vectorstores import FAISS, Chroma
+from langchain.schema.document import Document
+
+try:
+    from modules.embedding_cache import CachedEmbeddings
+except:
+    from embedding_cache import CachedEmbeddings
+
+# Embedding models whose embed_query is embed_documents([query])[0]
+QUERY_AS_DOCUMENT_MODELS = (HuggingFaceEmbeddings, OpenAIEmbeddings)
+
+
+class QueryBatcher:
+    """
+    Async retrieval for a FAISS or Chroma vector store. Queries that arrive
+    within max_wait_ms of each other (or up to max_batch_size of them) are
+    embedded in a single call and searched in a single batched index search,
+    on a small thread pool so that the event loop is never blocked.
+    """
+
+    def __init__(self, vectorstore, max_batch_size=16, max_wait_ms=5, max_workers=2):
+        self.vectorstore = vectorstore
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = []
+
+    async def search(self, query: str, k: int = 4, score_threshold: float = None):
+        """
+        Returns a list of (document, relevance score) and the per-stage timings
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((query, k, future, time.perf_counter()))
+        if len(self.pending) >= self.max_batch_size:
+            self.flush(loop)
+        elif len(self.pending) == 1:
+            loop.call_later(self.max_wait, self.flush, loop)
+        docs_and_scores, timings = await future
+        if score_threshold is not None:
+            docs_and_scores = [
+                (doc, score)
+                for doc, score in docs_and_scores
+                if score >= score_threshold
+            ]
+        return docs_and_scores, timings
+
+    def flush(self, loop):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        queries = [query for query, _, _, _ in batch]
+        k = max(k for _, k, _, _ in batch)
+        submitted = time.perf_counter()
+        task = loop.run_in_executor(self.executor, self.run_batch, queries, k)
+
+        def distribute(task):
+            if task.cancelled() or task.exception() is not None:
+                error = (
+                    asyncio.CancelledError() if task.cancelled() else task.exception()
+                )
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                return
+            results, timings = task.result()
+            for (_, k, future, enqueued), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(
+                        (
+                            result[:k],
+                            {
+                                "retrieval_queue_time": submitted - enqueued,
+                                "retrieval_batch_size": len(batch),
+                                **timings,
+                            },
+                        )
+                    )
+
+        task.add_done_callback(distribute)
+
+    def embed_queries(self, queries):
+        """
+        The same vectors as embed_query on each query (the sync path). Models
+        whose embed_query is embed_documents of one text embed the batch in one
+        call, the others (e.g. with a query instruction) one query at a time.
+        """
+        embedding_model = self.vectorstore.embeddings
+        if isinstance(embedding_model, CachedEmbeddings):
+            # The cache holds document vectors, and its embed_query is not
+            # cached either: a query vector may differ from the document
+            # vector of the same text
+            embedding_model = embedding_model.embedding_model
+        if type(embedding_model) in QUERY_AS_DOCUMENT_MODELS:
+            return embedding_model.embed_documents(queries)
+        return [embedding_model.embed_query(query) for query in queries]
+
+    def run_batch(self, queries, k):
+        start = time.perf_counter()
+        vectors = np.array(self.embed_queries(queries), dtype=np.float32)
+        embedded = time.perf_counter()
+        if isinstance(self.vectorstore, FAISS):
+            results = self.search_faiss(vectors, k)
+        else:
+            results = self.search_chroma(vectors, k)
+        timings = {
+            "retrieval_embed_time": embedded - start,
+            "retrieval_search_time": time.perf_counter() - embedded,
+        }
+        return results, timings
+
+    def search_faiss(self, vectors, k):
+        relevance_score_fn = self.vectorstore._select_relevance_score_fn()
+        if self.vectorstore._normalize_L2:
+            import faiss
+
+            faiss.normalize_L2(vectors)
+        scores, indices = self.vectorstore.index.search(vectors, k)
+        results = []
+        for row_scores, row_indices in zip(scores, indices):
+            docs_and_scores = []
+            for score, i in zip(row_scores, row_indices):
+                if i == -1:
+                    continue
+                doc = self.vectorstore.docstore.search(
+                    self.vectorstore.index_to_docstore_id[i]
+                )
+                docs_and_scores.append((doc, relevance_score_fn(float(score))))
+            results.append(docs_and_scores)
+        return results
+
+    def search_chroma(self, vectors, k):
+        relevance_score_fn = self.vectorstore._select_relevance_score_fn()
+        response = self.vectorstore._collection.query(
+            query_embeddings=vectors.tolist(),
+            n_results=k,
+            include=["documents", "metadatas", "distances"],
+        )
+        results = []
+        for texts, metadatas, distances in zip(
+            response["documents"], response["metadatas"], response["distances"]
+        ):
+            results.append(
+                [
+                    (
+                        Document(page_content=text, metadata=metadata or {}),
+                        relevance_score_fn(distance),
+                    )
+                    for text, metadata, distance in zip(texts, metadatas, distances)
+                ]
+            )
+        return results
+
+
+_query_batchers = weakref.WeakKeyDictionary()
+
+
+def get_query_batcher(vectorstore, options: dict):
+    """
+    One batcher per vector store, shared by all the sessions using it
+    """
+    if not isinstance(vectorstore, (FAISS, Chroma)):
+        return None
+    if vectorstore not in _query_batchers:
+        _query_batchers[vectorstore] = QueryBatcher(
+            vectorstore,
+            max_batch_size=options.get("max_batch_size", 16),
+            max_wait_ms=options.get("max_wait_ms", 5),
+            max_workers=options.get("max_workers", 2),
+        )
+    return _query_batchers[vectorstore]
@@ -0,0 +1,182 @@
+import hashlib
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List
+
+
+class Reranker(ABC):
+    """
+    Reranks the candidates of the first retrieval stage (dense, hybrid or
+    lexical) and keeps the best k.
+
+    Scores are cached per (query, chunk), so repeated questions only score the
+    chunks they did not see. Candidates are scored in batches of batch_size; if
+    the next batch would not fit in latency_budget_ms (estimated from the
+    previous batches), scoring stops and the first-stage ranking is kept.
+    """
+
+    def __init__(
+        self,
+        top_n: int = 20,
+        batch_size: int = 32,
+        latency_budget_ms: float = 500,
+        cache_size: int = 10000,
+    ):
+        self.top_n = top_n
+        self.batch_size = batch_size
+        self.latency_budget = latency_budget_ms / 1000
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.batch_time = None  # moving average of the time to score a batch
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.fallbacks = 0
+
+    @abstractmethod
+    def score_batch(self, query: str, texts: List[str]) -> List[float]:
+        """
+        Relevance scores of the texts for the query
+        """
+
+    def cache_key(self, query: str, text: str) -> str:
+        return hashlib.sha1(f"{query}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_cached(self, key):
+        with self._lock:
+            score = self.cache.get(key)
+            if score is not None:
+                self.cache.move_to_end(key)
+            return score
+
+    def put_cached(self, key, score: float):
+        with self._lock:
+            self.cache[key] = score
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def rerank(self, query: str, docs_and_scores: list, k: int):
+        """
+        The k best (document, score) of the candidates, and the rerank stats
+        """
+        start = time.perf_counter()
+        keys = [self.cache_key(query, doc.page_content) for doc, _ in docs_and_scores]
+        scores = [self.get_cached(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        num_cached = len(scores) - len(missing)
+
+        for batch_start in range(0, len(missing), self.batch_size):
+            elapsed = time.perf_counter() - start
+            if (
+                self.batch_time is not None
+                and elapsed + self.batch_time > self.latency_budget
+            ):
+                break
+            batch = missing[batch_start : batch_start + self.batch_size]
+            batch_start_time = time.perf_counter()
+            batch_scores = self.score_batch(
+                query, [docs_and_scores[i][0].page_content for i in batch]
+            )
+            batch_time = time.perf_counter() - batch_start_time
+            self.batch_time = (
+                batch_time
+                if self.batch_time is None
+                else 0.8 * self.batch_time + 0.2 * batch_time
+            )
+            for i, score in zip(batch, batch_scores):
+                scores[i] = float(score)
+                self.put_cached(keys[i], scores[i])
+
+        fallback = any(score is None for score in scores)
+        with self._lock:
+            self.calls += 1
+            self.fallbacks += int(fallback)
+        if fallback:
+            results = list(docs_and_scores[:k])
+        else:
+            order = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+            results = [(docs_and_scores[i][0], scores[i]) for i in order[:k]]
+        return results, {
+            "rerank_time": time.perf_counter() - start,
+            "rerank_candidates": len(docs_and_scores),
+            "rerank_cached": num_cached,
+            "rerank_fallback": fallback,
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "fallbacks": self.fallbacks,
+                "cache_entries": len(self.cache),
+            }
+
+
+class ColBERTReranker(Reranker):
+    """
+    Late-interaction scores of a ColBERT model (RAGatouille)
+    """
+
+    def __init__(self, model_name: str = "colbert-ir/colbertv2.0", **kwargs):
+        super().__init__(**kwargs)
+        from ragatouille import RAGPretrainedModel
+
+        self.model = RAGPretrainedModel.from_pretrained(model_name)
+        self._model_lock = threading.Lock()
+
+    def score_batch(self, query, texts):
+        with self._model_lock:
+            results = self.model.rerank(
+                query, texts, k=len(texts), bsize=self.batch_size
+            )
+        scores = [None] * len(texts)
+        for result in results:
+            scores[result["result_index"]] = result["score"]
+        return scores
+
+
+class CrossEncoderReranker(Reranker):
+    """
+    Relevance scores of a cross-encoder (a sequence classification model over
+    the query and the chunk), e.g. cross-encoder/ms-marco-MiniLM-L-6-v2
+    """
+
+    def __init__(
+        self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", **kwargs
+    ):
+        super().__init__(**kwargs)
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        self.model.eval()
+        self._model_lock = threading.Lock()
+
+    def score_batch(self, query, texts):
+        inputs = self.tokenizer(
+            [query] * len(texts),
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=512,
+            return_tensors="pt",
+        )
+        with self._model_lock, self.torch.no_grad():
+            logits = self.model(**inputs).logits
+        return logits[:, 0].tolist() if logits.dim() > 1 else logits.tolist()
+
+
+def load_reranker(options: dict) -> Reranker:
+    kwargs = dict(
+        top_n=options.get("top_n", 20),
+        batch_size=options.get("batch_size", 32),
+        latency_budget_ms=options.get("latency_budget_ms", 500),
+        cache_size=options.get("cache_size", 10000),
+    )
+    if options.get("type", "colbert") == "cross_encoder":
+        return CrossEncoderReranker(options["model"], **kwargs)
+    return ColBERTReranker(options["model"], **kwargs)
@@ -0,0 +1,237 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from typing import Union
+from uuid import uuid4
+
+import faiss
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain.schema.document import Document
+
+try:
+    from modules.faiss_index import read_index
+except:
+    from faiss_index import read_index
+
+DOCSTORE_FILE = "docstore.sqlite"
+STORE_VERSION_FILE = "store_version"
+BUILD_FILE_PATTERN = re.compile(r"(?:index|docstore)-([0-9a-f]{32})\.(?:faiss|sqlite)")
+DOCUMENT_COLUMNS = "page_content, source, page, metadata"
+
+
+class PositionalIds:
+    """
+    index_to_docstore_id of a FAISS store whose docstore is keyed by index
+    position: the id of the vector at position i of the index is i
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def __getitem__(self, i):
+        i = int(i)
+        if not 0 <= i < self.size:
+            raise KeyError(i)
+        return i
+
+    def get(self, i, default=None):
+        try:
+            return self[i]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(range(self.size))
+
+    def values(self):
+        return range(self.size)
+
+    def items(self):
+        return ((i, i) for i in range(self.size))
+
+
+class SQLiteDocstore(Docstore):
+    """
+    Read-only docstore over the documents table of a FAISS database, one row
+    per vector in index order: the text, the source and page in typed columns,
+    and the rest of the metadata as json. Opening it reads nothing, documents
+    are fetched by position (or chunk id) when they are retrieved. With
+    mmap_size, sqlite memory-maps the file, so processes serving the same
+    database share its pages.
+    """
+
+    def __init__(self, db_path: str, mmap_size: int = 0):
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(
+            f"file:{db_path}?mode=ro", uri=True, check_same_thread=False
+        )
+        if mmap_size:
+            self.db.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+
+    def __len__(self):
+        with self._lock:
+            # Positions are 0..n-1, the rowid b-tree gives the last one
+            last = self.db.execute("SELECT MAX(position) FROM documents").fetchone()[0]
+        return 0 if last is None else last + 1
+
+    def search(self, search: Union[int, str]) -> Union[str, Document]:
+        column = "id" if isinstance(search, str) else "position"
+        if column == "position":
+            search = int(search)
+        with self._lock:
+            row = self.db.execute(
+                f"SELECT {DOCUMENT_COLUMNS} FROM documents WHERE {column} = ?",
+                (search,),
+            ).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return row_to_document(row)
+
+
+def row_to_document(row) -> Document:
+    page_content, source, page, metadata = row
+    metadata = json.loads(metadata) if metadata else {}
+    if page is not None:
+        metadata = {"page": page, **metadata}
+    if source is not None:
+        metadata = {"source": source, **metadata}
+    return Document(page_content=page_content, metadata=metadata)
+
+
+def document_to_row(position: int, _id: str, doc: Document) -> tuple:
+    metadata = dict(doc.metadata)
+    source = metadata.pop("source", None)
+    page = metadata.pop("page", None)
+    return (
+        position,
+        _id,
+        doc.page_content,
+        source,
+        page,
+        json.dumps(metadata, default=str) if metadata else None,
+    )
+
+
+def get_store_files(path: str):
+    """
+    Paths of the index and the docstore of the current build, the ones the
+    store_version file names, or those of a store saved before it was written
+    """
+    version_path = os.path.join(path, STORE_VERSION_FILE)
+    if not os.path.exists(version_path):
+        return os.path.join(path, "index.faiss"), os.path.join(path, DOCSTORE_FILE)
+    with open(version_path, "r") as f:
+        build_id = f.read().strip()
+    return (
+        os.path.join(path, f"index-{build_id}.faiss"),
+        os.path.join(path, f"docstore-{build_id}.sqlite"),
+    )
+
+
+def remove_old_builds(path: str, keep: set, keep_unversioned: bool = False):
+    """
+    Removes the files of the builds not in keep, and unless keep_unversioned,
+    those of the unversioned layout (and the index.pkl of FAISS.save_local)
+    """
+    for name in os.listdir(path):
+        match = BUILD_FILE_PATTERN.fullmatch(name)
+        if match is not None and match.group(1) not in keep:
+            os.remove(os.path.join(path, name))
+    if keep_unversioned:
+        return
+    for name in ["index.faiss", DOCSTORE_FILE, "index.pkl"]:
+        if os.path.exists(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
+
+
+def save_faiss_store(path: str, vector_db: FAISS):
+    """
+    Writes the index, and the documents in index order, replacing the
+    index.pkl of FAISS.save_local.
+
+    Every save is a new build: both files are written under a new build id,
+    and the store_version file that names the current build is swapped in
+    with one os.replace, so a process loading the store never pairs the index
+    of one build with the documents of another. The previous build is kept
+    for the processes that read the version just before it changed.
+    """
+    os.makedirs(path, exist_ok=True)
+    previous_index_path, _ = get_store_files(path)
+    previous_build = BUILD_FILE_PATTERN.fullmatch(os.path.basename(previous_index_path))
+    build_id = uuid4().hex
+    faiss.write_index(vector_db.index, os.path.join(path, f"index-{build_id}.faiss"))
+    db = sqlite3.connect(os.path.join(path, f"docstore-{build_id}.sqlite"))
+    db.execute(
+        "CREATE TABLE documents (position INTEGER PRIMARY KEY, id TEXT UNIQUE, "
+        "page_content TEXT, source TEXT, page INTEGER, metadata TEXT)"
+    )
+    db.executemany(
+        "INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            document_to_row(
+                i, _id, vector_db.docstore.search(vector_db.index_to_docstore_id[i])
+            )
+            for i, _id in sorted(vector_db.index_to_docstore_id.items())
+        ),
+    )
+    db.commit()
+    db.close()
+    version_path = os.path.join(path, STORE_VERSION_FILE)
+    with open(version_path + ".tmp", "w") as f:
+        f.write(build_id)
+    os.replace(version_path + ".tmp", version_path)
+    if previous_build is None:
+        remove_old_builds(path, {build_id}, keep_unversioned=True)
+    else:
+        remove_old_builds(path, {build_id, previous_build.group(1)})
+
+
+def docstore_exists(path: str) -> bool:
+    return os.path.exists(get_store_files(path)[1])
+
+
+def faiss_store_exists(path: str) -> bool:
+    return os.path.exists(get_store_files(path)[0])
+
+
+def load_faiss_store(
+    path: str,
+    embedding_model,
+    read_only: bool = True,
+    mmap: bool = False,
+    index_type: str = "Flat",
+) -> FAISS:
+    """
+    Loads a FAISS database saved by save_faiss_store, without unpickling.
+
+    read_only stores fetch their documents from the sqlite file when they are
+    retrieved; with mmap, the index is memory-mapped too. Otherwise (to add to
+    or delete from the database) the documents are read into an
+    InMemoryDocstore.
+    """
+    index_path, db_path = get_store_files(path)
+    index = read_index(index_path, index_type, mmap=read_only and mmap)
+    if read_only:
+        docstore = SQLiteDocstore(db_path, mmap_size=2**40 if mmap else 0)
+        if len(docstore) != index.ntotal:
+            raise ValueError(
+                f"The docstore has {len(docstore)} documents, the index {index.ntotal}"
+            )
+        return FAISS(embedding_model, index, docstore, PositionalIds(index.ntotal))
+
+    documents, index_to_docstore_id = {}, {}
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    for row in db.execute(f"SELECT position, id, {DOCUMENT_COLUMNS} FROM documents"):
+        index_to_docstore_id[row[0]] = row[1]
+        documents[row[1]] = row_to_document(row[2:])
+    db.close()
+    return FAISS(
+        embedding_model, index, InMemoryDocstore(documents), index_to_docstore_id
+    )
@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Tag of the chain that generates the final answer (see LLMTutor.retrieval_qa_chain),
+# so that the tokens of the question condensing step are not streamed
+ANSWER_TAG = "final_answer"
+
+
+class AnswerStreamHandler(BaseCallbackHandler):
+    """
+    Forwards the tokens of the final answer to an asyncio queue, from whichever
+    thread the LLM runs in, and records time-to-first-token and tokens/sec.
+    """
+
+    # Called in the thread that emits the event, which keeps the tokens in order
+    run_inline = True
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.answer_chain_runs = set()
+        self.answer_llm_runs = set()
+        self.start_time = time.perf_counter()
+        self.llm_start_time = None
+        self.first_token_time = None
+        self.end_time = None
+        self.num_tokens = 0
+
+    def on_chain_start(self, serialized, inputs, *, run_id, tags=None, **kwargs):
+        if tags and ANSWER_TAG in tags:
+            self.answer_chain_runs.add(run_id)
+
+    def on_llm_start(
+        self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs
+    ):
+        if parent_run_id in self.answer_chain_runs:
+            self.answer_llm_runs.add(run_id)
+            self.llm_start_time = time.perf_counter()
+
+    def on_llm_new_token(self, token: str, *, run_id, **kwargs):
+        if run_id not in self.answer_llm_runs:
+            return
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        self.num_tokens += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, token)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        if run_id in self.answer_llm_runs:
+            self.end_time = time.perf_counter()
+
+    async def stream(self, task: asyncio.Task):
+        """
+        Yields the answer tokens until the chain task is done
+        """
+        while True:
+            next_token = asyncio.ensure_future(self.queue.get())
+            done, _ = await asyncio.wait(
+                {next_token, task}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if next_token in done:
+                yield next_token.result()
+                continue
+            next_token.cancel()
+            # Let the tokens scheduled from other threads land in the queue
+            await asyncio.sleep(0)
+            while not self.queue.empty():
+                yield self.queue.get_nowait()
+            return
+
+    def metrics(self):
+        trace = {"num_tokens": self.num_tokens}
+        if self.first_token_time is not None:
+            trace["time_to_first_token"] = self.first_token_time - self.start_time
+            if self.llm_start_time is not None:
+                trace["llm_time_to_first_token"] = (
+                    self.first_token_time - self.llm_start_time
+                )
+        if self.end_time is not None and self.first_token_time is not None:
+            generation_time = self.end_time - self.first_token_time
+            if generation_time > 0 and self.num_tokens > 1:
+                trace["tokens_per_sec"] = (self.num_tokens - 1) / generation_time
+        return trace
@@ -0,0 +1,272 @@
+import bisect
+import re
+import time
+from typing import List
+
+import numpy as np
+import tiktoken
+
+
+class DelimiterRemover:
+    """
+    Replaces the delimiters (regexes) with a space, one after the other, like
+    the re.sub calls of each chunk it replaces but with the patterns compiled
+    once. One alternation of all the delimiters is not equivalent (it leaves
+    the spaces around a delimiter: "a \\n b" -> "a   b"), and is slower, as
+    literal patterns are searched with a fast path that alternations lose.
+    """
+
+    def __init__(self, delimiters: List[str]):
+        self.patterns = [re.compile(delimiter) for delimiter in delimiters]
+
+    def __call__(self, text: str) -> str:
+        for pattern in self.patterns:
+            text = pattern.sub(" ", text)
+        return text
+
+
+class TokenOffsetSplitter:
+    """
+    Recursive text splitter with the separator priority and overlap semantics of
+    langchain's RecursiveCharacterTextSplitter: a text is split on the first
+    separator it contains (kept at the start of the following piece), pieces
+    that are still too long are split on the next separators, and the pieces
+    are merged back into chunks of up to chunk_size with chunk_overlap.
+
+    Unlike RecursiveCharacterTextSplitter.from_tiktoken_encoder, which
+    re-tokenizes every piece at every level of the recursion, each text is
+    tokenized once (texts are encoded in a batch) and the chunks are cut at
+    character offsets: the length of a piece is the number of tokens that
+    start inside it, and only the pieces that a token crosses are encoded on
+    their own. The chunks are the same as langchain's. With encoding_name None,
+    lengths are counted in characters.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = 300,
+        chunk_overlap: int = 30,
+        separators: List[str] = None,
+        encoding_name: str = "gpt2",
+    ):
+        if chunk_overlap > chunk_size:
+            raise ValueError(
+                f"Got a larger chunk overlap ({chunk_overlap}) than chunk size "
+                f"({chunk_size}), should be smaller."
+            )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = separators or ["\n\n", "\n", " ", ""]
+        self.encoding = (
+            tiktoken.get_encoding(encoding_name) if encoding_name is not None else None
+        )
+        self.token_lengths = None
+        self.char_lengths = {}
+        self.num_encoded_spans = 0
+
+    def get_token_lengths(self):
+        """
+        Length in bytes of every token of the vocabulary
+        """
+        if self.token_lengths is None:
+            token_lengths = np.zeros(self.encoding.n_vocab, dtype=np.int64)
+            for token in range(self.encoding.n_vocab):
+                try:
+                    token_lengths[token] = len(
+                        self.encoding.decode_single_token_bytes(token)
+                    )
+                except KeyError:
+                    pass
+            self.token_lengths = token_lengths
+        return self.token_lengths
+
+    def get_token_starts(self, texts: List[str]) -> list:
+        """
+        Character offset of the start of every token, for each text. Same as
+        the offsets of Encoding.decode_with_offsets, computed with numpy.
+        """
+        if self.encoding is None:
+            return [None] * len(texts)
+        token_lengths = self.get_token_lengths()
+        token_starts = []
+        for text, tokens in zip(texts, self.encoding.encode_ordinary_batch(texts)):
+            data = np.frombuffer(
+                text.encode("utf-8", errors="surrogatepass"), dtype=np.uint8
+            )
+            lengths = token_lengths[np.asarray(tokens, dtype=np.int64)]
+            byte_starts = np.cumsum(lengths) - lengths
+            # Index of the character that every byte belongs to
+            char_of_byte = np.cumsum((data & 0xC0) != 0x80) - 1
+            token_starts.append(char_of_byte[byte_starts].tolist())
+        return token_starts
+
+    def char_length(self, char: str) -> int:
+        """
+        Length of a single character, encoded on its own
+        """
+        if char not in self.char_lengths:
+            self.char_lengths[char] = len(self.encoding.encode_ordinary(char))
+        return self.char_lengths[char]
+
+    def is_token_start(self, token_starts, position: int) -> bool:
+        i = bisect.bisect_left(token_starts, position)
+        return i < len(token_starts) and token_starts[i] == position
+
+    def length(self, text, token_starts, start: int, end: int) -> int:
+        """
+        Length of text[start:end] encoded on its own, like the length function
+        of RecursiveCharacterTextSplitter.from_tiktoken_encoder. When the span
+        starts and ends at token boundaries of the whole text, it is the number
+        of tokens that start inside it, otherwise (a token crosses the span,
+        e.g. a run of whitespace) the span is encoded.
+        """
+        if token_starts is None:
+            return end - start
+        if end - start == 1:
+            return self.char_length(text[start])
+        if self.is_token_start(token_starts, start) and (
+            end == len(text) or self.is_token_start(token_starts, end)
+        ):
+            return bisect.bisect_left(token_starts, end) - bisect.bisect_left(
+                token_starts, start
+            )
+        self.num_encoded_spans += 1
+        return len(self.encoding.encode_ordinary(text[start:end]))
+
+    def split_on(self, text, start, end, separator):
+        """
+        Spans of text[start:end] split on separator, which is kept at the start
+        of the following span. The empty separator splits into characters.
+        """
+        if separator == "":
+            bounds = list(range(start, end))
+        else:
+            bounds = [start]
+            position = text.find(separator, start, end)
+            while position != -1:
+                if position > bounds[-1]:
+                    bounds.append(position)
+                position = text.find(separator, position + len(separator), end)
+        bounds.append(end)
+        return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+    def merge(self, text, spans):
+        """
+        Merges consecutive (start, end, length) spans into chunks of up to
+        chunk_size, the next chunk starting with up to chunk_overlap of the
+        previous one. Chunks are stripped, and dropped when empty.
+        """
+        chunks = []
+        current, total = [], 0
+        first = 0  # index of the first span of the current chunk
+        for start, end, length in spans:
+            if total + length > self.chunk_size and len(current) > first:
+                chunks.append(text[current[first][0] : current[-1][1]].strip())
+                while total > self.chunk_overlap or (
+                    total + length > self.chunk_size and total > 0
+                ):
+                    total -= current[first][2]
+                    first += 1
+            current.append((start, end, length))
+            total += length
+        if len(current) > first:
+            chunks.append(text[current[first][0] : current[-1][1]].strip())
+        return [chunk for chunk in chunks if chunk]
+
+    def split_span(self, text, token_starts, start, end, separators):
+        separator, next_separators = separators[-1], []
+        for i, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if text.find(candidate, start, end) != -1:
+                separator, next_separators = candidate, separators[i + 1 :]
+                break
+
+        chunks, good_spans = [], []
+        for span in self.split_on(text, start, end, separator):
+            length = self.length(text, token_starts, *span)
+            if length < self.chunk_size:
+                good_spans.append((*span, length))
+                continue
+            if good_spans:
+                chunks.extend(self.merge(text, good_spans))
+                good_spans = []
+            if next_separators:
+                chunks.extend(
+                    self.split_span(text, token_starts, *span, next_separators)
+                )
+            else:
+                # Too long and nothing left to split on, kept as is
+                chunks.append(text[span[0] : span[1]])
+        if good_spans:
+            chunks.extend(self.merge(text, good_spans))
+        return chunks
+
+    def split_texts(self, texts: List[str]) -> List[List[str]]:
+        return [
+            self.split_span(text, token_starts, 0, len(text), self.separators)
+            for text, token_starts in zip(texts, self.get_token_starts(texts))
+        ]
+
+    def split_text(self, text: str) -> List[str]:
+        return self.split_texts([text])[0]
+
+
+if __name__ == "__main__":
+    # Micro-benchmark against the langchain splitter, on the files given as
+    # arguments or on a synthetic corpus, and check that both give the same
+    # chunks
+    import sys
+
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    if len(sys.argv) > 1:
+        texts = []
+        for path in sys.argv[1:]:
+            with open(path, "r", errors="ignore") as f:
+                texts.append(f.read())
+    else:
+        paragraph = " ".join(f"word{i % 97} of the lecture notes." for i in range(60))
+        texts = ["\n\n".join(paragraph for _ in range(40)) for _ in range(50)]
+
+    options = dict(chunk_size=300, chunk_overlap=30, separators=["\n\n", "\n", " ", ""])
+    splitters = {
+        "RecursiveCharacterTextSplitter": RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            **options
+        ),
+        "TokenOffsetSplitter": TokenOffsetSplitter(**options),
+    }
+    results = {}
+    for name, splitter in splitters.items():
+        start = time.perf_counter()
+        if isinstance(splitter, TokenOffsetSplitter):
+            results[name] = splitter.split_texts(texts)
+        else:
+            results[name] = [splitter.split_text(text) for text in texts]
+        elapsed = time.perf_counter() - start
+        num_chunks = sum(len(chunks) for chunks in results[name])
+        print(
+            f"{name}: {num_chunks} chunks in {elapsed:.2f}s "
+            f"({num_chunks / elapsed:.1f} chunks/sec)"
+        )
+
+    def count_different(results, expected):
+        return sum(chunks != other for chunks, other in zip(results, expected))
+
+    num_different = count_different(
+        results["TokenOffsetSplitter"], results["RecursiveCharacterTextSplitter"]
+    )
+    print(f"Parity (chunk_size=300): {len(texts) - num_different}/{len(texts)} texts")
+    # Small chunk sizes go down to the last separators, and split words
+    for chunk_size, chunk_overlap in [(50, 10), (10, 3), (2, 1)]:
+        options.update(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(**options)
+        num_different = count_different(
+            TokenOffsetSplitter(**options).split_texts(texts),
+            [splitter.split_text(text) for text in texts],
+        )
+        print(
+            f"Parity (chunk_size={chunk_size}): "
+            f"{len(texts) - num_different}/{len(texts)} texts"
+        )
@@ -1,59 +1,507 @@
 import logging
+import multiprocessing
 import os
+import time
 import yaml
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice, tee
+from uuid import uuid4
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS, Chroma
 from langchain.schema.vectorstore import VectorStoreRetriever
 from langchain.callbacks.manager import CallbackManagerForRetrieverRun
 from langchain.schema.document import Document
 from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun
+from langchain_core.runnables.config import run_in_executor
 from ragatouille import RAGPretrainedModel
 
 try:
+    from modules.model_registry import model_registry
     from modules.embedding_model_loader import EmbeddingModelLoader
     from modules.data_loader import DataLoader
+    from modules.ingestion_manifest import *
+    from modules.embedding_cache import CachedEmbeddings
+    from modules.query_batcher import get_query_batcher
+    from modules.http_cache import get_http_cache
+    from modules.faiss_index import *
+    from modules.lexical_index import *
+    from modules.catalog import CourseCatalog, get_catalog_path
+    from modules.reranker import Reranker
+    from modules.mmr import mmr_search
+    from modules.sqlite_docstore import (
+        docstore_exists,
+        faiss_store_exists,
+        load_faiss_store,
+        save_faiss_store,
+    )
     from modules.constants import *
     from modules.helpers import *
 except:
+    from model_registry import model_registry
     from embedding_model_loader import EmbeddingModelLoader
     from data_loader import DataLoader
+    from ingestion_manifest import *
+    from embedding_cache import CachedEmbeddings
+    from query_batcher import get_query_batcher
+    from http_cache import get_http_cache
+    from faiss_index import *
+    from lexical_index import *
+    from catalog import CourseCatalog, get_catalog_path
+    from reranker import Reranker
+    from mmr import mmr_search
+    from sqlite_docstore import (
+        docstore_exists,
+        faiss_store_exists,
+        load_faiss_store,
+        save_faiss_store,
+    )
     from constants import *
     from helpers import *
 
-from typing import List
+from typing import List, Optional
 
 
 class VectorDBScore(VectorStoreRetriever):
+    retrieval_options: dict = {}
+    lexical_index: Optional[LexicalIndex] = None
+    catalog: Optional[CourseCatalog] = None
+    reranker: Optional[Reranker] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def get_mode(self) -> str:
+        if self.lexical_index is None or "filter" in self.search_kwargs:
+            return "dense"
+        return self.retrieval_options.get("mode", "dense")
+
+    def search_catalog(self, query: str):
+        """
+        The catalog records of the courses the query names, placed before the
+        retrieved chunks: the records answer the catalog fields (prerequisites,
+        credits...), the chunks the rest of the question
+        """
+        if self.catalog is None or "filter" in self.search_kwargs:
+            return []
+        start = time.perf_counter()
+        courses = self.catalog.lookup(
+            query, max_matches=self.retrieval_options.get("catalog_max_matches", 3)
+        )
+        if not courses:
+            return []
+        elapsed = time.perf_counter() - start
+        retrieval_stats.record("catalog", elapsed)
+        return self.annotate(
+            [(self.catalog.to_document(course), 1.0) for course in courses],
+            {"retrieval_path": "catalog", "retrieval_time": elapsed},
+        )
+
+    def search_lexical(self, query: str, k: int, fast_path: bool = True):
+        """
+        The lexical candidates of the query as documents, and whether they are
+        decisive enough to skip dense retrieval (the fast path). BM25 scores are
+        not similarities: they are added as bm25_score, and the score is None.
+        """
+        options = self.retrieval_options
+        hits = self.lexical_index.search(query, options.get("fetch_k", 20))
+        decisive = False
+        if fast_path and options.get("lexical_fast_path", True):
+            decisive = self.lexical_index.is_decisive(
+                query,
+                hits,
+                k,
+                max_terms=options.get("fast_path_max_terms", 4),
+                min_idf=options.get("fast_path_min_idf", 3.0),
+            )
+        if decisive:
+            hits = hits[:k]
+        docs = get_documents(self.vectorstore, [_id for _id, _, _ in hits])
+        return [
+            (
+                Document(
+                    page_content=docs[_id].page_content,
+                    metadata={**docs[_id].metadata, "bm25_score": float(bm25_score)},
+                ),
+                None,
+            )
+            for _id, bm25_score, _ in hits
+            if _id in docs
+        ], decisive
+
+    def get_num_candidates(self) -> int:
+        """
+        Documents taken from the first retrieval stage: k, or the top_n that the
+        reranker picks k from
+        """
+        if self.reranker is not None:
+            return max(self.reranker.top_n, self.search_kwargs.get("k", 4))
+        return self.search_kwargs.get("k", 4)
+
+    def rerank(self, query: str, docs_and_scores: list):
+        if self.reranker is None or not docs_and_scores:
+            return docs_and_scores, {}
+        return self.reranker.rerank(
+            query, docs_and_scores, self.search_kwargs.get("k", 4)
+        )
+
+    def use_mmr(self, search_kwargs: dict) -> bool:
+        return (
+            self.retrieval_options.get("mmr", False) and "filter" not in search_kwargs
+        )
+
+    def search_mmr(self, query: str, search_kwargs: dict, query_vector=None):
+        """
+        Dense retrieval diversified with maximal marginal relevance: near
+        duplicates of a chunk that is already retrieved are passed over. The
+        pool is at least 4 * k chunks, so that MMR still has chunks to pass over
+        when k is large (the candidates of hybrid retrieval or of the reranker).
+        """
+        k = search_kwargs.get("k", 4)
+        docs_and_scores, timings = mmr_search(
+            self.vectorstore,
+            query,
+            k=k,
+            fetch_k=max(self.retrieval_options.get("mmr_fetch_k", 20), 4 * k),
+            lambda_mult=self.retrieval_options.get("lambda_mult", 0.5),
+            query_vector=query_vector,
+        )
+        score_threshold = search_kwargs.get("score_threshold")
+        if score_threshold is not None:
+            docs_and_scores = [
+                (doc, score)
+                for doc, score in docs_and_scores
+                if score >= score_threshold
+            ]
+        return docs_and_scores, timings
+
+    def search_dense(self, query: str, search_kwargs: dict, query_vector=None):
+        """
+        Dense retrieval of the query, or of query_vector when the query is
+        already embedded (e.g. blended with the chat history, see
+        condensation.py)
+        """
+        if self.use_mmr(search_kwargs):
+            return self.search_mmr(query, search_kwargs, query_vector)
+        if query_vector is None:
+            return (
+                self.vectorstore.similarity_search_with_relevance_scores(
+                    query, **search_kwargs
+                ),
+                {},
+            )
+        start = time.perf_counter()
+        if isinstance(self.vectorstore, FAISS):
+            docs_and_distances = (
+                self.vectorstore.similarity_search_with_score_by_vector(
+                    query_vector,
+                    k=search_kwargs.get("k", 4),
+                    filter=search_kwargs.get("filter"),
+                )
+            )
+        else:
+            docs_and_distances = (
+                self.vectorstore.similarity_search_by_vector_with_relevance_scores(
+                    query_vector,
+                    k=search_kwargs.get("k", 4),
+                    filter=search_kwargs.get("filter"),
+                )
+            )
+        relevance_score_fn = self.vectorstore._select_relevance_score_fn()
+        score_threshold = search_kwargs.get("score_threshold")
+        docs_and_scores = [
+            (doc, relevance_score_fn(distance))
+            for doc, distance in docs_and_distances
+            if score_threshold is None
+            or relevance_score_fn(distance) >= score_threshold
+        ]
+        return docs_and_scores, {"retrieval_search_time": time.perf_counter() - start}
+
+    def fuse(self, dense_results, lexical_results, k: int):
+        """
+        The k best documents of both rankings, by reciprocal rank fusion. Their
+        score stays the dense similarity (None for the documents that only the
+        lexical search found), the fused score is added as rrf_score.
+        """
+        similarities = {document_key(doc): score for doc, score in dense_results}
+        fused = reciprocal_rank_fusion(
+            [
+                [doc for doc, _ in dense_results],
+                [doc for doc, _ in lexical_results],
+            ],
+            k,
+            rrf_k=self.retrieval_options.get("rrf_k", 60),
+        )
+        return [
+            (
+                Document(
+                    page_content=doc.page_content,
+                    metadata={**doc.metadata, "rrf_score": rrf_score},
+                ),
+                similarities.get(document_key(doc)),
+            )
+            for doc, rrf_score in fused
+        ]
+
+    def annotate(self, docs_and_scores, extra: dict) -> List[Document]:
+        # Make the score part of the document metadata. The docstore is shared
+        # across sessions, so annotate a copy instead of the stored document
+        return [
+            Document(
+                page_content=doc.page_content,
+                metadata={**doc.metadata, "score": score, **extra},
+            )
+            for doc, score in docs_and_scores
+        ]
 
     # See https://github.com/langchain-ai/langchain/blob/61dd92f8215daef3d9cf1734b0d1f8c70c1571c3/libs/langchain/langchain/vectorstores/base.py#L500
     def _get_relevant_documents(
-        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        query_vector: Optional[List[float]] = None,
     ) -> List[Document]:
-        docs_and_similarities = (
-            self.vectorstore.similarity_search_with_relevance_scores(
-                query, **self.search_kwargs
+        catalog_docs = self.search_catalog(query)
+        start = time.perf_counter()
+        mode = self.get_mode()
+        k = self.get_num_candidates()
+        timings = {}
+        lexical_results, decisive = [], False
+        if mode == "hybrid":
+            # A query_vector blended with the chat history is never skipped,
+            # the lexical search only sees the question
+            lexical_results, decisive = self.search_lexical(
+                query, k, fast_path=query_vector is None
             )
+        if decisive:
+            path, docs_and_scores = "lexical", lexical_results
+        else:
+            search_kwargs = dict(self.search_kwargs)
+            search_kwargs["k"] = k
+            if mode == "hybrid":
+                search_kwargs["k"] = max(k, self.retrieval_options.get("fetch_k", 20))
+            docs_and_scores, timings = self.search_dense(
+                query, search_kwargs, query_vector
+            )
+            path = mode
+            if mode == "hybrid":
+                docs_and_scores = self.fuse(docs_and_scores, lexical_results, k)
+        docs_and_scores, rerank_stats = self.rerank(query, docs_and_scores)
+        elapsed = time.perf_counter() - start
+        retrieval_stats.record(
+            path, elapsed, bool(lexical_results) if mode == "hybrid" else None
+        )
+        return catalog_docs + self.annotate(
+            docs_and_scores,
+            {
+                "retrieval_path": path,
+                "retrieval_time": elapsed,
+                **timings,
+                **rerank_stats,
+            },
         )
-        # Make the score part of the document metadata
-        for doc, similarity in docs_and_similarities:
-            doc.metadata["score"] = similarity
-
-        docs = [doc for doc, _ in docs_and_similarities]
-        return docs
 
     async def _aget_relevant_documents(
-        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+        query_vector: Optional[List[float]] = None,
     ) -> List[Document]:
-        docs_and_similarities = (
-            self.vectorstore.similarity_search_with_relevance_scores(
-                query, **self.search_kwargs
+        # Dictionary lookups, fast enough to run on the event loop
+        catalog_docs = self.search_catalog(query)
+        start = time.perf_counter()
+        mode = self.get_mode()
+        search_kwargs = dict(self.search_kwargs)
+        k = self.get_num_candidates()
+        search_kwargs["k"] = k
+        lexical_results, decisive = [], False
+        if mode == "hybrid":
+            lexical_results, decisive = await run_in_executor(
+                None, self.search_lexical, query, k, query_vector is None
             )
+            search_kwargs["k"] = max(k, self.retrieval_options.get("fetch_k", 20))
+
+        timings = {}
+        if decisive:
+            # No query embedding needed
+            path, docs_and_similarities = "lexical", lexical_results
+        else:
+            path = mode
+            batcher = get_query_batcher(self.vectorstore, self.retrieval_options)
+            if (
+                self.use_mmr(search_kwargs)
+                or batcher is None
+                or "filter" in search_kwargs
+                or query_vector is not None
+            ):
+                docs_and_similarities, timings = await run_in_executor(
+                    None, self.search_dense, query, search_kwargs, query_vector
+                )
+            else:
+                # Embedding and search run off the event loop, batched together
+                # with the queries of other sessions
+                docs_and_similarities, timings = await batcher.search(
+                    query,
+                    k=search_kwargs.get("k", 4),
+                    score_threshold=search_kwargs.get("score_threshold"),
+                )
+            if mode == "hybrid":
+                docs_and_similarities = self.fuse(
+                    docs_and_similarities, lexical_results, k
+                )
+        rerank_stats = {}
+        if self.reranker is not None:
+            docs_and_similarities, rerank_stats = await run_in_executor(
+                None, self.rerank, query, docs_and_similarities
+            )
+        elapsed = time.perf_counter() - start
+        retrieval_stats.record(
+            path, elapsed, bool(lexical_results) if mode == "hybrid" else None
         )
-        # Make the score part of the document metadata
-        for doc, similarity in docs_and_similarities:
-            doc.metadata["score"] = similarity
+        return catalog_docs + self.annotate(
+            docs_and_similarities,
+            {
+                "retrieval_path": path,
+                "retrieval_time": elapsed,
+                **timings,
+                **rerank_stats,
+            },
+        )
+
+
+# Embedding model of an EmbeddingPipeline worker process
+_worker_embedding_model = None
+
+
+def _init_embedding_worker(config, num_threads):
+    global _worker_embedding_model
+    try:
+        import torch
+
+        # Avoid oversubscribing the cores when several workers run in parallel
+        torch.set_num_threads(num_threads)
+    except ImportError:
+        pass
+    _worker_embedding_model = EmbeddingModelLoader(config).load_embedding_model(
+        use_cache=False
+    )
 
-        docs = [doc for doc, _ in docs_and_similarities]
-        return docs
+
+def _embed_batch(texts):
+    return _worker_embedding_model.embed_documents(texts)
+
+
+class EmbeddingPipeline:
+    """
+    Embeds a stream of chunks in batches. Local models run in a pool of worker
+    processes, OpenAI models with a bounded number of concurrent requests.
+    Cached vectors (see embedding_cache.py) are looked up before a batch is
+    submitted, so only the missing ones are computed.
+    """
+
+    def __init__(self, config, embedding_model, logger):
+        self.config = config
+        self.logger = logger
+        options = config["embedding_options"].get("embedding_pipeline", {})
+        self.batch_size = options.get("batch_size", 64)
+        self.num_workers = options.get("num_workers", 1)
+        self.max_concurrency = options.get("max_concurrency", 4)
+
+        if isinstance(embedding_model, CachedEmbeddings):
+            self.cache = embedding_model.cache
+            self.embedding_model = embedding_model.embedding_model
+        else:
+            self.cache = None
+            self.embedding_model = embedding_model
+
+    def get_executor(self):
+        if EmbeddingModelLoader(self.config).is_openai_model():
+            return ThreadPoolExecutor(max_workers=self.max_concurrency)
+        if self.num_workers > 1:
+            num_threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+            return ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_embedding_worker,
+                initargs=(self.config, num_threads),
+            )
+        return None
+
+    def submit(self, executor, texts):
+        if executor is None:
+            return self.embedding_model.embed_documents(texts)
+        if isinstance(executor, ThreadPoolExecutor):
+            return executor.submit(self.embedding_model.embed_documents, texts)
+        return executor.submit(_embed_batch, texts)
+
+    def embed(self, document_chunks, document_ids=None):
+        """
+        Yields (chunks, ids, vectors) for each batch, in input order
+        """
+        chunks_iter = iter(document_chunks)
+        ids_iter = iter(document_ids) if document_ids is not None else None
+        executor = self.get_executor()
+        max_pending = 2 * (self.num_workers if executor is not None else 1)
+        if isinstance(executor, ThreadPoolExecutor):
+            max_pending = 2 * self.max_concurrency
+        pending = deque()
+        num_chunks, start = 0, time.perf_counter()
+
+        def collect(batch):
+            chunks, ids, vectors, missing, result = batch
+            if missing:
+                new_vectors = result if executor is None else result.result()
+                if self.cache is not None:
+                    self.cache.put(
+                        [chunks[i].page_content for i in missing], new_vectors
+                    )
+                for i, vector in zip(missing, new_vectors):
+                    vectors[i] = vector
+            return chunks, ids, [list(map(float, vector)) for vector in vectors]
+
+        try:
+            while True:
+                chunks = list(islice(chunks_iter, self.batch_size))
+                if not chunks:
+                    break
+                ids = (
+                    list(islice(ids_iter, len(chunks)))
+                    if ids_iter is not None
+                    else [str(uuid4()) for _ in chunks]
+                )
+                texts = [chunk.page_content for chunk in chunks]
+                if self.cache is not None:
+                    vectors = self.cache.get(texts)
+                else:
+                    vectors = [None] * len(texts)
+                missing = [i for i, vector in enumerate(vectors) if vector is None]
+                result = (
+                    self.submit(executor, [texts[i] for i in missing])
+                    if missing
+                    else None
+                )
+                pending.append((chunks, ids, vectors, missing, result))
+                while len(pending) >= max_pending:
+                    batch = collect(pending.popleft())
+                    num_chunks += len(batch[0])
+                    yield batch
+            while pending:
+                batch = collect(pending.popleft())
+                num_chunks += len(batch[0])
+                yield batch
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        elapsed = time.perf_counter() - start
+        self.logger.info(
+            f"\tEmbedded {num_chunks} chunks in {elapsed:.1f}s "
+            f"({num_chunks / max(elapsed, 1e-9):.1f} chunks/sec)"
+        )
 
 
 class VectorDB:
@@ -61,7 +509,17 @@ class VectorDB:
         self.config = config
         self.db_option = config["embedding_options"]["db_option"]
         self.document_names = None
-        self.webpage_crawler = WebpageCrawler()
+        self.index_config = None
+        self.index_build_time, self.flat_index = 0.0, None
+        self.http_cache = get_http_cache(config)
+        crawler_options = config["embedding_options"].get("crawler", {})
+        self.webpage_crawler = WebpageCrawler(
+            max_depth=crawler_options.get("max_depth"),
+            max_pages=crawler_options.get("max_pages"),
+            concurrency=crawler_options.get("concurrency", 8),
+            requests_per_second=crawler_options.get("requests_per_second", 5),
+            http_cache=self.http_cache,
+        )
 
         # Set up logging to both console and a file
         if logger is None:
@@ -105,12 +563,64 @@ class VectorDB:
                     )
                 )
             urls = all_urls
+            self.logger.info(f"Crawl stats: {self.webpage_crawler.get_stats()}")
         return files, urls
 
     def create_embedding_model(self):
         self.logger.info("Creating embedding function")
-        self.embedding_model_loader = EmbeddingModelLoader(self.config)
-        self.embedding_model = self.embedding_model_loader.load_embedding_model()
+        self.embedding_model = model_registry.get_embedding_model(self.config)
+
+    def get_db_path(self):
+        return os.path.join(
+            self.config["embedding_options"]["db_path"],
+            "db_"
+            + self.config["embedding_options"]["db_option"]
+            + "_"
+            + self.config["embedding_options"]["model"],
+        )
+
+    def get_manifest(self):
+        config_hash = hash_config(
+            {
+                "splitter_options": self.config["splitter_options"],
+                "model": self.config["embedding_options"]["model"],
+                "faiss_index": (
+                    {
+                        option: get_index_options(self.config)[option]
+                        for option in BUILD_OPTIONS
+                    }
+                    if self.db_option == "FAISS"
+                    else None
+                ),
+            }
+        )
+        return IngestionManifest(
+            os.path.join(self.get_db_path(), "manifest.json"), config_hash
+        )
+
+    def get_index_version(self):
+        """
+        Changes whenever the database is rebuilt
+        """
+        version_path = os.path.join(self.get_db_path(), "index_version")
+        if os.path.exists(version_path):
+            with open(version_path, "r") as f:
+                return f.read().strip()
+        # Databases saved before the version file was written
+        manifest_path = os.path.join(self.get_db_path(), "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "rb") as f:
+                return hash_text(f.read().decode("utf-8", errors="ignore"))
+        if os.path.exists(self.get_db_path()):
+            return str(os.path.getmtime(self.get_db_path()))
+        return "none"
+
+    def database_exists(self):
+        if self.db_option == "FAISS":
+            return faiss_store_exists(self.get_db_path())
+        elif self.db_option == "Chroma":
+            return os.path.isdir(self.get_db_path())
+        return False
 
     def initialize_database(
         self,
@@ -118,29 +628,38 @@ class VectorDB:
         document_names: list,
         documents: list,
         document_metadata: list,
+        document_ids: list = None,
+        incremental: bool = False,
     ):
         if self.db_option in ["FAISS", "Chroma"]:
             self.create_embedding_model()
         # Track token usage
         self.logger.info("Initializing vector_db")
         self.logger.info("\tUsing {} as db_option".format(self.db_option))
-        if self.db_option == "FAISS":
-            self.vector_db = FAISS.from_documents(
-                documents=document_chunks, embedding=self.embedding_model
-            )
-        elif self.db_option == "Chroma":
-            self.vector_db = Chroma.from_documents(
-                documents=document_chunks,
-                embedding=self.embedding_model,
-                persist_directory=os.path.join(
-                    self.config["embedding_options"]["db_path"],
-                    "db_"
-                    + self.config["embedding_options"]["db_option"]
-                    + "_"
-                    + self.config["embedding_options"]["model"],
-                ),
-            )
-        elif self.db_option == "RAGatouille":
+        if self.db_option in ["FAISS", "Chroma"]:
+            if incremental:
+                # Only the new chunks are added to the existing database
+                self.vector_db = self.load_database(read_only=False)
+            elif self.db_option == "FAISS":
+                self.vector_db = None
+            elif self.db_option == "Chroma":
+                # A full rebuild starts from an empty collection, the chunks of
+                # the previous build are dropped
+                Chroma(
+                    persist_directory=self.get_db_path(),
+                    embedding_function=self.embedding_model,
+                ).delete_collection()
+                self.vector_db = Chroma(
+                    persist_directory=self.get_db_path(),
+                    embedding_function=self.embedding_model,
+                )
+            self.index_build_time, self.flat_index = 0.0, None
+            self.add_chunks(document_chunks, document_ids)
+            if self.db_option == "FAISS" and self.vector_db is not None:
+                self.index_config = self.get_index_config(incremental)
+                self.logger.info(f"\tFAISS index: {self.index_config}")
+                self.flat_index = None
+        if self.db_option == "RAGatouille":
             self.RAG = RAGPretrainedModel.from_pretrained("colbert-ir/colbertv2.0")
             index_path = self.RAG.index(
                 index_name="new_idx",
@@ -148,65 +667,325 @@ class VectorDB:
                 document_ids=document_names,
                 document_metadatas=document_metadata,
             )
+        if isinstance(getattr(self, "embedding_model", None), CachedEmbeddings):
+            self.logger.info(f"\tEmbedding cache: {self.embedding_model.cache.stats()}")
         self.logger.info("Completed initializing vector_db")
 
+    def add_chunks(self, document_chunks, document_ids=None):
+        """
+        Embeds the chunks through the EmbeddingPipeline and adds them to the
+        database batch by batch, as the vectors arrive. A new FAISS index is
+        created once enough vectors are embedded to train it.
+        """
+        pipeline = EmbeddingPipeline(self.config, self.embedding_model, self.logger)
+        index_options = get_index_options(self.config)
+        train_size = get_train_size(index_options)
+        buffered = []
+        for batch in pipeline.embed(document_chunks, document_ids):
+            if self.db_option == "FAISS" and self.vector_db is None:
+                buffered.append(batch)
+                if sum(len(ids) for _, ids, _ in buffered) >= train_size:
+                    self.create_faiss_store(buffered, index_options)
+                    self.add_batches(buffered)
+                    buffered = []
+            else:
+                self.add_batches([batch])
+        if buffered:
+            self.create_faiss_store(buffered, index_options)
+            self.add_batches(buffered)
+
+    def create_faiss_store(self, batches, index_options):
+        train_vectors = np.array(
+            [vector for _, _, vectors in batches for vector in vectors],
+            dtype=np.float32,
+        )
+        start = time.perf_counter()
+        index = create_index(index_options, train_vectors, self.logger)
+        set_search_params(index, index_options)
+        self.index_build_time += time.perf_counter() - start
+        self.vector_db = FAISS(self.embedding_model, index, InMemoryDocstore(), {})
+        # Exact index over the same vectors, to measure the recall of the index
+        if index_options["evaluate"] and index_options["type"] != "Flat":
+            self.flat_index = faiss.IndexFlatL2(train_vectors.shape[1])
+
+    def add_batches(self, batches):
+        for chunks, ids, vectors in batches:
+            texts = [chunk.page_content for chunk in chunks]
+            metadatas = [chunk.metadata for chunk in chunks]
+            if self.db_option == "FAISS":
+                start = time.perf_counter()
+                self.vector_db.add_embeddings(
+                    list(zip(texts, vectors)), metadatas=metadatas, ids=ids
+                )
+                self.index_build_time += time.perf_counter() - start
+                if self.flat_index is not None:
+                    self.flat_index.add(np.array(vectors, dtype=np.float32))
+            elif self.db_option == "Chroma":
+                self.vector_db._collection.upsert(
+                    ids=ids, embeddings=vectors, metadatas=metadatas, documents=texts
+                )
+
+    def get_index_config(self, incremental: bool):
+        """
+        What the FAISS index was built with, and how it compares to exact search
+        """
+        index_options = get_index_options(self.config)
+        index = self.vector_db.index
+        if incremental:
+            index_config = load_index_config(self.get_db_path()) or {}
+        else:
+            index_config = {option: index_options[option] for option in BUILD_OPTIONS}
+            index_config["index"] = type(index).__name__
+            index_config["build_time"] = round(self.index_build_time, 3)
+            if isinstance(index, faiss.IndexIVF):
+                index_config["nlist"] = index.nlist
+            if self.flat_index is not None:
+                index_config.update(
+                    evaluate_index(index, self.flat_index, index_options)
+                )
+            else:
+                index_config["memory_bytes"] = get_index_memory(index)
+        index_config["dim"] = index.d
+        index_config["ntotal"] = index.ntotal
+        return index_config
+
     def create_database(self):
-        data_loader = DataLoader(self.config)
+        data_loader = DataLoader(self.config, self.http_cache)
         self.logger.info("Loading data")
         files, urls = self.load_files()
-        files, webpages = self.webpage_crawler.clean_url_list(urls)
-        if "storage/data/urls.txt" in files:
-            files.remove("storage/data/urls.txt")
-        document_chunks, document_names, documents, document_metadata = (
-            data_loader.get_chunks(files, webpages)
-        )
+        url_files, webpages = self.webpage_crawler.clean_url_list(urls)
+        files = files + url_files
+        url_file_path = self.config["embedding_options"]["url_file_path"]
+        # The course catalog is looked up as structured records, not embedded
+        catalog_path = get_catalog_path(self.config) or url_file_path
+        files = [
+            file
+            for file in files
+            if os.path.normpath(file)
+            not in [os.path.normpath(url_file_path), os.path.normpath(catalog_path)]
+        ]
+
+        incremental = self.config["embedding_options"].get(
+            "incremental_update", False
+        ) and self.db_option in ["FAISS", "Chroma"]
+        self.manifest = None
+        if incremental:
+            self.manifest = self.get_manifest()
+            if not (self.manifest.exists() and self.database_exists()):
+                self.logger.info("\tNo usable manifest found, rebuilding from scratch")
+                self.manifest.sources = {}
+                incremental = False
+
+        if (
+            incremental
+            and self.db_option == "FAISS"
+            and get_index_options(self.config)["type"] == "HNSW"
+        ):
+            # HNSW indexes can't remove vectors
+            self.logger.info("\tHNSW index, rebuilding from scratch")
+            self.manifest.sources = {}
+            incremental = False
+
+        # Files and webpages whose content hash matches the manifest are not
+        # read again. Remote content is hashed from the http cache, which only
+        # downloads what changed since it was last fetched.
+        file_hashes = {file: hash_file(file) for file in files}
+        if self.manifest is not None:
+            for url in files + webpages:
+                if file_hashes.get(url) is None and url.startswith(
+                    ("http://", "https://")
+                ):
+                    file_hashes[url] = self.http_cache.content_hash(url)
+        if incremental:
+            unchanged_files = [
+                file
+                for file in files + webpages
+                if self.manifest.is_unchanged(file, file_hashes[file])
+            ]
+            self.logger.info(
+                f"\tSkipping {len(unchanged_files)} unchanged files and webpages"
+            )
+            files = [file for file in files if file not in unchanged_files]
+            webpages = [url for url in webpages if url not in unchanged_files]
+        else:
+            unchanged_files = []
+
+        if self.db_option == "RAGatouille":
+            document_chunks, document_names, documents, document_metadata = (
+                data_loader.get_chunks(files, webpages)
+            )
+            self.logger.info("Completed loading data")
+            self.initialize_database(
+                document_chunks, document_names, documents, document_metadata
+            )
+            return
+
+        # Parsed sources stream through the embedding pipeline into the
+        # database, the corpus is never held in memory as a whole
+        parsed_sources = data_loader.iter_sources(files, webpages)
+        if self.manifest is None:
+            document_chunks = (
+                chunk for _, _, chunks in parsed_sources for chunk in chunks
+            )
+            self.initialize_database(document_chunks, None, None, None)
+        else:
+            existing_ids = self.manifest.chunk_ids()
+            new_chunks = self.update_manifest(parsed_sources, file_hashes, existing_ids)
+            chunks_iter, ids_iter = tee(new_chunks)
+            self.initialize_database(
+                (chunk for chunk, _ in chunks_iter),
+                None,
+                None,
+                None,
+                document_ids=(chunk_id for _, chunk_id in ids_iter),
+                incremental=incremental,
+            )
+            self.remove_stale_chunks(
+                set(files + unchanged_files + webpages), existing_ids, incremental
+            )
         self.logger.info("Completed loading data")
-        self.initialize_database(
-            document_chunks, document_names, documents, document_metadata
-        )
+        self.logger.info(f"HTTP cache: {self.http_cache.stats()}")
+
+    def update_manifest(self, parsed_sources, source_hashes, existing_ids):
+        """
+        Records the new state of every parsed source in the manifest, and yields
+        the (chunk, id) of the chunks that are not in the database yet
+        """
+        new_ids = set()
+        for source, pages, chunks in parsed_sources:
+            chunk_ids, seen_ids = [], set()
+            for chunk in chunks:
+                chunk_id = get_chunk_id(chunk)
+                if chunk_id in seen_ids:
+                    continue
+                seen_ids.add(chunk_id)
+                chunk_ids.append(chunk_id)
+                if chunk_id not in existing_ids and chunk_id not in new_ids:
+                    new_ids.add(chunk_id)
+                    yield chunk, chunk_id
+            page_hashes = {
+                str(metadata["page"]): hash_text(text) for text, metadata, _ in pages
+            }
+            source_hash = source_hashes.get(source) or hash_text(
+                "".join(page_hashes.values())
+            )
+            self.manifest.update_source(source, source_hash, page_hashes, chunk_ids)
+        self.logger.info(f"\t{len(new_ids)} new chunks")
+
+    def remove_stale_chunks(self, sources: set, existing_ids: set, delete: bool):
+        """
+        Drops the sources that are gone from the manifest, and deletes the chunks
+        that no source has anymore from the database. Sources that were not
+        parsed (e.g. a network error) keep their chunks.
+        """
+        for source in list(self.manifest.sources):
+            if source not in sources:
+                self.logger.info(f"\tSource removed: {source}")
+                self.manifest.remove_source(source)
+
+        removed_ids = existing_ids - self.manifest.chunk_ids()
+        if delete and removed_ids:
+            self.logger.info(f"\tDeleting {len(removed_ids)} stale chunks")
+            if self.db_option == "FAISS":
+                delete_vectors(self.vector_db, list(removed_ids))
+            else:
+                self.vector_db.delete(list(removed_ids))
 
     def save_database(self):
         if self.db_option == "FAISS":
-            self.vector_db.save_local(
-                os.path.join(
-                    self.config["embedding_options"]["db_path"],
-                    "db_"
-                    + self.config["embedding_options"]["db_option"]
-                    + "_"
-                    + self.config["embedding_options"]["model"],
-                )
-            )
+            save_faiss_store(self.get_db_path(), self.vector_db)
+            if getattr(self, "index_config", None) is not None:
+                save_index_config(self.get_db_path(), self.index_config)
         elif self.db_option == "Chroma":
             # db is saved in the persist directory during initialization
             pass
         elif self.db_option == "RAGatouille":
             # index is saved during initialization
             pass
+        if self.db_option in ["FAISS", "Chroma"]:
+            self.save_lexical_index()
+        if getattr(self, "manifest", None) is not None:
+            self.manifest.save()
+        self.save_index_version()
         self.logger.info("Saved database")
 
-    def load_database(self):
+    def save_index_version(self):
+        """
+        A new version on every save, cached answers of older versions are stale
+        (rewriting the index files does not change the mtime of the directory)
+        """
+        os.makedirs(self.get_db_path(), exist_ok=True)
+        version_path = os.path.join(self.get_db_path(), "index_version")
+        with open(version_path + ".tmp", "w") as f:
+            f.write(uuid4().hex)
+        os.replace(version_path + ".tmp", version_path)
+
+    def get_lexical_index_path(self):
+        return os.path.join(self.get_db_path(), "lexical_index")
+
+    def save_lexical_index(self):
+        """
+        BM25 index over the chunks of the database, with the same chunk ids
+        """
+        start = time.perf_counter()
+        ids, texts = get_store_texts(self.vector_db)
+        LexicalIndex.build(ids, texts).save(self.get_lexical_index_path())
+        self.logger.info(
+            f"\tBuilt the lexical index of {len(ids)} chunks in "
+            f"{time.perf_counter() - start:.2f}s"
+        )
+
+    def load_lexical_index(self):
+        if not os.path.exists(self.get_lexical_index_path()):
+            self.logger.warning(
+                "The database has no lexical index, save it again to use hybrid "
+                "retrieval"
+            )
+            return None
+        return LexicalIndex.load(self.get_lexical_index_path())
+
+    def load_database(self, read_only: bool = True):
+        """
+        A read_only FAISS database (the one the app serves) fetches its
+        documents from the docstore when they are retrieved. With the
+        serving.mmap option, the index is memory-mapped too: workers serving
+        the same database share one copy of it, and loading doesn't read it.
+        """
         self.create_embedding_model()
         if self.db_option == "FAISS":
-            self.vector_db = FAISS.load_local(
-                os.path.join(
-                    self.config["embedding_options"]["db_path"],
-                    "db_"
-                    + self.config["embedding_options"]["db_option"]
-                    + "_"
-                    + self.config["embedding_options"]["model"],
-                ),
-                self.embedding_model,
-                allow_dangerous_deserialization=True,
-            )
+            index_options = get_index_options(self.config)
+            index_config = load_index_config(self.get_db_path())
+            serving_options = self.config["embedding_options"].get("serving", {})
+            if docstore_exists(self.get_db_path()):
+                self.vector_db = load_faiss_store(
+                    self.get_db_path(),
+                    self.embedding_model,
+                    read_only=read_only,
+                    mmap=serving_options.get("mmap", False),
+                    index_type=(index_config or {}).get("type", "Flat"),
+                )
+            else:
+                self.logger.warning(
+                    "Loading the pickled docstore of an older database, save it "
+                    "again to load it without unpickling"
+                )
+                self.vector_db = FAISS.load_local(
+                    self.get_db_path(),
+                    self.embedding_model,
+                    allow_dangerous_deserialization=True,
+                )
+            if (
+                index_config is not None
+                and index_config["type"] != index_options["type"]
+            ):
+                self.logger.warning(
+                    f"The database has a {index_config['type']} index, rebuild it "
+                    f"to use {index_options['type']}"
+                )
+            set_search_params(self.vector_db.index, index_options)
         elif self.db_option == "Chroma":
             self.vector_db = Chroma(
-                persist_directory=os.path.join(
-                    self.config["embedding_options"]["db_path"],
-                    "db_"
-                    + self.config["embedding_options"]["db_option"]
-                    + "_"
-                    + self.config["embedding_options"]["model"],
-                ),
+                persist_directory=self.get_db_path(),
                 embedding_function=self.embedding_model,
             )
         elif self.db_option == "RAGatouille":
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app runs from code/ and imports its modules as modules.<name>
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "code"))
@@ -0,0 +1,74 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from modules.http_cache import HTTPCache
+
+
+@pytest.fixture
+def page():
+    return {"body": b"<html><body>Lecture 1</body></html>", "etag": '"v1"'}
+
+
+@pytest.fixture
+def url(page):
+    """
+    Url of a local page served with an ETag, 304 when If-None-Match matches it
+    """
+
+    class ETagHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.headers.get("If-None-Match") == page["etag"]:
+                self.send_response(304)
+                self.send_header("ETag", page["etag"])
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("ETag", page["etag"])
+            self.send_header("Content-Length", str(len(page["body"])))
+            self.end_headers()
+            self.wfile.write(page["body"])
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ETagHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/lecture1.html"
+    server.shutdown()
+    server.server_close()
+
+
+def test_unchanged_page_is_not_downloaded_again(tmp_path, url):
+    # Each HTTPCache is a new build on the same cache directory
+    first = HTTPCache(str(tmp_path)).fetch(url)
+    assert first.ok and not first.not_modified
+
+    cache = HTTPCache(str(tmp_path))
+    second = cache.fetch(url)
+    assert second.ok and second.not_modified
+    assert second.content == first.content
+    assert cache.stats()["not_modified"] == 1
+    assert cache.stats()["downloaded"] == 0
+
+
+def test_changed_page_is_downloaded(tmp_path, url, page):
+    HTTPCache(str(tmp_path)).fetch(url)
+    page["body"], page["etag"] = b"<html><body>Lecture 1 v2</body></html>", '"v2"'
+
+    cache = HTTPCache(str(tmp_path))
+    response = cache.fetch(url)
+    assert response.ok and not response.not_modified
+    assert response.content == page["body"]
+    assert cache.stats()["downloaded"] == 1
+
+
+def test_url_is_requested_once_per_build(tmp_path, url):
+    cache = HTTPCache(str(tmp_path))
+    cache.fetch(url)
+    assert cache.fetch(url).not_modified
+    assert cache.stats()["requests"] == 1
+    assert cache.stats()["fresh_hits"] == 1
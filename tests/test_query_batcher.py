@@ -0,0 +1,44 @@
+import asyncio
+
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from modules.query_batcher import QueryBatcher
+
+
+class InstructionEmbeddings(Embeddings):
+    """
+    Embeds queries differently from documents, like instruction models
+    """
+
+    def embed(self, text):
+        rng = np.random.default_rng(abs(hash(text)) % 2**32)
+        return rng.standard_normal(16).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed("query: " + text)
+
+
+# Random vectors are not normalized
+@pytest.mark.filterwarnings("ignore:Relevance scores")
+def test_batched_queries_are_embedded_as_queries():
+    vectorstore = FAISS.from_texts(
+        [f"chunk {i}" for i in range(50)], InstructionEmbeddings()
+    )
+    batcher = QueryBatcher(vectorstore, max_wait_ms=20)
+    queries = ["chunk 1", "chunk 2", "chunk 3"]
+
+    async def search_all():
+        return await asyncio.gather(*(batcher.search(query, k=4) for query in queries))
+
+    for query, (docs_and_scores, timings) in zip(queries, asyncio.run(search_all())):
+        assert timings["retrieval_batch_size"] == len(queries)
+        expected = vectorstore.similarity_search_with_relevance_scores(query, k=4)
+        assert [doc.page_content for doc, _ in docs_and_scores] == [
+            doc.page_content for doc, _ in expected
+        ]
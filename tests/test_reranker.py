@@ -0,0 +1,25 @@
+import pytest
+from langchain.schema.document import Document
+
+from modules.reranker import Reranker
+
+
+class LengthReranker(Reranker):
+    def score_batch(self, query, texts):
+        return [float(len(text)) for text in texts]
+
+
+def test_incomplete_reranker_fails_when_created():
+    class IncompleteReranker(Reranker):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteReranker()
+
+
+def test_rerank_keeps_the_best_k():
+    docs_and_scores = [
+        (Document(page_content=text), 0.0) for text in ["a", "ccc", "bb"]
+    ]
+    results, _ = LengthReranker().rerank("query", docs_and_scores, 2)
+    assert [doc.page_content for doc, _ in results] == ["ccc", "bb"]
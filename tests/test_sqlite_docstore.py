@@ -0,0 +1,50 @@
+import os
+
+from langchain_community.embeddings import FakeEmbeddings
+from langchain_community.vectorstores import FAISS
+
+from modules.sqlite_docstore import get_store_files, load_faiss_store, save_faiss_store
+
+embedding_model = FakeEmbeddings(size=8)
+
+
+def build(texts):
+    return FAISS.from_texts(texts, embedding_model)
+
+
+def test_index_and_docstore_of_the_same_build(tmp_path):
+    path = str(tmp_path)
+    save_faiss_store(path, build(["a", "b", "c"]))
+    index_path, db_path = get_store_files(path)
+    assert os.path.basename(index_path)[len("index-") : -len(".faiss")] == (
+        os.path.basename(db_path)[len("docstore-") : -len(".sqlite")]
+    )
+    # Same number of documents: only the build id tells the builds apart
+    save_faiss_store(path, build(["x", "y", "z"]))
+    assert get_store_files(path) != (index_path, db_path)
+    store = load_faiss_store(path, embedding_model, read_only=False)
+    assert sorted(doc.page_content for doc in store.docstore._dict.values()) == [
+        "x",
+        "y",
+        "z",
+    ]
+
+
+def test_loaded_store_survives_a_save(tmp_path):
+    path = str(tmp_path)
+    save_faiss_store(path, build(["a", "b", "c"]))
+    store = load_faiss_store(path, embedding_model, read_only=True, mmap=True)
+    save_faiss_store(path, build(["x", "y", "z"]))
+    save_faiss_store(path, build(["p", "q", "r"]))
+    assert sorted(doc.page_content for doc in store.similarity_search("a", k=3)) == [
+        "a",
+        "b",
+        "c",
+    ]
+
+
+def test_previous_build_is_kept(tmp_path):
+    path = str(tmp_path)
+    for texts in [["a"], ["b"], ["c"]]:
+        save_faiss_store(path, build(texts))
+    assert len([name for name in os.listdir(path) if name.endswith(".faiss")]) == 2
@@ -0,0 +1,71 @@
+import glob
+import os
+import re
+
+import pytest
+import yaml
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from modules.catalog import parse_catalog
+from modules.text_splitter import DelimiterRemover, TokenOffsetSplitter
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+
+
+def get_config():
+    with open(os.path.join(ROOT, "code", "config.yml"), "r") as f:
+        return yaml.safe_load(f)
+
+
+def get_documents():
+    """
+    Real documents of the repository: the markdown files and the course
+    abstracts of the catalog
+    """
+    texts = []
+    for path in glob.glob(os.path.join(ROOT, "**", "*.md"), recursive=True):
+        with open(path, "r", errors="ignore") as f:
+            texts.append(f.read())
+    with open(os.path.join(ROOT, "storage", "data", "catalog.json"), "r") as f:
+        for course in parse_catalog(f.read()):
+            texts.append(course.get("course_abstract") or "")
+    return texts
+
+
+def remove_delimiters_one_by_one(text, delimiters):
+    for delimiter in delimiters:
+        text = re.sub(delimiter, " ", text)
+    return text
+
+
+@pytest.mark.parametrize(
+    "text", ["a \n b", "word \nnext", "x\t y", "a\n\n\n\n\nb", "a     b\t\t c"]
+)
+def test_delimiter_remover_around_spaces(text):
+    delimiters = get_config()["splitter_options"]["delimiters_to_remove"]
+    assert DelimiterRemover(delimiters)(text) == remove_delimiters_one_by_one(
+        text, delimiters
+    )
+
+
+def test_delimiter_remover_on_documents():
+    delimiters = get_config()["splitter_options"]["delimiters_to_remove"]
+    remover = DelimiterRemover(delimiters)
+    documents = get_documents()
+    assert documents
+    for text in documents:
+        assert remover(text) == remove_delimiters_one_by_one(text, delimiters)
+
+
+@pytest.mark.parametrize("chunk_size,chunk_overlap", [(300, 30), (50, 10), (2, 1)])
+def test_splitter_parity_in_characters(chunk_size, chunk_overlap):
+    options = dict(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=get_config()["splitter_options"]["chunk_separators"],
+    )
+    splitter = RecursiveCharacterTextSplitter(**options)
+    documents = get_documents()
+    assert TokenOffsetSplitter(**options, encoding_name=None).split_texts(
+        documents
+    ) == [splitter.split_text(text) for text in documents]